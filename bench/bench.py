@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+'''Benchmarks of UltraBlog.vim, which run the commands of ultrablog.commands
+against synthetic archives, outside of Vim. A fake vim module stands for
+Vim, a blog on localhost stands for the blog. Results are written as JSON,
+and compared with a baseline written by an earlier run if one is given:
+
+    python bench/bench.py --sizes 1000,10000 --output baseline.json
+    python bench/bench.py --sizes 1000,10000 --baseline baseline.json
+
+The exit status is 1 if any case is slower than its baseline by more than
+the tolerance. Archives are generated once and kept in the work directory,
+every size runs on a fresh copy of its archive.
+'''
+
+import sys, os, time, json, random, shutil, tempfile, optparse, platform, sqlite3
+from timeit import default_timer as timer
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(BENCH_DIR, os.path.pardir, 'plugin'))
+
+import fakevim
+from fakeblog import UBFakeBlog
+
+vim = fakevim.install()
+from ultrablog import db, util, commands, listeners
+from ultrablog.registry import UBViewRegistry
+from ultrablog.worker import UBWorker
+
+# Bump when archives are generated differently, to stop reusing old ones
+ARCHIVE_VERSION = 1
+# Posts with this word are found by searches and changed by replacements
+NEEDLE = 'ultrablogneedle'
+
+def make_words(rnd, count):
+    syllables = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'pe', 'zu', 'bor', 'gan', 'tel', 'wix']
+    return [''.join([rnd.choice(syllables) for i in range(rnd.randint(1, 4))]) for i in range(count)]
+
+def make_archive(path, size, blog):
+    ''' Create an archive of size posts and pages, of which every fifth is a
+    draft, every tenth is a page, and one in a hundred has the needle
+    '''
+    rnd = random.Random(size)
+    words = make_words(rnd, 2000)
+    rows = []
+    for i in range(1, size+1):
+        isSent = i%5 != 0
+        text = [rnd.choice(words) for j in range(rnd.randint(80, 400))]
+        if i%100 == 7: text.insert(rnd.randint(0, len(text)), NEEDLE)
+        paragraphs = [' '.join(text[j:j+40]) for j in range(0, len(text), 40)]
+        rows.append(dict(id=i, post_id=isSent and i or None,
+            title=u'Post %d on %s %s' % (i, rnd.choice(words), rnd.choice(words)),
+            categories=u'Vim, Python', tags=u'vim,%s' % rnd.choice(words),
+            content=u'\n\n'.join(['<p>%s</p>' % p for p in paragraphs]),
+            slug=u'post-%d' % i, syntax='html', type=i%10==3 and 'page' or 'post',
+            status=isSent and 'publish' or 'draft'))
+
+    setup_plugin(path, blog)
+    conn = db.dbe.connect()
+    trans = conn.begin()
+    for i in range(0, len(rows), 1000):
+        conn.execute(db.Post.__table__.insert(), rows[i:i+1000])
+    trans.commit()
+    conn.close()
+    db.dbe.dispose()
+
+def sent_items(path):
+    ''' Return (post_id, struct) pairs of the sent items in the archive, to seed the blog
+    '''
+    conn = sqlite3.connect(path)
+    try:
+        rows = conn.execute("select post_id, title, type, status from post where post_id is not null").fetchall()
+    finally:
+        conn.close()
+    return [(postId, dict(postid=str(postId), title=title, post_type=type, post_status=status))
+        for postId, title, type, status in rows]
+
+def setup_plugin(path, blog):
+    ''' Point UltraBlog.vim to the database and the blog, as if Vim had just started
+    '''
+    for nr in [buf.number for buf in vim.buffers]: util.ub_forget_buffer(nr)
+    UBViewRegistry.views.clear()
+    vim.reset(ub_blog=dict(login_name='bench', password='bench', url=blog.url,
+        xmlrpc_uri='xmlrpc.php', db=path), ub_async=0, ub_use_ubviewer=0)
+    vim.onBufDelete.append(util.ub_forget_buffer)
+    close_plugin()
+    db.cfg = db.api = db.dbe = None
+    db.fts = False
+    db.ub_bootstrap()
+    if db.dbe is None: raise RuntimeError('UltraBlog.vim cannot be set up with %s' % path)
+
+def close_plugin():
+    ''' Close the connections to the database and to the blog
+    '''
+    if db.dbe is not None: db.dbe.dispose()
+    if db.api is not None: db.api('close')()
+
+def reset_views():
+    ''' Close every view, leaving an empty buffer
+    '''
+    for buf in list(vim.buffers): vim.command('bd! %d' % buf.number)
+
+def run_async(func):
+    ''' Run func with ub_async on and Vim having timers, then poll for the
+    results of background calls as the timer of UltraBlog.vim would
+    '''
+    vim.vars['ub_async'] = 1
+    vim.features['timers'] = '1'
+    try:
+        func()
+        deadline = time.time()+60
+        while UBWorker.isPending():
+            if time.time() > deadline: raise RuntimeError('Background calls did not finish in time')
+            time.sleep(0.001)
+            commands.ub_async_poll()
+    finally:
+        vim.vars['ub_async'] = 0
+        vim.features['timers'] = '0'
+
+def pick_ids(size, itemType, isSent, count):
+    rnd = random.Random(count)
+    ids = [i for i in range(1, size+1) if (i%10==3) == (itemType=='page') and (i%5!=0) == isSent]
+    return [rnd.choice(ids) for i in range(count)]
+
+# Cases, each of which is set up with the size of the archive and the number
+# of runs, and returns the function to time
+
+def case_list(size, runs):
+    return lambda i: commands.UBCmdList('post', 'local').execute()
+
+def case_list_deep(size, runs):
+    ''' The middle page of local posts, located by number
+    '''
+    pageNo = max(size/2/util.ub_get_option('ub_local_pagesize'), 1)
+    return lambda i: commands.UBCmdList('post', 'local', None, pageNo).execute()
+
+def case_list_remote(size, runs):
+    ''' Recent posts of the blog, which are looked up in the archive
+    '''
+    return lambda i: commands.UBCmdList('post', 'remote').execute()
+
+def case_list_remote_pages(size, runs):
+    ''' Every page of the blog, which are looked up in the archive
+    '''
+    return lambda i: commands.UBCmdList('page', 'remote').execute()
+
+def case_list_remote_async(size, runs):
+    return lambda i: run_async(commands.UBCmdList('post', 'remote').execute)
+
+def case_search(size, runs):
+    return lambda i: commands.UBCmdSearch(0, 1, NEEDLE).execute()
+
+def case_search_regexp(size, runs):
+    return lambda i: commands.UBCmdSearch(1, 1, NEEDLE[:-2]+'l+e').execute()
+
+def case_replace(size, runs):
+    # Replacing the needle with itself keeps the archive the same for every run
+    return lambda i: commands.UBCmdReplace(0, False, NEEDLE, NEEDLE).execute()
+
+def case_replace_dry_run(size, runs):
+    return lambda i: commands.UBCmdReplace(0, True, NEEDLE, NEEDLE).execute()
+
+def case_open(size, runs):
+    ids = pick_ids(size, 'post', True, runs)
+    return lambda i: commands.UBCmdOpen(ids[i], 'post').execute()
+
+def case_save(size, runs):
+    ids = pick_ids(size, 'post', True, runs)
+    def run(i):
+        commands.UBCmdOpen(ids[i], 'post').execute()
+        vim.current.buffer.append('<p>Saved by run %d.</p>' % i)
+        return lambda: commands.UBCmdSave().execute()
+    return run
+
+def case_send(size, runs):
+    ids = pick_ids(size, 'post', True, runs)
+    def run(i):
+        commands.UBCmdOpen(ids[i], 'post').execute()
+        return lambda: commands.UBCmdSend().execute()
+    return run
+
+def case_send_async(size, runs):
+    ids = pick_ids(size, 'post', True, runs)
+    def run(i):
+        commands.UBCmdOpen(ids[i], 'post').execute()
+        return lambda: run_async(lambda: commands.UBCmdSend().execute())
+    return run
+
+def case_async_errors(size, runs):
+    ''' Two background calls finished by the same poll, of which the first
+    fails, the result of the second must be delivered all the same
+    '''
+    def run(i):
+        results = []
+        def call():
+            commands.ub_call_api('Failing', 'metaWeblog.getPost', (-1, 'bench', 'bench'), results.append)
+            commands.ub_call_api('Listing', 'metaWeblog.getRecentPosts', ('', 'bench', 'bench', 10), results.append)
+            while UBWorker.results.qsize() < 2: time.sleep(0.001)
+        run_async(call)
+        if len(results) != 1 or len(vim.errors) != 1:
+            raise RuntimeError('async_errors delivered %d results and %d errors' % (len(results), len(vim.errors)))
+        del vim.errors[:]
+    return run
+
+CASES = [
+    ('list', case_list),
+    ('list_deep', case_list_deep),
+    ('list_remote', case_list_remote),
+    ('list_remote_pages', case_list_remote_pages),
+    ('list_remote_async', case_list_remote_async),
+    ('search', case_search),
+    ('search_regexp', case_search_regexp),
+    ('replace', case_replace),
+    ('replace_dry_run', case_replace_dry_run),
+    ('open', case_open),
+    ('save', case_save),
+    ('send', case_send),
+    ('send_async', case_send_async),
+    ('async_errors', case_async_errors),
+]
+
+def measure(name, factory, size, runs, blog):
+    ''' Run the case and return its record, a factory may return a function
+    which prepares each run and returns the function to time instead
+    '''
+    func = factory(size, runs)
+    times = []
+    calls = 0
+    for i in range(runs):
+        reset_views()
+        before = blog.calls
+        start = timer()
+        result = func(i)
+        if callable(result):
+            before = blog.calls
+            start = timer()
+            result()
+        times.append(timer()-start)
+        calls += blog.calls-before
+        if len(vim.errors)>0: raise RuntimeError('%s failed: %s' % (name, vim.errors[-1]))
+    times.sort()
+    return dict(case=name, size=size, runs=runs, unit='s', min=times[0], max=times[-1],
+        median=times[len(times)/2], mean=sum(times)/len(times), calls=float(calls)/runs)
+
+def compare(results, baseline, tolerance):
+    ''' Return comparisons of the medians with the ones in the baseline
+    '''
+    base = dict([((rec['case'], rec['size']), rec) for rec in baseline['results']])
+    comparisons = []
+    for rec in results:
+        old = base.get((rec['case'], rec['size']))
+        if old is None: continue
+        ratio = old['median']>0 and rec['median']/old['median'] or 1.0
+        status = ratio > 1+tolerance and 'slower' or ratio < 1-tolerance and 'faster' or 'same'
+        comparisons.append(dict(case=rec['case'], size=rec['size'], baseline=old['median'],
+            median=rec['median'], ratio=ratio, status=status))
+    return comparisons
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]', description=__doc__.split('\n\n')[0])
+    parser.add_option('--sizes', default='1000,10000', help='sizes of archives, separated by commas [%default]')
+    parser.add_option('--runs', type='int', default=5, help='runs of each case [%default]')
+    parser.add_option('--latency', type='float', default=0.02, help='seconds taken by each call to the blog [%default]')
+    parser.add_option('--cases', default=','.join([name for name, factory in CASES]), help='cases to run [%default]')
+    parser.add_option('--workdir', default=os.path.join(tempfile.gettempdir(), 'ultrablog-bench'),
+        help='where archives are kept [%default]')
+    parser.add_option('--output', help='write the results to this file instead of stdout')
+    parser.add_option('--baseline', help='compare the results with the ones in this file')
+    parser.add_option('--tolerance', type='float', default=0.25,
+        help='how much slower than the baseline a case may be [%default]')
+    opts, args = parser.parse_args()
+
+    sizes = [int(size) for size in opts.sizes.split(',')]
+    names = opts.cases.split(',')
+    unknown = [name for name in names if name not in dict(CASES)]
+    if unknown: parser.error('unknown cases: %s' % ', '.join(unknown))
+    if not os.path.isdir(opts.workdir): os.makedirs(opts.workdir)
+
+    blog = UBFakeBlog(opts.latency).start()
+    results = []
+    try:
+        for size in sizes:
+            archive = os.path.join(opts.workdir, 'archive-%d-v%d.db' % (size, ARCHIVE_VERSION))
+            if not os.path.exists(archive):
+                sys.stderr.write('Generating %d posts in %s\n' % (size, archive))
+                make_archive(archive+'.tmp', size, blog)
+                os.rename(archive+'.tmp', archive)
+            scratch = os.path.join(opts.workdir, 'scratch.db')
+            close_plugin()
+            # A write-ahead log left by the last size belongs to another database
+            for path in [scratch+'-wal', scratch+'-shm']:
+                if os.path.exists(path): os.remove(path)
+            shutil.copyfile(archive, scratch)
+            blog.posts.clear()
+            blog.seed(sent_items(scratch))
+            setup_plugin(scratch, blog)
+
+            for name, factory in CASES:
+                if name not in names: continue
+                rec = measure(name, factory, size, opts.runs, blog)
+                sys.stderr.write('%-20s%8d%12.2f ms\n' % (name, size, rec['median']*1000))
+                results.append(rec)
+    finally:
+        close_plugin()
+        blog.stop()
+
+    report = dict(meta=dict(python=platform.python_version(), sqlite=sqlite3.sqlite_version,
+        sqlalchemy=db.sqlalchemy.__version__, platform=platform.platform(), runs=opts.runs,
+        latency=opts.latency, fts=db.fts, unhandled=sorted(set(vim.unhandled))), results=results)
+    isSlower = False
+    if opts.baseline:
+        fp = open(opts.baseline)
+        report['comparisons'] = compare(results, json.load(fp), opts.tolerance)
+        fp.close()
+        for cmp in report['comparisons']:
+            sys.stderr.write('%-20s%8d%8.2fx  %s\n' % (cmp['case'], cmp['size'], cmp['ratio'], cmp['status']))
+        isSlower = len([cmp for cmp in report['comparisons'] if cmp['status']=='slower'])>0
+
+    output = json.dumps(report, indent=1, sort_keys=True)
+    if opts.output:
+        fp = open(opts.output, 'w')
+        fp.write(output+'\n')
+        fp.close()
+    else:
+        print output
+    return isSlower and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
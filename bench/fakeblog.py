@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+'''A blog on localhost which answers the parts of the metaWeblog and wp APIs
+used by UltraBlog.vim, keeping posts in memory. Every call is delayed by
+latency seconds, to stand for the network and the blog.
+'''
+
+import threading, time, xmlrpclib, SocketServer
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+class UBThreadingXMLRPCServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+class UBRequestHandler(SimpleXMLRPCRequestHandler):
+    # Any path is the endpoint, e.g. /xmlrpc.php
+    rpc_paths = ()
+    protocol_version = 'HTTP/1.1'
+
+class UBFakeBlog:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.posts = {}
+        self.lastId = 0
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.server = UBThreadingXMLRPCServer(('127.0.0.1', 0), UBRequestHandler,
+            logRequests=False, allow_none=True)
+        self.server.register_introspection_functions()
+        self.server.register_multicall_functions()
+        self.server.register_instance(self)
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='UBFakeBlog')
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def seed(self, posts):
+        ''' Fill the blog with (post_id, dict) pairs, e.g. of a synthetic archive
+        '''
+        for postId, post in posts:
+            self.posts[postId] = post
+            self.lastId = max(self.lastId, postId)
+
+    def _dispatch(self, method, params):
+        func = getattr(self, method.replace('.', '_'), None)
+        if func is None: raise xmlrpclib.Fault(-32601, 'Unknown method %s' % method)
+        time.sleep(self.latency)
+        self.lock.acquire()
+        try:
+            self.calls += 1
+            return func(*params)
+        finally:
+            self.lock.release()
+
+    def __newId(self):
+        self.lastId += 1
+        return self.lastId
+
+    def __get(self, postId):
+        post = self.posts.get(int(postId))
+        if post is None: raise xmlrpclib.Fault(404, 'Invalid post ID.')
+        return post
+
+    def metaWeblog_newPost(self, blogId, login, password, struct, publish):
+        postId = self.__newId()
+        self.posts[postId] = dict(struct, postid=str(postId), dateCreated=xmlrpclib.DateTime(time.time()))
+        return str(postId)
+
+    def metaWeblog_editPost(self, postId, login, password, struct, publish):
+        self.__get(postId).update(struct)
+        return True
+
+    def metaWeblog_getPost(self, postId, login, password):
+        return self.__get(postId)
+
+    def metaWeblog_getRecentPosts(self, blogId, login, password, count):
+        ids = sorted([id for id, post in self.posts.items() if post.get('post_type', 'post')=='post'], reverse=True)
+        return [self.posts[id] for id in ids[:int(count)]]
+
+    def metaWeblog_getCategories(self, blogId, login, password):
+        return [dict(description=name, categoryName=name) for name in ['Vim', 'Python', 'Blogging']]
+
+    def metaWeblog_newMediaObject(self, blogId, login, password, struct):
+        name = struct['name']
+        return dict(file=name, url='http://127.0.0.1/media/%s' % name, type=struct.get('type'))
+
+    def blogger_deletePost(self, appKey, postId, login, password, publish):
+        self.posts.pop(int(postId), None)
+        return True
+
+    def wp_getPages(self, blogId, login, password):
+        return [dict(post, page_id=post['postid'], page_status=post.get('post_status', 'publish'))
+            for post in self.posts.values() if post.get('post_type')=='page']
+
+    def wp_getPage(self, blogId, pageId, login, password):
+        return self.__get(pageId)
+
+    def wp_getPosts(self, blogId, login, password, flt=None, fields=None):
+        flt = flt or {}
+        posts = [post for post in self.posts.values() if post.get('post_type', 'post')==flt.get('post_type', 'post')]
+        # Items which were seeded without a date are as old as their ids
+        posts.sort(key=lambda post: (str(post.get('post_modified_gmt', '')), int(post['postid'])), reverse=True)
+        offset = int(flt.get('offset', 0))
+        return [dict(post_id=post['postid'], post_title=post.get('title', ''), post_content=post.get('description', ''),
+            post_status=post.get('post_status', 'publish'), post_name=post.get('wp_slug', ''),
+            post_modified_gmt=post.get('post_modified_gmt', '%020d' % int(post['postid'])), terms=[])
+            for post in posts[offset:offset+int(flt.get('number', 10))]]
+
+    def wp_getTags(self, blogId, login, password):
+        return [dict(name=name) for name in ['vim', 'python', 'benchmark']]
+
+if __name__ == '__main__':
+    pass
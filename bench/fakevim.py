@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+
+'''A scriptable stand-in for the vim module of Vim, which knows just enough
+of buffers, variables, options and Ex commands to drive ultrablog.commands
+outside of Vim. Anything it does not understand is recorded in unhandled
+instead of failing, so that a benchmark can tell when it is off the map.
+
+Install it before importing ultrablog:
+
+    import fakevim
+    fakevim.install(ub_blog=dict(...))
+'''
+
+import sys, os, re, types
+
+class error(Exception): pass
+
+class Buffer(object):
+    def __init__(self, number):
+        self.number = number
+        self.name = None
+        self.lines = ['']
+        self.vars = {}
+        self.options = dict(modified='0', modifiable='1', syntax='', filetype='')
+        self.changedtick = 1
+
+    def __changed(self):
+        self.changedtick += 1
+        self.options['modified'] = '1'
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __iter__(self):
+        return iter(list(self.lines))
+
+    def __getitem__(self, idx):
+        return self.lines[idx]
+
+    def __setitem__(self, idx, val):
+        self.lines[idx] = val
+        self.__changed()
+
+    def __delitem__(self, idx):
+        del self.lines[idx]
+        # A buffer of Vim always has a line
+        if len(self.lines)==0: self.lines.append('')
+        self.__changed()
+
+    def __getslice__(self, i, j):
+        return self.lines[max(i, 0):max(j, 0)]
+
+    def __setslice__(self, i, j, vals):
+        self.lines[max(i, 0):max(j, 0)] = vals
+        if len(self.lines)==0: self.lines.append('')
+        self.__changed()
+
+    def __delslice__(self, i, j):
+        self.__setslice__(i, j, [])
+
+    def append(self, lines, nr=None):
+        if type(lines) in types.StringTypes: lines = [lines]
+        if nr is None: nr = len(self.lines)
+        self.lines[nr:nr] = list(lines)
+        self.__changed()
+
+class Window(object):
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.cursor = (1, 0)
+
+class Current(object):
+    def __init__(self, vim):
+        self.vim = vim
+
+    @property
+    def buffer(self):
+        return self.vim.window.buffer
+
+    @property
+    def window(self):
+        return self.vim.window
+
+    @property
+    def line(self):
+        return self.vim.window.buffer[self.vim.window.cursor[0]-1]
+
+class Buffers(object):
+    def __init__(self, vim):
+        self.vim = vim
+
+    def __iter__(self):
+        return iter(sorted(self.vim.bufs.values(), key=lambda buf: buf.number))
+
+    def __len__(self):
+        return len(self.vim.bufs)
+
+    def __getitem__(self, idx):
+        return list(self)[idx]
+
+class FakeVim(types.ModuleType):
+    ''' The module itself, state is kept in attributes so that it can be reset
+    '''
+    error = error
+
+    def __init__(self):
+        types.ModuleType.__init__(self, 'vim')
+        self.current = Current(self)
+        self.buffers = Buffers(self)
+        self.reset()
+
+    def reset(self, **variables):
+        ''' Start over with one empty buffer and the given global variables
+        '''
+        self.bufs = {}
+        self.lastnr = 0
+        self.window = Window(self.__newBuffer())
+        self.vars = dict(variables)
+        self.options = dict(encoding='utf-8')
+        self.features = dict(timers='0')
+        self.confirmations = []
+        self.messages = []
+        self.errors = []
+        self.unhandled = []
+        self.onBufDelete = []
+
+    def __newBuffer(self):
+        self.lastnr += 1
+        buf = Buffer(self.lastnr)
+        self.bufs[buf.number] = buf
+        return buf
+
+    def __findVar(self, name):
+        ''' Return the dict holding the variable and its bare name
+        '''
+        if name.startswith('b:'): return self.window.buffer.vars, name[2:]
+        if name.startswith('g:'): return self.vars, name[2:]
+        return self.vars, name
+
+    # Evaluation of expressions
+
+    def eval(self, expr):
+        expr = expr.strip()
+        for pattern, handler in self.evaluators:
+            m = re.match(pattern+'$', expr, re.S)
+            if m is not None: return handler(self, *m.groups())
+        self.unhandled.append('eval: '+expr)
+        return ''
+
+    def _option(self, name):
+        if name in self.window.buffer.options: return self.window.buffer.options[name]
+        return self.options.get(name, '')
+
+    def _exists(self, name):
+        if name.startswith('&'): return '1'
+        vars, name = self.__findVar(name)
+        return vars.has_key(name) and '1' or '0'
+
+    def _debug(self, name):
+        return self.vars.get(name) in [1, '1'] and '1' or '0'
+
+    def _var(self, name):
+        vars, name = self.__findVar(name)
+        return self.__toVim(vars[name])
+
+    def _bufnr(self, expr):
+        expr = expr.strip("'\"")
+        if expr == '%': return str(self.window.buffer.number)
+        if expr.isdigit() and int(expr) in self.bufs: return expr
+        return '-1'
+
+    def _getbufvar(self, nr, name):
+        buf = self.bufs.get(int(nr))
+        if buf is None: return ''
+        if name == 'changedtick': return str(buf.changedtick)
+        if name.startswith('&'): return buf.options.get(name[1:], '')
+        return self.__toVim(buf.vars.get(name, ''))
+
+    def _expand(self, expr):
+        return os.path.expanduser(expr)
+
+    def _has(self, feature):
+        return self.features.get(feature, '0')
+
+    def _confirm(self, msg):
+        return len(self.confirmations)>0 and str(self.confirmations.pop(0)) or '1'
+
+    def __toVim(self, val):
+        ''' Values come from vim.eval() as strings, lists and dicts of them
+        '''
+        if type(val) in (types.IntType, types.LongType): return str(val)
+        if type(val) is types.ListType: return [self.__toVim(v) for v in val]
+        if type(val) is types.DictType: return dict([(k, self.__toVim(v)) for k, v in val.items()])
+        return val
+
+    evaluators = [
+        (r'&(\w+)', _option),
+        (r'exists\([\'"]([&\w:]+)[\'"]\)', _exists),
+        (r'exists\(\'g:(\w+)\'\) && g:\1', _debug),
+        (r'bufnr\(([^)]*)\)', _bufnr),
+        (r'getbufvar\((\d+), \'([&\w]+)\'\)', _getbufvar),
+        (r'expand\(\'(.*)\'\)', _expand),
+        (r'has\(\'(\w+)\'\)', _has),
+        (r'confirm\(\'(.*)\', .*\)', _confirm),
+        (r'([gb]:\w+|\w+)', _var),
+    ]
+
+    # Ex commands
+
+    def command(self, cmd):
+        cmd = cmd.strip().lstrip(':')
+        for pattern, handler in self.commands:
+            m = re.match(pattern, cmd)
+            if m is not None:
+                handler(self, *m.groups())
+                return
+        self.unhandled.append('command: '+cmd)
+
+    def _let(self, name, expr):
+        vars, name = self.__findVar(name)
+        vars[name] = self.__parse(expr.strip())
+
+    def _unlet(self, name):
+        vars, name = self.__findVar(name)
+        vars.pop(name, None)
+
+    def _setl(self, args):
+        opts = self.window.buffer.options
+        for arg in args.split():
+            if '=' in arg:
+                name, val = arg.split('=', 1)
+                opts[name] = val
+                if name in ['filetype', 'ft', 'syntax']: opts['syntax'] = opts['filetype'] = val
+            elif arg.startswith('no'):
+                opts[arg[2:]] = '0'
+            else:
+                opts[arg] = '1'
+
+    def _setbufvar(self, nr, name, expr):
+        buf = self.bufs.get(int(nr))
+        if buf is None: return
+        val = self.__parse(expr.strip())
+        if name.startswith('&'): buf.options[name[1:]] = str(val)
+        else: buf.vars[name] = val
+
+    def _new(self):
+        self.window = Window(self.__newBuffer())
+
+    def _delete(self, nr):
+        nr = nr.strip() and int(nr) or self.window.buffer.number
+        if nr not in self.bufs: return
+        for callback in self.onBufDelete: callback(nr)
+        del self.bufs[nr]
+        if self.window.buffer.number == nr:
+            if len(self.bufs)==0: self.__newBuffer()
+            self.window = Window(self.bufs[max(self.bufs.keys())])
+
+    def _echo(self, kind, msg):
+        if kind == 'echoerr': self.errors.append(msg)
+        else: self.messages.append(msg)
+
+    def _echoErrorMsg(self, msg):
+        self.errors.append(msg)
+
+    def _ignore(self, *args):
+        pass
+
+    def __parse(self, expr):
+        if re.match(r'-?\d+$', expr): return int(expr)
+        if expr.startswith("'") and expr.endswith("'"): return expr[1:-1].replace("''", "'")
+        if expr.startswith('"') and expr.endswith('"'): return expr[1:-1]
+        if expr.startswith('[') and expr.endswith(']'):
+            return [self.__parse(item) for item in re.findall(r"'(?:[^']|'')*'|[^,\s]+", expr[1:-1])]
+        return expr
+
+    commands = [
+        (r'let ([gb]:\w+|@/|s:\w+|\w+)\s*=(.*)$', _let),
+        (r'unlet (\S+)', _unlet),
+        (r'setl(?:ocal)? (.*)$', _setl),
+        (r'set (.*)$', _setl),
+        (r'call setbufvar\((\d+), \'([&\w]+)\', (.*)\)$', _setbufvar),
+        (r'(?:new|tabnew|enew|vnew)$', _new),
+        (r'b[dw](?:elete|ipeout)?!?\s*(\d*)$', _delete),
+        (r'echohl ErrorMsg \| echomsg (.*) \| echohl None$', _echoErrorMsg),
+        (r'(echo|echomsg|echoerr) (.*)$', _echo),
+        (r'call UB\w+\(.*\)$', _ignore),
+        (r'(?:map|vmap|nmap|imap|mapclear|command!|augroup|autocmd!?|nohl|redraw|redrawstatus!?|exe|normal|syntax|hi)(?:\s|$)', _ignore),
+    ]
+
+def install(**variables):
+    ''' Put a fake vim module in place of the real one, and return it
+    '''
+    vim = FakeVim()
+    vim.reset(**variables)
+    sys.modules['vim'] = vim
+    return vim
+
+if __name__ == '__main__':
+    pass
@@ -19,6 +19,10 @@ function! StatusCmpl(ArgLead, CmdLine, CursorPos)"{{{
   return "draft\npublish\nprivate\npending\n"
 endfunction"}}}
 
+function! ItemTypeCmpl(ArgLead, CmdLine, CursorPos)"{{{
+  return "post\npage\n"
+endfunction"}}}
+
 function! ScopeCmpl(ArgLead, CmdLine, CursorPos)"{{{
   return "local\nremote\n"
 endfunction"}}}
@@ -184,39 +188,89 @@ endfunction"}}}
 
 function! Completable(findstart, base)"{{{
     let line = getline('.')
-    if line !~ '^\$categories:\s*'
+    if line !~ '^\$\(categories\|tags\):\s*'
         return -1
     endif
     if a:findstart
-        " locate the start of the word
+        " locate the start of the term, which may contain spaces
         let line = getline('.')
         let start = col('.') - 1
-        while start > 0 && line[start - 1] =~ '\a'
+        while start > 0 && line[start - 1] !~ '[,:]'
             let start -= 1
         endwhile
+        while start < col('.') - 1 && line[start] == ' '
+            let start += 1
+        endwhile
         return start
     else
         " find matching items
 python <<EOF
-if len(cfg.categories) == 0:
-    try:
-        cats = api.metaWeblog.getCategories('', cfg.loginName, cfg.password)
-        cfg.categories = '|'.join([cat['description'].encode(self.enc) for cat in cats])
-    except Exception, e:
-        vim.command("echoerr '%s'" % e)
-vim.command("let s:categories='%s'" % cfg.categories)
+try:
+    # Terms are served from memory, they may be refreshed in the background
+    __ub_taxonomy = vim.eval("getline('.')").startswith('$tags:') and 'tag' or 'category'
+    __ub_terms = ub_complete_terms(__ub_taxonomy, vim.eval('a:base'))
+    vim.command("let s:terms=[%s]" % ','.join(["'%s'" % term.replace("'", "''") for term in __ub_terms]))
+except Exception, e:
+    vim.command("let s:terms=[]")
+    vim.command("echoerr '%s'" % str(e).replace("'", "''"))
 EOF
-        let res = []
-        for m in split(s:categories,"|")
-            if m =~ '^' . a:base
-                call add(res, m)
-            endif
-        endfor
-        return res
+        return s:terms
       endif
 endfun"}}}
 set completefunc=Completable
 
+" Background calls to the blog
+function! UBAsyncPoll(timer)"{{{
+    py ub_async_poll()
+endfunction"}}}
+
+function! UBStartAsyncPoller()"{{{
+    if !exists('s:ub_async_timer')
+        let s:ub_async_timer = timer_start(100, 'UBAsyncPoll', {'repeat': -1})
+    endif
+endfunction"}}}
+
+function! UBStopAsyncPoller()"{{{
+    if exists('s:ub_async_timer')
+        call timer_stop(s:ub_async_timer)
+        unlet s:ub_async_timer
+    endif
+endfunction"}}}
+
+" Show the state of background calls, e.g. set statusline+=%{UBAsyncStatus()}
+function! UBAsyncStatus()"{{{
+    return exists('g:ub_async_status') ? g:ub_async_status : ''
+endfunction"}}}
+
+" Live preview, render the buffer again after it has not changed for a while
+function! UBSchedulePreviewUpdate(delay)"{{{
+    if !has('timers')
+        call UBUpdatePreviewIfChanged()
+        return
+    endif
+    if exists('s:ub_preview_timer')
+        call timer_stop(s:ub_preview_timer)
+    endif
+    let s:ub_preview_bufnr = bufnr('%')
+    let s:ub_preview_timer = timer_start(a:delay, 'UBUpdatePreview')
+endfunction"}}}
+
+" Without timers, render the buffer again when the user is idle, if it has changed
+function! UBUpdatePreviewIfChanged()"{{{
+    if b:changedtick != get(b:, 'ub_preview_tick', -1)
+        let b:ub_preview_tick = b:changedtick
+        py ub_update_preview()
+    endif
+endfunction"}}}
+
+function! UBUpdatePreview(timer)"{{{
+    unlet s:ub_preview_timer
+    " Skip if the user has left the buffer, it is rendered on next change
+    if bufnr('%') == s:ub_preview_bufnr
+        py ub_update_preview()
+    endif
+endfunction"}}}
+
 " Commands
 command! -nargs=* -complete=customlist,UBListCmpl UBList exec('py ub_list_items(<f-args>)')
 command! -nargs=* -complete=customlist,UBNewCmpl UBNew exec('py ub_new_item(<f-args>)')
@@ -225,24 +279,37 @@ command! -nargs=* -complete=customlist,UBDelCmpl UBDel exec('py ub_del_item(<f-a
 command! -nargs=* -complete=customlist,UBThisCmpl UBThis exec('py ub_blog_this(<f-args>)')
 command! -nargs=+ UBFind exec('py ub_search(0, 1, <f-args>)')
 command! -nargs=+ UBRegexSearch exec('py ub_search(1, 1, <f-args>)')
-command! -nargs=+ UBReplace exec('py ub_replace(0, <f-args>)')
-command! -nargs=+ UBRegexReplace exec('py ub_replace(1, <f-args>)')
+command! -bang -nargs=+ UBReplace exec('py ub_replace(0, "<bang>"=="!", <f-args>)')
+command! -bang -nargs=+ UBRegexReplace exec('py ub_replace(1, "<bang>"=="!", <f-args>)')
+command! -bang -nargs=? -complete=custom,ItemTypeCmpl UBSync exec('py ub_sync("<bang>"=="!", <f-args>)')
 command! -nargs=0 UBEnableDebug exec('py ub_debug(1)')
 command! -nargs=0 UBDisableDebug exec('py ub_debug(0)')
 command! -nargs=0 UBToggleDebug exec('py ub_debug(2)')
+command! -nargs=0 UBStartupProfile exec('py ub_startup_profile()')
+command! -bang -nargs=? UBProfile exec('py ub_profile("<bang>"=="!", <f-args>)')
+command! -bang -nargs=0 UBCacheStats exec('py ub_render_cache_stats("<bang>"=="!")')
+command! -bang -nargs=* UBMedia exec('py ub_media("<bang>"=="!", <f-args>)')
 
 " Auto-commands
 autocmd BufEnter * py __ub_on_buffer_enter()
+autocmd BufDelete,BufWipeout * py ub_forget_buffer(int(vim.eval('expand("<abuf>")')))
+autocmd VimLeave * py UBConverterPool.shutdown()
+autocmd VimLeave * py UBPreviewServer.stop()
+autocmd VimLeave * py UBViewerClient.stop()
+autocmd VimLeave * py ub_close_db()
 
 python <<EOF
 # -*- coding: utf-8 -*-
 import vim,os
 
+import time
+__ub_import_start = time.time()
 for pth in vim.eval('&rtp').split(','): sys.path.append(os.path.join(pth, 'plugin'))
 from ultrablog.exceptions import *
 from ultrablog.events import *
 from ultrablog.commands import *
 from ultrablog.listeners import UBEventQueue
+ub_record_startup_stage('import', time.time()-__ub_import_start)
 
 def __ub_on_buffer_enter():
     ''' Triggered by BufEnter event, check if the buffer is outdated
@@ -250,4 +317,5 @@ def __ub_on_buffer_enter():
     if ub_is_view_outdated('%'):
         ub_refresh_current_view()
         ub_set_view_outdated('%', False)
+    ub_open_deferred_view()
 EOF
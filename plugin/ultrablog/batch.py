@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+import xmlrpclib, socket
+
+class UBBatch:
+    ''' Group calls to the blog API into system.multicall requests,
+    or make them one by one if the server does not support multicall.
+    Errors, i.e. faults, HTTP errors and network errors, are mapped to the
+    calls which raised them instead of aborting the whole batch, an error of
+    a multicall request is mapped to every call in it.
+    '''
+    # Whether each endpoint supports system.multicall, keyed by its URL
+    multicall = {}
+    errors = (xmlrpclib.Fault, xmlrpclib.ProtocolError, socket.error)
+
+    def __init__(self, api, endpoint, size=20):
+        self.api = api
+        self.endpoint = endpoint
+        self.size = size
+        self.calls = []
+
+    def add(self, method, *params):
+        self.calls.append((method, params))
+
+    def run(self):
+        ''' Make the calls and return a list of (result, error) pairs,
+        in the order the calls were added
+        '''
+        if not self.isMulticallSupported():
+            return [self.__call(method, params) for method, params in self.calls]
+
+        results = []
+        for i in range(0, len(self.calls), self.size):
+            chunk = self.calls[i:i+self.size]
+            try:
+                rslts = self.api.system.multicall([dict(methodName=method, params=list(params)) for method, params in chunk])
+            except self.errors, e:
+                results.extend([(None, e)]*len(chunk))
+                continue
+            for rslt in rslts:
+                if type(rslt) is dict:
+                    results.append((None, xmlrpclib.Fault(rslt['faultCode'], rslt['faultString'])))
+                else:
+                    results.append((rslt[0], None))
+        return results
+
+    def isMulticallSupported(self):
+        ''' Check if the server advertises system.multicall, the answer is cached
+        for the endpoint. Servers which forbid introspection answer with a fault
+        or an HTTP error, then calls are made one by one. A network error is
+        not an answer, the server is asked again next time.
+        '''
+        if not UBBatch.multicall.has_key(self.endpoint):
+            try:
+                UBBatch.multicall[self.endpoint] = 'system.multicall' in self.api.system.listMethods()
+            except (xmlrpclib.Fault, xmlrpclib.ProtocolError):
+                UBBatch.multicall[self.endpoint] = False
+            except socket.error:
+                return False
+        return UBBatch.multicall[self.endpoint]
+
+    def __call(self, method, params):
+        func = self.api
+        for name in method.split('.'):
+            func = getattr(func, name)
+        try:
+            return (func(*params), None)
+        except self.errors, e:
+            return (None, e)
+
+if __name__ == '__main__':
+    pass
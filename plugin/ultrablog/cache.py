@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+import hashlib, threading, time
+from collections import OrderedDict
+
+class UBRenderCache:
+    ''' Results of syntax conversions, keyed by a hash of the content, the
+    syntaxes, the encoding and the identity of the converter, so that an
+    entry never has to be invalidated, it simply stops being asked for.
+    Entries are kept in an in-memory LRU, and optionally in the table
+    render_cache of the database, which is bounded by disk_size bytes.
+    '''
+    size = 32
+    disk_size = 0
+    engine = None
+    entries = OrderedDict()
+    lock = threading.Lock()
+    stats = dict(memory_hits=0, disk_hits=0, misses=0, bytes_saved=0)
+
+    @classmethod
+    def key(cls, content, from_syntax, to_syntax, encoding, converter):
+        h = hashlib.sha1()
+        for part in (from_syntax, to_syntax, encoding, converter):
+            h.update('%s\0' % part)
+        # hashlib only takes bytes, unicode would be encoded as ASCII
+        if isinstance(content, unicode): content = content.encode(encoding or 'utf-8')
+        h.update(content)
+        return h.hexdigest()
+
+    @classmethod
+    def get(cls, key):
+        cls.lock.acquire()
+        try:
+            value = cls.entries.pop(key, None)
+            if value is not None:
+                cls.entries[key] = value
+                cls.__hit('memory_hits', value)
+                return value
+        finally:
+            cls.lock.release()
+
+        value = cls.__getFromDisk(key)
+        if value is not None:
+            cls.lock.acquire()
+            try:
+                cls.__remember(key, value)
+                cls.__hit('disk_hits', value)
+            finally:
+                cls.lock.release()
+            return value
+
+        cls.lock.acquire()
+        try:
+            cls.stats['misses'] += 1
+        finally:
+            cls.lock.release()
+        return None
+
+    @classmethod
+    def put(cls, key, value):
+        cls.lock.acquire()
+        try:
+            cls.__remember(key, value)
+        finally:
+            cls.lock.release()
+        cls.__putToDisk(key, value)
+
+    @classmethod
+    def clear(cls):
+        cls.lock.acquire()
+        try:
+            cls.entries.clear()
+        finally:
+            cls.lock.release()
+        if cls.engine is not None:
+            cls.engine.execute("delete from render_cache")
+
+    @classmethod
+    def report(cls):
+        ''' Return a list of lines describing how well the cache works
+        '''
+        hits = cls.stats['memory_hits'] + cls.stats['disk_hits']
+        total = hits + cls.stats['misses']
+        lines = []
+        lines.append('Lookups:      %d' % total)
+        lines.append('Hit rate:     %.1f%%' % (total and hits*100.0/total or 0))
+        lines.append('Memory hits:  %d' % cls.stats['memory_hits'])
+        lines.append('Disk hits:    %d' % cls.stats['disk_hits'])
+        lines.append('Bytes saved:  %d' % cls.stats['bytes_saved'])
+        lines.append('Entries:      %d/%d' % (len(cls.entries), cls.size))
+        if cls.engine is not None:
+            rslt = cls.engine.execute("select count(*), coalesce(sum(size),0) from render_cache").fetchone()
+            lines.append('On disk:      %d entries, %d/%d bytes' % (rslt[0], rslt[1], cls.disk_size))
+        return lines
+
+    @classmethod
+    def __hit(cls, counter, value):
+        cls.stats[counter] += 1
+        cls.stats['bytes_saved'] += len(value)
+
+    @classmethod
+    def __remember(cls, key, value):
+        cls.entries.pop(key, None)
+        cls.entries[key] = value
+        while len(cls.entries) > cls.size:
+            cls.entries.popitem(last=False)
+
+    @classmethod
+    def __getFromDisk(cls, key):
+        if cls.engine is None: return None
+        conn = cls.engine.connect()
+        try:
+            row = conn.execute("select value from render_cache where key=?", key).fetchone()
+            if row is None: return None
+            conn.execute("update render_cache set accessed=? where key=?", time.time(), key)
+            return str(row[0])
+        finally:
+            conn.close()
+
+    @classmethod
+    def __putToDisk(cls, key, value):
+        if cls.engine is None or len(value) > cls.disk_size: return
+        conn = cls.engine.connect()
+        try:
+            conn.execute("insert or replace into render_cache (key,value,size,accessed) values (?,?,?,?)",
+                key, buffer(value), len(value), time.time())
+            total = conn.execute("select sum(size) from render_cache").scalar()
+            if total > cls.disk_size:
+                # Evict the least recently used entries down to 3/4 of the limit,
+                # so that eviction does not happen on every put
+                evicted = []
+                for row in conn.execute("select key, size from render_cache order by accessed").fetchall():
+                    if total <= cls.disk_size*3/4: break
+                    evicted.append(row[0])
+                    total -= row[1]
+                for k in evicted:
+                    conn.execute("delete from render_cache where key=?", k)
+        finally:
+            conn.close()
+
+if __name__ == '__main__':
+    pass
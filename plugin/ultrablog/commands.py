@@ -1,22 +1,25 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8 -*-
 
-import vim, xmlrpclib, re, tempfile, os, mimetypes, inspect, gettext
+import vim, xmlrpclib, re, os, mimetypes, inspect, gettext, glob, json, time
 gettext.install('ultrablog', os.path.join(os.path.dirname(__file__), os.path.pardir, 'locale'))
 
 from exceptions import *
+import db
 from db import *
 from util import *
 from events import *
 from eventqueue import UBEventQueue
+from worker import UBJob, UBWorker
+from batch import UBBatch
+from cache import UBRenderCache
+from preview import UBPreviewServer, UBViewerClient
+from registry import UBViewRegistry
+from media import UBMediaUploader
+from terms import UBTermIndex
+from profiler import UBProfiler
 
 import webbrowser
-ubviewer = None
-if not is_in_console() and ub_get_option('ub_use_ubviewer') is True:
-    """Do not import ultrablog.viewer if is in console or the option ub_use_ubviewer has been set to 0"""
-    try:
-        import ultrablog.viewer as ubviewer
-    except ImportError: pass
 
 def __ub_exception_handler(func):
     def __check(*args,**kwargs):
@@ -24,19 +27,8 @@ def __ub_exception_handler(func):
         if dbg_enabled is True: return func(*args,**kwargs)
         try:
             return func(*args,**kwargs)
-        except UBException, e:
-            ub_echoerr(e.message)
-        except xmlrpclib.Fault, e:
-            msg = "xmlrpc error: %s" % e.faultString
-            ub_echoerr(msg)
-        except xmlrpclib.ProtocolError, e:
-            msg = "xmlrpc error: %s %s" % (e.url, e.errmsg)
-            ub_echoerr(msg)
-        except IOError, e:
-            msg = "network error: %s" % str(e)
-            ub_echoerr(msg)
         except Exception, e:
-            ub_echoerr(str(e))
+            ub_echoerr(ub_get_error_message(e))
     return __check
 
 def __ub_enc_check(func):
@@ -55,6 +47,121 @@ def __ub_enc_check(func):
         return func(*args, **kw)
     return __check
 
+def ub_call_api(label, method, args, callback, errback=None):
+    '''Call a method of the blog API and pass the result to callback,
+    the call is made in the background if the option ub_async is enabled and
+    Vim supports timers, in which case callback is invoked later by ub_async_poll()
+    '''
+    if ub_is_async():
+        UBWorker.submit(UBJob(label, method, args, callback, errback), ub_new_api)
+        vim.command('call UBStartAsyncPoller()')
+        ub_update_async_status()
+    else:
+        callback(UBJob(label, method, args).run(db.api))
+
+def ub_is_async():
+    '''Check if calls to the blog are made in the background
+    '''
+    return ub_get_option('ub_async') is True and vim.eval("has('timers')")=='1'
+
+@__ub_exception_handler
+def ub_async_poll():
+    '''Deliver the results of background calls through the event queue,
+    invoked by a timer on the main thread
+    '''
+    for job in UBWorker.poll():
+        UBEventQueue.fireEvent(UBAsyncDoneEvent(job))
+    if not UBWorker.isPending():
+        vim.command('call UBStopAsyncPoller()')
+    ub_update_async_status()
+    UBEventQueue.processEvents()
+
+def ub_update_async_status():
+    '''Show the state of background calls in g:ub_async_status
+    '''
+    if len(UBWorker.pending)>0:
+        status = _('UB: %s (%d pending)') % (UBWorker.pending[0].label, len(UBWorker.pending))
+    else:
+        status = _('UB: done')
+    vim.command("let g:ub_async_status='%s'" % status.replace("'", "''"))
+    vim.command('redrawstatus!')
+
+def ub_complete_terms(taxonomy, prefix):
+    '''Return categories or tags starting with prefix for completion.
+    They are served from memory and refreshed from the blog in the background
+    when older than ub_completion_ttl, so that completion never waits for it.
+    '''
+    def __keep_terms(e):
+        '''Keep the terms as they are, try again when they expire next time
+        '''
+        UBTermIndex.fetched = time.time()
+
+    ub_bootstrap()
+    if db.cfg is None: return []
+    if not ub_is_async() and UBWorker.isPending(ub_fetch_terms):
+        # Without timers, the refresh started by an earlier completion is delivered here
+        ub_async_poll()
+    if not UBTermIndex.isLoaded(): ub_load_terms()
+
+    if UBTermIndex.isStale(time.time(), ub_get_option('ub_completion_ttl')) \
+            and not UBWorker.isPending(ub_fetch_terms):
+        # Categories set in ub_blog are not fetched
+        UBWorker.submit(UBJob(_('Fetching categories and tags'), ub_fetch_terms,
+            (db.cfg.loginName, db.cfg.password, len(db.cfg.categories)==0), ub_store_terms, __keep_terms), ub_new_api)
+        if ub_is_async():
+            vim.command('call UBStartAsyncPoller()')
+            ub_update_async_status()
+
+    enc = vim.eval('&encoding')
+    return [term.encode(enc) for term in UBTermIndex.complete(taxonomy, prefix.decode(enc))]
+
+def ub_fetch_terms(api, loginName, password, withCategories=True):
+    '''Fetch categories and tags from the blog, either of which is None if not
+    fetched, run by UBWorker
+    '''
+    cats = None
+    if withCategories:
+        cats = [cat['description'] for cat in api.metaWeblog.getCategories('', loginName, password)]
+    try:
+        tags = [tag['name'] for tag in api.wp.getTags('', loginName, password)]
+    except xmlrpclib.Fault:
+        # Not a WordPress blog
+        tags = None
+    return cats, tags
+
+def ub_store_terms(result):
+    '''Replace the stored categories and tags of the current blog with the
+    fetched ones, then reload them for completion
+    '''
+    now = time.time()
+    sess = Session()
+    for taxonomy, names in zip(['category', 'tag'], result):
+        if names is None: continue
+        sess.query(Term).filter(Term.blog==db.cfg.xmlrpc).filter(Term.taxonomy==taxonomy).delete(synchronize_session=False)
+        for name in set([isinstance(name, unicode) and name or name.decode('utf-8') for name in names]):
+            sess.add(Term(blog=db.cfg.xmlrpc, taxonomy=taxonomy, name=name, fetched=now))
+    sess.commit()
+    sess.close()
+    ub_load_terms(now)
+
+def ub_load_terms(fetched=None):
+    '''Load categories and tags of the current blog for completion, including
+    the ones set in ub_blog and tags used in local posts
+    '''
+    sess = Session()
+    terms = sess.query(Term.taxonomy, Term.name, Term.fetched).filter(Term.blog==db.cfg.xmlrpc).all()
+    post_tags = sess.query(Post.tags).filter(Post.tags!=None).filter(Post.tags!='').all()
+    sess.close()
+
+    enc = vim.eval('&encoding')
+    cats = [term.name for term in terms if term.taxonomy=='category']
+    cats.extend(db.cfg.categories.decode(enc).split('|'))
+    tags = [term.name for term in terms if term.taxonomy=='tag']
+    for row in post_tags: tags.extend(row.tags.split(','))
+    UBTermIndex.load('category', cats)
+    UBTermIndex.load('tag', tags)
+    UBTermIndex.fetched = fetched or max([term.fetched for term in terms] or [0])
+
 def ub_debug(mode):
     """Set debug mode
     0: Disable debug mode
@@ -66,14 +173,49 @@ def ub_debug(mode):
         dbg_enabled = ub_get_option('ub_debug')
         dbg_status = (dbg_enabled is False) and 1 or 0
     vim.command("let g:ub_debug = %d" % dbg_status)
-    if dbg_status == 1: dbe.echo = True
-    else: dbe.echo = False
+    if db.dbe is not None: db.dbe.echo = dbg_status == 1
+
+def ub_startup_profile():
+    '''Show how long each stage of setting up UltraBlog.vim takes
+    '''
+    if len(db.bootstrap_profile)==0:
+        ub_echo(_('UltraBlog.vim has not been set up yet, it will be on first use.'))
+    elif db.dbe is None:
+        ub_echo(_('UltraBlog.vim could not be set up, these are the stages of the last attempt.'))
+    stages = db.startup_profile+db.bootstrap_profile
+    for stage, seconds in stages:
+        ub_echo("%-16s%8.1f ms" % (stage, seconds*1000))
+    ub_echo("%-16s%8.1f ms" % (_('total'), sum([seconds for stage, seconds in stages])*1000))
 
 @__ub_exception_handler
-def ub_list_items(item_type='post', scope='local', page_size=None, page_no=None):
+def ub_profile(clear=False, count=10):
+    '''Show the phases of recent commands which took the longest, and how long
+    commands take, or forget them
+    '''
+    if clear is True:
+        UBProfiler.clear()
+        ub_echo(_('The profile has been cleared.'))
+        return
+    for line in UBProfiler.report(int(count)):
+        ub_echo(line)
+
+@__ub_exception_handler
+def ub_render_cache_stats(clear=False):
+    '''Show how well the cache of syntax conversions works, or empty it
+    '''
+    ub_bootstrap()
+    if clear is True:
+        UBRenderCache.clear()
+        ub_echo(_('The render cache has been cleared.'))
+        return
+    for line in UBRenderCache.report():
+        ub_echo(line)
+
+@__ub_exception_handler
+def ub_list_items(item_type='post', scope='local', page_size=None, page_no=None, cursor=None):
     ''' List items
     '''
-    cmd = UBCmdList(item_type, scope, page_size, page_no)
+    cmd = UBCmdList(item_type, scope, page_size, page_no, cursor)
     cmd.execute()
 
 @__ub_exception_handler
@@ -84,10 +226,10 @@ def ub_search(is_regexp, page_no, *keywords):
     cmd.execute()
 
 @__ub_exception_handler
-def ub_replace(is_regexp, needle, replacement):
-    ''' List posts/pages which match the keywords given
+def ub_replace(is_regexp, is_dry_run, needle, replacement):
+    ''' Replace the needle in posts/pages, or only list the matched ones
     '''
-    cmd = UBCmdReplace(is_regexp, needle, replacement)
+    cmd = UBCmdReplace(is_regexp, is_dry_run, needle, replacement)
     cmd.execute()
 
 @__ub_exception_handler
@@ -97,6 +239,20 @@ def ub_refresh_current_view():
     cmd = UBCmdRefresh()
     cmd.execute()
 
+def ub_open_deferred_view():
+    ''' Open the view whose result arrived while the user was away from the
+    current buffer, called on every BufEnter, so nothing else is done if none
+    '''
+    func = ub_pop_deferred_view(vim.current.buffer.number)
+    if func is not None: __ub_exception_handler(func)()
+
+@__ub_exception_handler
+def ub_sync(full=False, item_type=None):
+    ''' Synchronize posts/pages from the blog to the database
+    '''
+    cmd = UBCmdSync(full, item_type)
+    cmd.execute()
+
 @__ub_exception_handler
 def ub_preview(tmpl=None):
     '''Preview the current buffer in a browser
@@ -104,6 +260,14 @@ def ub_preview(tmpl=None):
     cmd = UBCmdPreview(tmpl)
     cmd.execute()
 
+@__ub_exception_handler
+def ub_update_preview():
+    '''Render the current buffer again for its live preview
+    '''
+    if vim.eval("exists('b:ub_preview_template')") == '1':
+        cmd = UBCmdPreview(vim.eval('b:ub_preview_template'), True)
+        cmd.execute()
+
 @__ub_exception_handler
 def ub_save_item():
     '''Save the current buffer to local database
@@ -112,10 +276,10 @@ def ub_save_item():
     cmd.execute()
 
 @__ub_exception_handler
-def ub_send_item(status=None):
+def ub_send_item(status=None, callback=None):
     '''Send the current item to the blog
     '''
-    cmd = UBCmdSend(status)
+    cmd = UBCmdSend(status, callback)
     cmd.execute()
 
 @__ub_exception_handler
@@ -152,28 +316,199 @@ def ub_del_item_under_cursor():
     cmd.execute()
 
 @__ub_exception_handler
-def ub_upload_media(file_path):
-    '''Upload a file
+def ub_del_range(line1, line2):
+    '''Delete the items in the given lines, invoked in list view
+    '''
+    cmd = UBCmdDelRange(line1, line2)
+    cmd.execute()
+
+@__ub_exception_handler
+def ub_open_range(line1, line2):
+    '''Open the items in the given lines in new tabs, invoked in list view
+    '''
+    cmd = UBCmdOpenRange(line1, line2)
+    cmd.execute()
+
+@__ub_exception_handler
+def ub_send_range(line1, line2, status=None):
+    '''Send the local items in the given lines to the blog, invoked in list view
+    '''
+    cmd = UBCmdSendRange(line1, line2, status)
+    cmd.execute()
+
+@__ub_exception_handler
+def ub_upload_media(file_path, force=False):
+    '''Upload a file, unless it has been uploaded to the blog before
     '''
     if not ub_is_view('post_edit'):
         raise UBException(_('Invalid view !'))
     if not os.path.exists(file_path):
         raise UBException(_('File not exists !'))
+    ub_bootstrap()
+    if db.api is None: raise UBException(_('Cannot initiate API !'))
 
     file_type = mimetypes.guess_type(file_path)[0]
-    fp = open(file_path, 'rb')
-    bin_data = xmlrpclib.Binary(fp.read())
-    fp.close()
+    nr = ub_get_bufnr('%')
+    row = vim.current.window.cursor[0]
 
-    global cfg, api
-    result = api.metaWeblog.newMediaObject('', cfg.loginName, cfg.password,
-        dict(name=os.path.basename(file_path), type=file_type, bits=bin_data))
+    def __insert_url(result):
+        '''Insert the URL of the uploaded file below the line where the upload was started
+        '''
+        ub_record_media(digest, file_path, file_type, result)
+        buf = ub_get_buffer(nr)
+        if buf is None: return
+        buf.append(ub_get_media_url(result, nr).split("\n"), row)
 
+    digest = UBMediaUploader.digest(file_path)
+    result = not force and ub_find_media(digest, file_type) or None
+    if result is not None:
+        vim.current.buffer.append(ub_get_media_url(result, nr).split("\n"), row)
+        ub_echo(_('%s has been uploaded before: %s') % (os.path.basename(file_path), result['url']))
+        return
+
+    ub_call_api(_('Uploading %s') % os.path.basename(file_path), UBMediaUploader.upload,
+        (db.cfg.xmlrpc, db.cfg.loginName, db.cfg.password, file_path, file_type), __insert_url)
+
+@__ub_exception_handler
+def ub_upload_many(force, *patterns):
+    '''Upload files matching the given patterns at the same time, then insert
+    their URLs in the order of the files. Files which have been uploaded to
+    the blog before are skipped unless force is True.
+    '''
+    if not ub_is_view('post_edit'):
+        raise UBException(_('Invalid view !'))
+    paths = []
+    for pattern in patterns:
+        matched = [path for path in sorted(glob.glob(os.path.expanduser(pattern))) if os.path.isfile(path)]
+        if len(matched)==0: raise UBException(_('No files match %s !') % pattern)
+        paths.extend([path for path in matched if path not in paths])
+    ub_bootstrap()
+    if db.api is None: raise UBException(_('Cannot initiate API !'))
+
+    nr = ub_get_bufnr('%')
+    row = vim.current.window.cursor[0]
+    results = [None]*len(paths)
+    errors = []
+
+    def __finish():
+        '''Insert the URLs when all uploads have finished
+        '''
+        remaining[0] -= 1
+        if remaining[0]>0: return
+        buf = ub_get_buffer(nr)
+        if buf is not None:
+            lines = []
+            for result in results:
+                if result is not None: lines.extend(ub_get_media_url(result, nr).split("\n"))
+            if len(lines)>0: buf.append(lines, row)
+        if len(errors)>0: raise UBException(_('Failed to upload %s !') % ', '.join(errors))
+
+    def __new_job(i, path, file_type, digest):
+        def __callback(result):
+            ub_record_media(digest, path, file_type, result)
+            results[i] = result
+            __finish()
+        def __errback(e):
+            errors.append('%s (%s)' % (os.path.basename(path), isinstance(e, xmlrpclib.Fault) and e.faultString or e))
+            __finish()
+        return UBJob(_('Uploading %s') % os.path.basename(path), UBMediaUploader.upload,
+            (db.cfg.xmlrpc, db.cfg.loginName, db.cfg.password, path, file_type),
+            __callback, __errback)
+
+    jobs = []
+    for i in range(len(paths)):
+        file_type = mimetypes.guess_type(paths[i])[0]
+        digest = UBMediaUploader.digest(paths[i])
+        results[i] = not force and ub_find_media(digest, file_type) or None
+        if results[i] is None: jobs.append(__new_job(i, paths[i], file_type, digest))
+
+    # One more for the files which need no upload
+    remaining = [len(jobs)+1]
+    UBWorker.poolSize = ub_get_option('ub_upload_workers')
+    for job in jobs: UBWorker.submitParallel(job, ub_new_api)
+    if len(jobs)>0 and ub_is_async():
+        vim.command('call UBStartAsyncPoller()')
+        ub_update_async_status()
+        __finish()
+        return
+
+    for job in UBWorker.wait(jobs):
+        if job.error is None: job.callback(job.result)
+        else: job.errback(job.error)
+    __finish()
+
+def ub_find_media(digest, file_type):
+    '''Return the result of uploading the file with the given digest to the
+    current blog, or None if it has not been uploaded
+    '''
+    sess = Session()
+    media = sess.query(Media).filter(Media.blog==db.cfg.xmlrpc).filter(Media.hash==digest[0])\
+        .filter(Media.size==digest[1]).filter(Media.type==(file_type or '')).first()
+    sess.close()
+    if media is None: return None
+
+    result = json.loads(media.result)
+    # Strings of ASCII come as str from xmlrpclib, so they do from here
+    for key, val in result.items():
+        if isinstance(val, unicode):
+            try:
+                result[key] = val.encode('ascii')
+            except UnicodeError:
+                pass
+    return result
+
+def ub_record_media(digest, file_path, file_type, result):
+    '''Remember the result of uploading a file to the current blog
+    '''
+    sess = Session()
+    media = sess.query(Media).filter(Media.blog==db.cfg.xmlrpc).filter(Media.hash==digest[0])\
+        .filter(Media.size==digest[1]).filter(Media.type==(file_type or '')).first()
+    if media is None:
+        media = Media()
+        media.blog = db.cfg.xmlrpc
+        media.hash, media.size = digest
+        media.type = file_type or ''
+    media.name = os.path.basename(file_path).decode(vim.eval('&encoding'), 'replace')
+    media.url = result['url']
+    media.result = json.dumps(result, default=str)
+    media.uploaded = time.time()
+    sess.add(media)
+    sess.commit()
+    sess.close()
+
+@__ub_exception_handler
+def ub_media(prune=False, *ids):
+    '''List the files uploaded to the current blog, or forget them if prune is
+    True, so that they will be uploaded again
+    '''
+    ub_bootstrap()
+    if db.cfg is None: raise UBException(_('Cannot initiate API !'))
+    sess = Session()
+    query = sess.query(Media).filter(Media.blog==db.cfg.xmlrpc)
+    if len(ids)>0: query = query.filter(Media.id.in_([int(id) for id in ids]))
+    if prune is True:
+        count = query.delete(synchronize_session=False)
+        sess.commit()
+        sess.close()
+        ub_echo(_('%d media files forgotten !') % count)
+        return
+
+    items = query.order_by(Media.uploaded.desc()).all()
+    sess.close()
+    if len(items)==0: raise UBException(_('No media files found !'))
+    enc = vim.eval('&encoding')
+    for media in items:
+        ub_echo(("%-6d%s %10d  %-24s%s" % (media.id, time.strftime('%Y-%m-%d', time.localtime(media.uploaded)),
+            media.size, media.name or '', media.url)).encode(enc))
+
+def ub_get_media_url(result, nr):
+    '''Return the link to an uploaded file by ub_tmpl_img_url, in the syntax
+    of the given buffer
+    '''
     img_tmpl_info = ub_get_option('ub_tmpl_img_url', True)
     img_url = img_tmpl_info['tmpl'] % result
-    syntax = vim.eval('&syntax')
-    img_url = ub_convert_str(img_url, img_tmpl_info['syntax'], syntax)
-    vim.current.range.append(img_url.split("\n"))
+    syntax = vim.eval("getbufvar(%d, '&syntax')" % nr)
+    return ub_convert_str(img_url, img_tmpl_info['syntax'], syntax)
 
 @__ub_exception_handler
 def ub_blog_this(item_type='post', to_syntax=None, from_syntax=None):
@@ -196,13 +531,111 @@ def ub_new_item(item_type='post', mixed='markdown'):
     cmd = UBCmdNew(item_type, mixed)
     cmd.execute()
 
+def ub_render_list_rows(items, enc):
+    '''Return the lines of the given posts/pages in a list view, and the rows
+    which map the lines to the items, refer to ub_patch_list_views()
+    '''
+    tmpl = ub_get_list_template()
+    lines = []
+    rows = []
+    for item in items:
+        line = (tmpl % (item.id,item.post_id,item.status,item.title)).encode(enc)
+        lines.append(line)
+        rows.append([item.id, item.post_id, len(line)])
+    return lines, rows
+
+def ub_patch_list_views(ids, isDeleted=False, viewTypes=['post_list','page_list','search_result_list']):
+    '''Update the lines of the given posts/pages in list views in place, remove
+    them if they have been deleted, or insert new drafts on first pages.
+    Return numbers of the list views which have to be refreshed instead,
+    which are views whose paging boundaries change, or which cannot be patched.
+    '''
+    items = {}
+    if not isDeleted and len(ids)>0:
+        tbl = Post.__table__
+        conn = db.dbe.connect()
+        # In chunks, because SQLite limits the number of variables of a statement
+        for i in range(0, len(ids), 500):
+            stmt = select([tbl.c.id,case([(tbl.c.post_id>0, tbl.c.post_id)], else_=0).label('post_id'),
+                tbl.c.status,tbl.c.title,tbl.c.type]).where(tbl.c.id.in_(ids[i:i+500]))
+            for item in conn.execute(stmt).fetchall(): items[item.id] = item
+        conn.close()
+
+    enc = vim.eval('&encoding')
+    refreshes = []
+    for nr in ub_get_buffers(viewTypes):
+        rows = UBViewRegistry.getRows(nr)
+        buf = ub_get_buffer(nr)
+        if rows is None or buf is None:
+            refreshes.append(nr)
+            continue
+
+        viewName = UBViewRegistry.getName(nr)
+        pageNo = vim.eval("getbufvar(%d, 'page_no')" % nr)
+        pageSize = vim.eval("getbufvar(%d, 'page_size')" % nr)
+        # Items of the next page move in when one is removed from a full page
+        isFull = not pageSize.isdigit() or len(rows)>=int(pageSize)
+        keys = [row[0] for row in rows]
+        updates = []
+        removals = []
+        inserts = []
+        for id in ids:
+            item = items.get(id)
+            if id in keys:
+                idx = keys.index(id)
+                if isDeleted or item is None:
+                    if isFull: break
+                    removals.append(idx)
+                # The item has been sent and moves to another part of the list
+                elif item.post_id != rows[idx][1]: break
+                else: updates.append((idx, item))
+            elif item is None:
+                continue
+            elif viewName.startswith('local_'):
+                # Drafts are listed first from the newest, a new one goes to the top
+                # of the first page, unless it pushes another item to the next page
+                if not viewName.endswith('_%s_list' % item.type): continue
+                if item.post_id>0 or pageNo!='1' or isFull or len(rows)+len(inserts)>=int(pageSize) \
+                    or (rows[0][1]==0 and rows[0][0]>id): break
+                inserts.append(item)
+            elif viewName.startswith('remote_') and (item.post_id==0 or not viewName.endswith('_%s_list' % item.type)):
+                continue
+            else:
+                break
+        else:
+            if len(removals)>=len(rows):
+                refreshes.append(nr)
+                continue
+            if len(updates)+len(removals)+len(inserts)==0: continue
+
+            vim.command("call setbufvar(%d, '&modifiable', 1)" % nr)
+            for idx, item in updates:
+                line = ub_render_list_rows([item], enc)[0][0]
+                # Keep what follows the columns, e.g. excerpts of search results
+                buf[idx+1] = line + buf[idx+1][rows[idx][2]:]
+                rows[idx][2] = len(line)
+            for idx in sorted(removals, reverse=True):
+                del buf[idx+1]
+                del rows[idx]
+            if len(inserts)>0:
+                inserts.sort(key=lambda item: item.id, reverse=True)
+                lines, newRows = ub_render_list_rows(inserts, enc)
+                buf.append(lines, 1)
+                rows[0:0] = newRows
+            vim.command("call setbufvar(%d, '&modifiable', 0)" % nr)
+            vim.command("call setbufvar(%d, '&modified', 0)" % nr)
+            continue
+        refreshes.append(nr)
+
+    return refreshes
+
 class UBCommand(object):
     ''' Abstract parent class for all commands of UB
     '''
     def __init__(self, isContentAware=False):
         self.checkPrerequisites()
         # Set editor mode if the corresponding option has been set
-        ub_set_mode(dbe)
+        ub_set_mode(db.dbe)
 
         self.isContentAware = isContentAware
         self.scope = 'local'
@@ -227,9 +660,10 @@ class UBCommand(object):
         if sqlalchemy is None: raise UBException(_('Cannot find SQLAlchemy !'))
         if Base is None or Session is None or Post is None or Template is None:
             raise UBException(_('Cannot create database objects !'))
-        if cfg is None: raise UBException(_('Settings of UltraBlog.vim is missing or invalid !'))
-        if api is None: raise UBException(_('Cannot initiate API !'))
-        if dbe is None: raise UBException(_('Cannot connect to database !'))
+        ub_bootstrap()
+        if db.cfg is None: raise UBException(_('Settings of UltraBlog.vim is missing or invalid !'))
+        if db.api is None: raise UBException(_('Cannot initiate API !'))
+        if db.dbe is None: raise UBException(_('Cannot connect to database !'))
 
     def checkItemType(self, itemType=None):
         ''' Check if the item type is among the available ones
@@ -270,11 +704,17 @@ class UBCommand(object):
             raise UBException(_('Invalid view, this command is only allowed in %s !') % str(self.viewScopes))
 
     def execute(self):
-        ''' The main functional method of this command
+        ''' The main functional method of this command, how long each step
+        takes is recorded by UBProfiler under the name of the command
         '''
-        self._preExec()
-        self._exec()
-        self._postExec()
+        name = self.__class__.__name__.replace('UBCmd', '', 1)
+        dumpFile = name==ub_get_option('ub_cprofile_command') and ub_get_option('ub_cprofile_file') or None
+        UBProfiler.command(name, self.__run, dumpFile)
+
+    def __run(self):
+        UBProfiler.call('preExec', self._preExec)
+        UBProfiler.call('exec', self._exec)
+        UBProfiler.call('postExec', self._postExec)
 
     def _preExec(self):
         ''' Do something before self._exec()
@@ -311,12 +751,16 @@ class UBCommand(object):
 class UBCmdList(UBCommand):
     ''' Listing command, implements UBCommand
     '''
-    def __init__(self, itemType='post', scope='local', pageSize=None, pageNo=None):
+    def __init__(self, itemType='post', scope='local', pageSize=None, pageNo=None, cursor=None):
         UBCommand.__init__(self)
         self.itemType = itemType
         self.scope = scope
         self.pageSize = int(pageSize is not None and pageSize or ub_get_option("ub_%s_pagesize" % self.scope))
         self.pageNo = int(pageNo is not None and pageNo or 1)
+        self.cursor = cursor is not None and len(cursor)>0 and cursor or None
+        self.isPending = False
+        # Remote items are listed from this buffer, whenever they arrive
+        self.bufnr = vim.current.buffer.number
 
     def _preExec(self):
         UBCmdList.doDefault()
@@ -329,6 +773,12 @@ class UBCmdList(UBCommand):
 
     def _postExec(self):
         UBCmdList.doDefault()
+        # Remote lists are finished when the items arrive
+        if not self.isPending: self._finishView()
+
+    def _finishView(self):
+        '''Lock the list view and put the cursor on the first item
+        '''
         vim.command('call UBClearUndo()')
         vim.command('setl nomodified')
         vim.command("setl nomodifiable")
@@ -338,50 +788,55 @@ class UBCmdList(UBCommand):
     def _listLocalPosts(self):
         '''List local posts stored in database
         '''
-        posts = []
-
-        tbl = Post.__table__
-        ua = union_all(
-            select([select([tbl.c.id,case([(tbl.c.post_id>0, tbl.c.post_id)], else_=0).label('post_id'),tbl.c.status,tbl.c.title])\
-                .where(tbl.c.post_id==None).where(tbl.c.type=='post').order_by(tbl.c.id.desc())]),
-            select([select([tbl.c.id,case([(tbl.c.post_id>0, tbl.c.post_id)], else_=0).label('post_id'),tbl.c.status,tbl.c.title])\
-                .where(tbl.c.post_id!=None).where(tbl.c.type=='post').order_by(tbl.c.post_id.desc())])
-        )
-        stmt = select([ua]).limit(self.pageSize).offset(self.pageSize*(self.pageNo-1))
-
-        conn = dbe.connect()
-        rslt = conn.execute(stmt)
-        while True:
-            row = rslt.fetchone()
-            if row is not None:
-                posts.append(row)
-            else:
-                break
-        conn.close()
-
+        posts = self._fetchLocalItems()
         if len(posts)==0: raise UBException(_('No more posts found !'))
 
         ub_wise_open_view('local_post_list')
         vim.current.buffer[0] = "==================== Posts (Page %d) ====================" % self.pageNo
-        tmpl = ub_get_list_template()
-        vim.current.buffer.append([(tmpl % (post.id,post.post_id,post.status,post.title)).encode(self.enc) for post in posts])
+        lines, rows = ub_render_list_rows(posts, self.enc)
+        vim.current.buffer.append(lines)
+        UBViewRegistry.setRows(vim.current.buffer.number, rows)
 
-        vim.command("let b:page_no=%s" % self.pageNo)
-        vim.command("let b:page_size=%s" % self.pageSize)
-        vim.command("map <buffer> "+ub_get_option('ub_hotkey_pagedown')+" :py ub_list_items('post', 'local', %d, %d)<cr>" % (self.pageSize, self.pageNo+1))
-        vim.command("map <buffer> "+ub_get_option('ub_hotkey_pageup')+" :py ub_list_items('post', 'local', %d, %d)<cr>" % (self.pageSize, self.pageNo-1))
+        self._setPagingKeys(posts)
 
     def _listRemotePosts(self):
         '''List remote posts stored in the blog
         '''
-        posts = api.metaWeblog.getRecentPosts('', cfg.loginName, cfg.password, self.pageSize)
+        if self._isMirrored():
+            self._showMirroredItems('remote_post_list', "==================== Recent Posts ====================")
+            return
+
+        self.isPending = True
+        ub_call_api(_('Listing remote posts'), 'metaWeblog.getRecentPosts',
+            ('', db.cfg.loginName, db.cfg.password, self.pageSize), self._showRemotePosts)
+
+    def _getLocalCopies(self, postIds, itemType=None):
+        '''Return the ids and statuses of the local copies of remote items, keyed
+        by post_id, looked up by IN (...) in chunks, because SQLite limits the
+        number of variables of a statement
+        '''
+        copies = {}
+        postIds = [int(postId) for postId in postIds]
+        for i in range(0, len(postIds), 500):
+            query = self.sess.query(Post.post_id, Post.id, Post.status).filter(Post.post_id.in_(postIds[i:i+500]))
+            if itemType is not None: query = query.filter(Post.type==itemType)
+            for row in query.order_by(Post.id).all():
+                copies.setdefault(row.post_id, row)
+        return copies
+
+    def _showRemotePosts(self, posts):
+        '''Show the remote posts fetched by self._listRemotePosts()
+        '''
+        if self._deferIfAway(lambda: self._showRemotePosts(posts)): return
+        copies = self._getLocalCopies([post['postid'] for post in posts])
         for post in posts:
-            local_post = self.sess.query(Post).filter(Post.post_id==post['postid']).first()
+            local_post = copies.get(int(post['postid']))
             if local_post is None:
                 post['id'] = 0
             else:
                 post['id'] = local_post.id
                 post['post_status'] = local_post.status
+        self.sess.close()
 
         ub_wise_open_view('remote_post_list')
         vim.current.buffer[0] = "==================== Recent Posts ===================="
@@ -389,53 +844,157 @@ class UBCmdList(UBCommand):
         vim.current.buffer.append([(tmpl % (post['id'],post['postid'],post['post_status'],post['title'])).encode(self.enc) for post in posts])
 
         vim.command("let b:page_size=%s" % self.pageSize)
+        self._finishView()
 
     def _listLocalPages(self):
         '''List local pages stored in database
         '''
-        pages = []
+        pages = self._fetchLocalItems()
+        if len(pages)==0: raise UBException(_('No more pages found !'))
 
-        tbl = Post.__table__
-        ua = union_all(
-            select([select([tbl.c.id,case([(tbl.c.post_id>0, tbl.c.post_id)], else_=0).label('post_id'),tbl.c.status,tbl.c.title])\
-                .where(tbl.c.post_id==None).where(tbl.c.type=='page').order_by(tbl.c.id.desc())]),
-            select([select([tbl.c.id,case([(tbl.c.post_id>0, tbl.c.post_id)], else_=0).label('post_id'),tbl.c.status,tbl.c.title])\
-                .where(tbl.c.post_id!=None).where(tbl.c.type=='page').order_by(tbl.c.post_id.desc())])
-        )
+        ub_wise_open_view('local_page_list')
+        vim.current.buffer[0] = "==================== Local Pages (Page %d) ====================" % self.pageNo
+        lines, rows = ub_render_list_rows(pages, self.enc)
+        vim.current.buffer.append(lines)
+        UBViewRegistry.setRows(vim.current.buffer.number, rows)
 
-        conn = dbe.connect()
-        rslt = conn.execute(ua)
-        while True:
-            row = rslt.fetchone()
-            if row is not None:
-                pages.append(row)
+        self._setPagingKeys(pages)
+
+    def _fetchLocalItems(self):
+        '''Fetch a page of local posts/pages, items which have not been sent
+        come first, both parts are ordered from the newest to the oldest.
+
+        The page is located by a keyset cursor like "next:sent:1234", which
+        holds the sort key of the item next to the page, so that every page
+        costs the same index seek however deep it is. Without a cursor, the
+        page is located by its number and an offset.
+        '''
+        tbl = Post.__table__
+        cols = [tbl.c.id,case([(tbl.c.post_id>0, tbl.c.post_id)], else_=0).label('post_id'),tbl.c.status,tbl.c.title]
+        drafts = select(cols+[literal('draft').label('segment'),tbl.c.id.label('sort_key')])\
+            .where(tbl.c.type==self.itemType).where(tbl.c.post_id==None)
+        sent = select(cols+[literal('sent').label('segment'),tbl.c.post_id.label('sort_key')])\
+            .where(tbl.c.type==self.itemType).where(tbl.c.post_id!=None)
+
+        conn = db.dbe.connect()
+        direction = 'next'
+        if self.cursor is None:
+            offset = self.pageSize*(self.pageNo-1)
+            stmt = select([func.count(tbl.c.id)]).where(tbl.c.type==self.itemType).where(tbl.c.post_id==None)
+            draftCount = conn.execute(stmt).scalar()
+            if offset<draftCount:
+                segments = [(drafts.order_by(tbl.c.id.desc()), offset), (sent.order_by(tbl.c.post_id.desc()), 0)]
             else:
-                break
+                segments = [(sent.order_by(tbl.c.post_id.desc()), offset-draftCount)]
+        else:
+            try:
+                direction, segment, key = self.cursor.split(':')
+                key = int(key)
+            except ValueError:
+                conn.close()
+                raise UBException(_('Invalid cursor (%s) !') % self.cursor)
+            if direction=='next' and segment=='draft':
+                segments = [(drafts.where(tbl.c.id<key).order_by(tbl.c.id.desc()), 0),
+                    (sent.order_by(tbl.c.post_id.desc()), 0)]
+            elif direction=='next':
+                segments = [(sent.where(tbl.c.post_id<key).order_by(tbl.c.post_id.desc()), 0)]
+            # Walk backwards in the reversed order, the rows are flipped afterwards
+            elif segment=='draft':
+                segments = [(drafts.where(tbl.c.id>key).order_by(tbl.c.id.asc()), 0)]
+            else:
+                segments = [(sent.where(tbl.c.post_id>key).order_by(tbl.c.post_id.asc()), 0),
+                    (drafts.order_by(tbl.c.id.asc()), 0)]
+
+        items = []
+        for stmt, offset in segments:
+            if len(items)>=self.pageSize: break
+            rslt = conn.execute(stmt.limit(self.pageSize-len(items)).offset(offset))
+            items.extend(rslt.fetchall())
         conn.close()
 
-        if len(pages)==0: raise UBException(_('No more pages found !'))
+        if direction=='prev': items.reverse()
+        return items
 
-        ub_wise_open_view('local_page_list')
-        vim.current.buffer[0] = "==================== Local Pages ===================="
-        tmpl = ub_get_list_template()
-        vim.current.buffer.append([(tmpl % (page.id,page.post_id,page.status,page.title)).encode(self.enc) for page in pages])
+    def _setPagingKeys(self, items):
+        '''Remember the paging status of the list and map the paging hotkeys
+        to the keyset cursors of the items around the current page
+        '''
+        first = 'prev:%s:%d' % (items[0].segment, items[0].sort_key)
+        last = 'next:%s:%d' % (items[-1].segment, items[-1].sort_key)
+
+        vim.command("let b:page_no=%s" % self.pageNo)
+        vim.command("let b:page_size=%s" % self.pageSize)
+        vim.command("let b:ub_cursor='%s'" % (self.cursor is not None and self.cursor or ''))
+        vim.command("map <buffer> "+ub_get_option('ub_hotkey_pagedown')+" :py ub_list_items('%s', 'local', %d, %d, '%s')<cr>" % (self.itemType, self.pageSize, self.pageNo+1, last))
+        vim.command("map <buffer> "+ub_get_option('ub_hotkey_pageup')+" :py ub_list_items('%s', 'local', %d, %d, '%s')<cr>" % (self.itemType, self.pageSize, self.pageNo-1, first))
 
     def _listRemotePages(self):
         '''List remote pages stored in the blog
         '''
-        pages = api.wp.getPages('', cfg.loginName, cfg.password)
+        if self._isMirrored():
+            self._showMirroredItems('remote_page_list', "==================== Blog Pages ====================")
+            return
+
+        self.isPending = True
+        ub_call_api(_('Listing remote pages'), 'wp.getPages',
+            ('', db.cfg.loginName, db.cfg.password), self._showRemotePages)
+
+    def _showRemotePages(self, pages):
+        '''Show the remote pages fetched by self._listRemotePages()
+        '''
+        if self._deferIfAway(lambda: self._showRemotePages(pages)): return
+        copies = self._getLocalCopies([page['page_id'] for page in pages], 'page')
         for page in pages:
-            local_page = self.sess.query(Post).filter(Post.post_id==page['page_id']).filter(Post.type=='page').first()
+            local_page = copies.get(int(page['page_id']))
             if local_page is None:
                 page['id'] = 0
             else:
                 page['id'] = local_page.id
                 page['page_status'] = local_page.status
+        self.sess.close()
 
         ub_wise_open_view('remote_page_list')
         vim.current.buffer[0] = "==================== Blog Pages ===================="
         tmpl = ub_get_list_template()
         vim.current.buffer.append([(tmpl % (page['id'],page['page_id'],page['page_status'],page['title'])).encode(self.enc) for page in pages])
+        self._finishView()
+
+    def _deferIfAway(self, func):
+        '''Leave the remote items to be listed when the user returns to the
+        buffer they were asked from, instead of taking over the window the
+        user has moved to in the meantime. Return True if they are left.
+        '''
+        if vim.current.buffer.number == self.bufnr: return False
+        if ub_defer_view(self.bufnr, func):
+            ub_echo(_('Remote items have arrived, they will be listed when you return to buffer %d.') % self.bufnr)
+        return True
+
+    def _isMirrored(self):
+        '''Check if remote items can be listed from the database, which is
+        true after they have been synchronized by :UBSync
+        '''
+        if ub_get_option('ub_list_remote_from_mirror') is not True: return False
+        state = self.sess.query(SyncState).filter(SyncState.blog==db.cfg.xmlrpc).filter(SyncState.type==self.itemType).first()
+        return state is not None and state.watermark is not None
+
+    def _showMirroredItems(self, viewName, title):
+        '''List remote items from the local mirror without a network round trip
+        '''
+        tbl = Post.__table__
+        stmt = select([tbl.c.id,tbl.c.post_id,tbl.c.status,tbl.c.title])\
+            .where(tbl.c.type==self.itemType).where(tbl.c.post_id!=None).order_by(tbl.c.post_id.desc())
+        if self.itemType=='post': stmt = stmt.limit(self.pageSize)
+
+        conn = db.dbe.connect()
+        items = conn.execute(stmt).fetchall()
+        conn.close()
+
+        ub_wise_open_view(viewName)
+        vim.current.buffer[0] = title
+        lines, rows = ub_render_list_rows(items, self.enc)
+        vim.current.buffer.append(lines)
+        UBViewRegistry.setRows(vim.current.buffer.number, rows)
+        vim.command("let b:page_size=%s" % self.pageSize)
 
     def _listTemplates(self):
         '''List preview templates
@@ -465,6 +1024,71 @@ class UBCmdSearch(UBCommand):
         if self.pageSize<1: raise UBException(_('Illegal page size (%s) !') % self.pageSize)
 
     def _exec(self):
+        if db.fts and not self.isRegexp and ub_get_option('ub_use_fts') is True:
+            posts = self._searchIndex()
+        else:
+            posts = self._searchTable()
+
+        if len(posts)==0: raise UBException(_('No more posts found !'))
+
+        ub_wise_open_view('search_result_list')
+        vim.current.buffer[0] = "==================== Results (Page %d) ====================" % self.pageNo
+        lines, rows = ub_render_list_rows(posts, self.enc)
+        for i in range(len(posts)):
+            # Excerpts are only available from the FTS5 index
+            if 'excerpt' in posts[i].keys() and posts[i].excerpt is not None:
+                lines[i] = "%s    %s" % (lines[i], ' '.join(posts[i].excerpt.split()).encode(self.enc))
+        vim.current.buffer.append(lines)
+        UBViewRegistry.setRows(vim.current.buffer.number, rows)
+
+        vim.command("let b:page_no=%s" % self.pageNo)
+        vim.command("let b:page_size=%s" % self.pageSize)
+        vim.command("let b:is_regexp=%s" % self.isRegexp)
+        vim.command("let b:ub_keywords=[%s]" % ','.join(["'%s'" % kw for kw in self.keywords]))
+        vim.command("map <buffer> "+ub_get_option('ub_hotkey_pagedown')+" :py ub_search(%d,%d,%s)<cr>" % (self.isRegexp, self.pageNo+1, ','.join(["'%s'" % kw for kw in self.keywords])))
+        vim.command("map <buffer> "+ub_get_option('ub_hotkey_pageup')+" :py ub_search(%d,%d,%s)<cr>" % (self.isRegexp, self.pageNo-1, ','.join(["'%s'" % kw for kw in self.keywords])))
+        vim.command('call UBClearUndo()')
+        vim.command('setl nomodified')
+        vim.command("setl nomodifiable")
+        vim.current.window.cursor = (2, 0)
+        vim.command("let @/='\\(%s\\)'" % '\\|'.join(self.keywords))
+        vim.command('setl hls')
+
+    def _searchIndex(self):
+        '''Search the FTS5 index, best matches come first. If nothing at all
+        matches, e.g. keywords shorter than a trigram or parts of words which
+        the index does not split, all posts are scanned instead.
+        '''
+        posts = []
+        match = ' '.join(['"%s"' % kw.decode(self.enc).replace('"', '""') for kw in self.keywords])
+        # Excerpts are about a dozen words long, trigrams are counted by characters
+        tokens = db.fts=='trigram' and 64 or 12
+        sql = "select post.id as id,case when post.post_id>0 then post.post_id else 0 end as post_id,"\
+            "post.status as status,post.title as title,snippet(post_fts,-1,'','','...',%d) as excerpt "\
+            "from post_fts join post on post.id=post_fts.rowid where post_fts match :match "\
+            "order by bm25(post_fts,10.0,1.0,5.0,5.0) limit :limit offset :offset" % tokens
+
+        conn = db.dbe.connect()
+        rslt = conn.execute(text(sql), match=match, limit=self.pageSize, offset=self.pageSize*(self.pageNo-1))
+        while True:
+            row = rslt.fetchone()
+            if row is not None:
+                posts.append(row)
+            else:
+                break
+        # Whether to fall back must not depend on the page, or pages would mix both results
+        found = len(posts)>0 or self.pageNo>1 and conn.execute(
+            text("select 1 from post_fts where post_fts match :match limit 1"), match=match).scalar() is not None
+        conn.close()
+
+        if not found: return self._searchTable()
+        return posts
+
+    def _searchTable(self):
+        '''Scan the post table with LIKE or REGEXP conditions,
+        used when FTS5 is not available, regular expressions are given or the
+        index matches nothing
+        '''
         posts = []
         tbl = Post.__table__
 
@@ -483,7 +1107,7 @@ class UBCmdSearch(UBCommand):
             and_(*conds)
         ).limit(self.pageSize).offset(self.pageSize*(self.pageNo-1)).order_by(tbl.c.status.asc(),tbl.c.post_id.desc())
 
-        conn = dbe.connect()
+        conn = db.dbe.connect()
         # Hook regexp function to sqlite3 if the current mode is regexp
         if self.isRegexp:
             conn.connection.create_function('REGEXP', 2, regexp_search)
@@ -496,59 +1120,76 @@ class UBCmdSearch(UBCommand):
                 break
         conn.close()
 
-        if len(posts)==0: raise UBException(_('No more posts found !'))
-
-        ub_wise_open_view('search_result_list')
-        vim.current.buffer[0] = "==================== Results (Page %d) ====================" % self.pageNo
-        tmpl = ub_get_list_template()
-        vim.current.buffer.append([(tmpl % (post.id,post.post_id,post.status,post.title)).encode(self.enc) for post in posts])
-
-        vim.command("let b:page_no=%s" % self.pageNo)
-        vim.command("let b:page_size=%s" % self.pageSize)
-        vim.command("let b:is_regexp=%s" % self.isRegexp)
-        vim.command("let b:ub_keywords=[%s]" % ','.join(["'%s'" % kw for kw in self.keywords]))
-        vim.command("map <buffer> "+ub_get_option('ub_hotkey_pagedown')+" :py ub_search(%d,%d,%s)<cr>" % (self.isRegexp, self.pageNo+1, ','.join(["'%s'" % kw for kw in self.keywords])))
-        vim.command("map <buffer> "+ub_get_option('ub_hotkey_pageup')+" :py ub_search(%d,%d,%s)<cr>" % (self.isRegexp, self.pageNo-1, ','.join(["'%s'" % kw for kw in self.keywords])))
-        vim.command('call UBClearUndo()')
-        vim.command('setl nomodified')
-        vim.command("setl nomodifiable")
-        vim.current.window.cursor = (2, 0)
-        vim.command("let @/='\\(%s\\)'" % '\\|'.join(self.keywords))
-        vim.command('setl hls')
+        return posts
 
 class UBCmdReplace(UBCommand):
     ''' Context replace
+
+    Matched items are found by one query, then only they are updated, in
+    transactions of ub_replace_batchsize items, so that neither the rest of
+    the database nor the full-text index is rewritten. In dry-run mode, the
+    matched items and the number of matches in each are listed instead.
     '''
-    def __init__(self, isRegexp, needle, replacement):
+    def __init__(self, isRegexp, isDryRun, needle, replacement):
         UBCommand.__init__(self)
         self.isRegexp = isRegexp
+        self.isDryRun = isDryRun
         self.needle = needle
         self.replacement = replacement
+        self.batchSize = ub_get_option('ub_replace_batchsize')
+        self.matches = []
         self.count = 0
 
     def _preExec(self):
         UBCmdReplace.doDefault()
+        if self.needle=='': raise UBException(_('Nothing to replace !'))
 
     def _exec(self):
-        conn = dbe.connect()
+        params = {'needle':self.needle.decode(self.enc), 'replacement':self.replacement.decode(self.enc)}
+        conn = db.dbe.connect()
         # Hook regexp function to sqlite3 if the current mode is regexp
         if self.isRegexp:
             conn.connection.create_function('REGEXP', 2, regexp_search)
             conn.connection.create_function('regex_replace', 3, regex_replace)
-            sql_replace = "update post set title=regex_replace(title,:needle,:replacement),content=regex_replace(content,:needle,:replacement)"
-            sql_count = "select count(*) from post where title regexp :needle or content regexp :needle"
-            rslt = conn.execute(sql_count, {'needle':self.needle.decode(self.enc)})
-            self.count = rslt.fetchone()[0]
+            conn.connection.create_function('regex_count', 2, regex_count)
+            sql_match = "select id,type,title,regex_count(title,:needle)+regex_count(content,:needle) " \
+                "from post where title regexp :needle or content regexp :needle order by id"
+            sql_replace = "update post set title=regex_replace(title,:needle,:replacement)," \
+                "content=regex_replace(content,:needle,:replacement),dirty=1 where id in (%s)"
         else:
-            sql_replace = "update post set title=replace(title,:needle,:replacement),content=replace(content,:needle,:replacement)"
-            needle = '%%%s%%' % self.needle.decode(self.enc)
-            self.count = self.sess.query(Post).filter(or_(Post.title.like(needle),Post.content.like(needle))).count()
-        conn.execute(sql_replace, {'needle':self.needle.decode(self.enc), 'replacement':self.replacement.decode(self.enc)})
-        conn.close()
+            sql_match = "select id,type,title," \
+                "(ifnull(length(title),0)-ifnull(length(replace(title,:needle,'')),0)" \
+                "+ifnull(length(content),0)-ifnull(length(replace(content,:needle,'')),0))/length(:needle) " \
+                "from post where instr(title,:needle)>0 or instr(content,:needle)>0 order by id"
+            sql_replace = "update post set title=replace(title,:needle,:replacement)," \
+                "content=replace(content,:needle,:replacement),dirty=1 where id in (%s)"
+
+        try:
+            self.matches = conn.execute(sql_match, params).fetchall()
+            self.count = len(self.matches)
+            if self.isDryRun: return
+
+            ids = [row[0] for row in self.matches]
+            for i in range(0, len(ids), self.batchSize):
+                trans = conn.begin()
+                try:
+                    conn.execute(sql_replace % ','.join([str(id) for id in ids[i:i+self.batchSize]]), params)
+                    trans.commit()
+                except:
+                    trans.rollback()
+                    raise
+        finally:
+            conn.close()
 
     def _postExec(self):
         UBCmdReplace.doDefault()
-        evt = UBReplaceCompleteEvent(self.count)
+        if self.isDryRun:
+            for id, itemType, title, count in self.matches:
+                ub_echo(("%-8d%-8s%6d  %s" % (id, itemType, count, title)).encode(self.enc))
+            ub_echo(_('%d items would be substituted !') % self.count)
+            return
+
+        evt = UBReplaceCompleteEvent([row[0] for row in self.matches])
         UBEventQueue.fireEvent(evt)
         UBEventQueue.processEvents()
         ub_echo(_('%d items substituted !') % self.count)
@@ -578,6 +1219,7 @@ class UBCmdSave(UBCommand):
 
         ub_set_meta(self.item.getKeyProperty(), self.itemKey)
         vim.command('setl nomodified')
+        if self.itemType=='post' and self.item.tags: UBTermIndex.add('tag', self.item.tags.split(','))
         
         evt = eval("UB%sSaveEvent('%s')" % (self.itemType=='tmpl' and 'Tmpl' or 'Post', self.itemKey));
         UBEventQueue.fireEvent(evt)
@@ -596,7 +1238,7 @@ class UBCmdSave(UBCommand):
             tmpl = Template()
             tmpl.name = self.itemKey
 
-        tmpl.content = "\n".join(vim.current.buffer[len(ub_get_tmpl_meta_data())+2:]).decode(self.enc)
+        tmpl.content = ub_get_content().decode(self.enc)
         tmpl.description = ub_get_meta('description').decode(self.enc)
 
         self.item = tmpl
@@ -609,7 +1251,7 @@ class UBCmdSave(UBCommand):
         else:
             post = self.sess.query(Post).filter(Post.id==self.itemKey).first()
 
-        post.content = "\n".join(vim.current.buffer[len(ub_get_post_meta_data())+2:]).decode(self.enc)
+        post.content = ub_get_content().decode(self.enc)
         post.post_id = ub_get_meta('post_id')
         post.title = ub_get_meta('title').decode(self.enc)
         post.categories = ub_get_meta('categories').decode(self.enc)
@@ -617,6 +1259,7 @@ class UBCmdSave(UBCommand):
         post.slug = ub_get_meta('slug').decode(self.enc)
         post.status = ub_get_meta('status').decode(self.enc)
         post.syntax = self.syntax
+        post.dirty = 1
 
         self.item = post
 
@@ -629,19 +1272,20 @@ class UBCmdSave(UBCommand):
         else:
             page = self.sess.query(Post).filter(Post.id==self.itemKey).first()
 
-        page.content = "\n".join(vim.current.buffer[len(ub_get_page_meta_data())+2:]).decode(self.enc)
+        page.content = ub_get_content().decode(self.enc)
         page.post_id = ub_get_meta('post_id')
         page.title = ub_get_meta('title').decode(self.enc)
         page.slug = ub_get_meta('slug').decode(self.enc)
         page.status = ub_get_meta('status').decode(self.enc)
         page.syntax = self.syntax
+        page.dirty = 1
 
         self.item = page
 
 class UBCmdSend(UBCommand):
     ''' Send item
     '''
-    def __init__(self, status=None):
+    def __init__(self, status=None, callback=None):
         UBCommand.__init__(self, True)
         self.status = status is not None and status or ub_get_meta('status')
         self.publish = ub_check_status(self.status)
@@ -649,32 +1293,55 @@ class UBCmdSend(UBCommand):
         self.viewScopes = ['post_edit', 'page_edit'];
         self.postId = ub_get_meta('post_id')
         self.itemTypeName = ub_get_item_type_name(self.itemType)
+        self.bufnr = ub_get_bufnr('%')
+        self.callback = callback
 
     def _exec(self):
         eval('self._load%s()' % self.itemType.capitalize())
+        # The stored item is what is sent, if the buffer is saved and stays unchanged until sent
+        self.savedTick = vim.eval('&modified')=='0' and vim.eval("getbufvar(%d, 'changedtick')" % self.bufnr) or None
+        label = _('Sending %s') % self.itemTypeName
         if self.postId is None:
-            self.postId = api.metaWeblog.newPost('', cfg.loginName, cfg.password, self.item, self.publish)
+            ub_call_api(label, 'metaWeblog.newPost',
+                ('', db.cfg.loginName, db.cfg.password, self.item, self.publish), self._onSent)
         else:
-            api.metaWeblog.editPost(self.postId, cfg.loginName, cfg.password, self.item, self.publish)
+            ub_call_api(label, 'metaWeblog.editPost',
+                (self.postId, db.cfg.loginName, db.cfg.password, self.item, self.publish), self._onSent)
+
+    def _onSent(self, result):
+        '''Update the buffer which has been sent, invoked with the result of
+        metaWeblog.newPost or metaWeblog.editPost
+        '''
+        if self.postId is None: self.postId = result
+        isStored = self.savedTick is not None and self.savedTick==vim.eval("getbufvar(%d, 'changedtick')" % self.bufnr)
         msg = _("%s sent as %s !") % (self.itemTypeName.capitalize(), ub_get_status_label(self.status))
         ub_echo(msg)
 
-    def _postExec(self):
-        UBCmdSend.doDefault()
-
-        if self.postId != ub_get_meta('post_id'):
-            ub_set_meta('post_id', self.postId)
-        if self.status != ub_get_meta('status'):
-            ub_set_meta('status', self.status)
+        if self.postId != ub_get_meta('post_id', self.bufnr):
+            ub_set_meta('post_id', self.postId, self.bufnr)
+        if self.status != ub_get_meta('status', self.bufnr):
+            ub_set_meta('status', self.status, self.bufnr)
 
+        # Only the current buffer can be saved
         saveit = ub_get_option('ub_save_after_sent')
-        if '1'==vim.eval('&modified') and saveit is not None and saveit.isdigit() and int(saveit) == 1:
+        if self.bufnr==ub_get_bufnr('%') and '1'==vim.eval('&modified') \
+                and saveit is not None and saveit.isdigit() and int(saveit) == 1:
             ub_save_item()
-        
+        id = ub_get_meta('id', self.bufnr)
+        if isStored and ub_is_id(id):
+            sess = Session()
+            sess.query(Post).filter(Post.id==int(id)).update(
+                {Post.post_id:int(self.postId), Post.status:self.status, Post.dirty:0})
+            sess.commit()
+            sess.close()
+            UBEventQueue.fireEvent(UBPostSaveEvent(int(id)))
+
         evt = eval("UBPostSendEvent(%s)" % self.postId)
         UBEventQueue.fireEvent(evt)
         UBEventQueue.processEvents()
 
+        if self.callback is not None: self.callback(self.postId)
+
     def _loadPost(self):
         '''Send the current buffer to the blog
         '''
@@ -702,12 +1369,13 @@ class UBCmdSend(UBCommand):
 class UBCmdOpen(UBCommand):
     ''' Open an item
     '''
-    def __init__(self, itemKey, itemType, scope='local', viewType=None):
+    def __init__(self, itemKey, itemType, scope='local', viewType=None, remoteItem=None):
         UBCommand.__init__(self)
         self.itemKey = itemType=='tmpl' and itemKey.decode(self.enc) or int(itemKey)
         self.itemType = itemType
         self.scope = scope
         self.viewType = viewType
+        self.remoteItem = remoteItem
         self.saveIt = ub_get_option('ub_save_after_opened')
         self.metaData = None
         self.item = None
@@ -730,23 +1398,25 @@ class UBCmdOpen(UBCommand):
     def _loadLocalPost(self):
         '''Open local post
         '''
-        self.item = self.sess.query(Post).filter(Post.id==self.itemKey).first()
+        self.item = self.sess.query(Post).options(undefer('content')).filter(Post.id==self.itemKey).first()
         if self.item is None: raise UBException(_('No post found !'))
 
     def _loadLocalPage(self):
         '''Open local page
         '''
-        self.item = self.sess.query(Post).filter(Post.id==self.itemKey).filter(Post.type=='page').first()
+        self.item = self.sess.query(Post).options(undefer('content')).filter(Post.id==self.itemKey).filter(Post.type=='page').first()
         if self.item is None: raise UBException(_('No page found !'))
 
     def _loadRemotePost(self):
         '''Open remote post
         '''
-        self.item = self.sess.query(Post).filter(Post.post_id==self.itemKey).first()
+        self.item = self.sess.query(Post).options(undefer('content')).filter(Post.post_id==self.itemKey).first()
 
         # Fetch the remote post if there is not a local copy
         if self.item is None:
-            remote_post = api.metaWeblog.getPost(self.itemKey, cfg.loginName, cfg.password)
+            remote_post = self.remoteItem
+            if remote_post is None:
+                remote_post = db.api.metaWeblog.getPost(self.itemKey, db.cfg.loginName, db.cfg.password)
             self.item = Post()
             self.item.post_id = self.itemKey
             self.item.title = remote_post['title']
@@ -764,11 +1434,13 @@ class UBCmdOpen(UBCommand):
     def _loadRemotePage(self):
         '''Open remote page
         '''
-        self.item = self.sess.query(Post).filter(Post.post_id==self.itemKey).filter(Post.type=='page').first()
+        self.item = self.sess.query(Post).options(undefer('content')).filter(Post.post_id==self.itemKey).filter(Post.type=='page').first()
 
         # Fetch the remote page if there is not a local copy
         if self.item is None:
-            remote_page = api.wp.getPage('', self.itemKey, cfg.loginName, cfg.password)
+            remote_page = self.remoteItem
+            if remote_page is None:
+                remote_page = db.api.wp.getPage('', self.itemKey, db.cfg.loginName, db.cfg.password)
             self.item = Post()
             self.item.type = 'page'
             self.item.post_id = self.itemKey
@@ -860,31 +1532,29 @@ class UBCmdNew(UBCommand):
         doit = ub_get_option('ub_append_promotion_link')
         if doit is not None and doit.isdigit() and int(doit) == 1:
             if self.syntax == 'markdown':
-                link = 'Posted via [UltraBlog.vim](%s).' % cfg.homepage
+                link = 'Posted via [UltraBlog.vim](%s).' % db.cfg.homepage
             else:
-                link = 'Posted via <a href="%s">UltraBlog.vim</a>.' % cfg.homepage
+                link = 'Posted via <a href="%s">UltraBlog.vim</a>.' % db.cfg.homepage
             vim.current.buffer.append(link)
 
 class UBCmdPreview(UBCommand):
     ''' Preview command
     '''
-    def __init__(self, tmpl=None):
+    def __init__(self, tmpl=None, isLive=False):
         UBCommand.__init__(self, True)
         self.tmpl = tmpl is not None and tmpl or ub_get_option('ub_default_template')
+        self.isLive = isLive
         self.viewScopes = ['post_edit', 'page_edit']
 
     def _exec(self):
-        prv_url = ''
         if self.tmpl in ['private', 'publish', 'draft']:
-            ub_send_item(self.tmpl)
-
-            if ub_is_view('page_edit'):
-                prv_url = "%s?page_id=%s&preview=true"
-            else:
-                prv_url = "%s?p=%s&preview=true"
-
-            prv_url = prv_url % (cfg.url, ub_get_meta('post_id'))
+            # The post is previewed in the blog after being sent
+            ub_send_item(self.tmpl, self._previewRemote)
         else:
+            nr = int(vim.eval("bufnr('%')"))
+            # Nobody is looking at the live preview, do not bother rendering it
+            if self.isLive and not UBPreviewServer.isWatched(nr): return
+
             template = self.sess.query(Template).filter(Template.name==self.tmpl.decode(self.enc)).first()
             if template is None:
                 raise UBException(_("Template '%s' is not found !") % self.tmpl)
@@ -895,21 +1565,53 @@ class UBCmdPreview(UBCommand):
             draft['title'] = ub_get_meta('title')
             draft['content'] = ub_get_html()
 
-            tmpfile = tempfile.mktemp(suffix='.html')
-            fp = open(tmpfile, 'w')
-            fp.write(tmpl_str % draft)
-            fp.close()
-            prv_url = "file://%s" % tmpfile
+            # Pages open in a browser reload themselves
+            UBPreviewServer.publish(nr, (tmpl_str % draft).decode(self.enc).encode('utf-8'))
+            if self.isLive: return
+
+            self._watchBuffer()
+            if not UBPreviewServer.isWatched(nr):
+                self._show(UBPreviewServer.url(nr))
 
+    def _watchBuffer(self):
+        '''Update the preview when the current buffer changes, or without
+        timers, when the user stops typing or writes the buffer
+        '''
+        vim.command("let b:ub_preview_template = '%s'" % self.tmpl.replace("'", "''"))
+        vim.command("augroup UBLivePreview")
+        vim.command("autocmd! * <buffer>")
+        if vim.eval("has('timers')")=='1':
+            vim.command("autocmd TextChanged,TextChangedI <buffer> call UBSchedulePreviewUpdate(%d)" % ub_get_option('ub_preview_delay'))
+        else:
+            vim.command("autocmd CursorHold,CursorHoldI,BufWritePost <buffer> call UBUpdatePreviewIfChanged()")
+        vim.command("autocmd BufWipeout <buffer> py UBPreviewServer.remove(int(vim.eval('expand(\"<abuf>\")')))")
+        vim.command("augroup END")
+
+    def _previewRemote(self, postId):
+        '''Open the preview URL of the post which has been sent
+        '''
+        if self.itemType == 'page':
+            prv_url = "%s?page_id=%s&preview=true"
+        else:
+            prv_url = "%s?p=%s&preview=true"
+        self._show(prv_url % (db.cfg.url, postId))
+
+    def _show(self, prv_url):
+        '''Open the given URL in the previewer or the web browser
+        '''
         use_ubviewer = ub_get_option('ub_use_ubviewer')
         if use_ubviewer is True:
             if is_in_console():
                 ub_echoerr(_('You are currently in console and no graphical environment is available !'))
                 return
-            if ubviewer is None:
-                ub_echoerr(_("pywebkitgtk is missing or you have not restarted Vim after installation of this module !"))
-            else:
-                ubviewer.open(prv_url, ub_get_option('ub_viewer_width'), ub_get_option('ub_viewer_height'))
+            error = UBViewerClient.takeError()
+            if error is not None: ub_echoerr(str(error))
+            if UBViewerClient.failed:
+                webbrowser.open(prv_url)
+                return
+            UBViewerClient.python = ub_get_option('ub_viewer_python')
+            UBViewerClient.send('open', url=prv_url,
+                width=ub_get_option('ub_viewer_width'), height=ub_get_option('ub_viewer_height'))
         else:
             webbrowser.open(prv_url)
 
@@ -950,9 +1652,9 @@ class UBCmdDelete(UBCommand):
             else:
                 if self.scope=='remote':
                     if self.itemType=='page':
-                        api.wp.deletePage('', cfg.loginName, cfg.password, self.itemKey)
+                        db.api.wp.deletePage('', db.cfg.loginName, db.cfg.password, self.itemKey)
                     else:
-                        api.metaWeblog.deletePost('', self.itemKey, cfg.loginName, cfg.password)
+                        db.api.metaWeblog.deletePost('', self.itemKey, db.cfg.loginName, db.cfg.password)
                     UBEventQueue.fireEvent(UBRemotePostDelEvent(self.itemKey))
                 else:
                     self.sess.query(Post).filter(Post.type==self.itemType).filter(Post.id==self.itemKey).delete()
@@ -1015,6 +1717,199 @@ class UBCmdDelItemUnderCursor(UBCommand):
         if ub_is_id(self.postId, True):
             ub_del_item(self.itemType, self.postId, 'remote')
 
+class UBCmdRange(UBCommand):
+    ''' Abstract parent class for commands on a range of posts/pages in a list view
+    '''
+    def __init__(self, line1, line2):
+        UBCommand.__init__(self)
+        self.viewScopes = ['post_list', 'page_list', 'result_list']
+
+        # Pairs of local ID and remote ID, 0 stands for no copy
+        self.items = []
+        for line in vim.current.buffer[max(int(line1),2)-1:int(line2)]:
+            parts = line.split()
+            if len(parts)>=3 and parts[0].isdigit() and parts[1].isdigit():
+                self.items.append((int(parts[0]), int(parts[1])))
+
+        ids = [id for id, postId in self.items if id>0]
+        self.types = {}
+        for i in range(0, len(ids), 500):
+            self.types.update(self.sess.query(Post.id, Post.type).filter(Post.id.in_(ids[i:i+500])).all())
+
+    def _preExec(self):
+        UBCmdRange.doDefault()
+        if len(self.items)==0: raise UBException(_('This is not an item !'))
+
+    def getType(self, id):
+        ''' Return the type of the item, which is the same as the view if it has no local copy
+        '''
+        return self.types.get(id, self.itemType)
+
+    def confirm(self, msg):
+        choice = vim.eval("confirm('%s', '&Yes\n&No')" % msg.replace("'", "''"))
+        return choice == '1'
+
+class UBCmdDelRange(UBCmdRange):
+    ''' Delete the posts/pages in a range of lines, remote copies are deleted
+    by system.multicall requests
+    '''
+    def _preExec(self):
+        UBCmdDelRange.doDefault()
+        self.localIds = [id for id, postId in self.items if id>0]
+        self.remoteItems = [(postId, self.getType(id)) for id, postId in self.items if postId>0]
+
+        if len(self.localIds)>0 and not self.confirm(_('Are you sure to delete %d local items ?') % len(self.localIds)):
+            self.localIds = []
+        if len(self.remoteItems)>0 and not self.confirm(_('Are you sure to delete %d remote items ?') % len(self.remoteItems)):
+            self.remoteItems = []
+        if len(self.localIds)==0 and len(self.remoteItems)==0:
+            raise UBException(_('Deletion canceled !'))
+
+    def _exec(self):
+        if len(self.localIds)>0:
+            for i in range(0, len(self.localIds), 500):
+                self.sess.query(Post).filter(Post.id.in_(self.localIds[i:i+500])).delete(synchronize_session=False)
+            self.sess.commit()
+            for id in self.localIds:
+                UBEventQueue.fireEvent(UBLocalPostDelEvent(id))
+            UBEventQueue.processEvents()
+            ub_echo(_('%d local items were deleted !') % len(self.localIds))
+
+        if len(self.remoteItems)>0:
+            ub_call_api(_('Deleting %d remote items') % len(self.remoteItems), UBCmdDelRange.deleteRemote,
+                (db.cfg.xmlrpc, self.remoteItems, db.cfg.loginName, db.cfg.password), self._onRemoteDeleted)
+
+    @staticmethod
+    def deleteRemote(api, xmlrpc, items, loginName, password):
+        batch = UBBatch(api, xmlrpc)
+        for postId, itemType in items:
+            if itemType=='page':
+                batch.add('wp.deletePage', '', loginName, password, postId)
+            else:
+                batch.add('metaWeblog.deletePost', '', postId, loginName, password)
+        return batch.run()
+
+    def _onRemoteDeleted(self, results):
+        faults = []
+        for (postId, itemType), (result, fault) in zip(self.remoteItems, results):
+            if fault is None:
+                UBEventQueue.fireEvent(UBRemotePostDelEvent(postId))
+            else:
+                faults.append((postId, fault))
+        UBEventQueue.processEvents()
+
+        if len(faults)>0:
+            raise UBException(_('%d of %d remote items were deleted, failed to delete %s: %s') % (len(self.remoteItems)-len(faults),
+                len(self.remoteItems), faults[0][0], ub_get_error_message(faults[0][1])))
+        ub_echo(_('%d remote items were deleted !') % len(self.remoteItems))
+
+class UBCmdOpenRange(UBCmdRange):
+    ''' Open the posts/pages in a range of lines in new tabs, remote items
+    which are not in the database are fetched by system.multicall requests
+    '''
+    def _exec(self):
+        fetches = []
+        for id, postId in self.items:
+            if self.scope=='local' or id>0:
+                self._openTab(self.getType(id), id, 'local')
+            else:
+                fetches.append((postId, self.getType(id)))
+
+        if len(fetches)>0:
+            ub_call_api(_('Fetching %d remote items') % len(fetches), UBCmdOpenRange.fetchRemote,
+                (db.cfg.xmlrpc, fetches, db.cfg.loginName, db.cfg.password), lambda results: self._onFetched(fetches, results))
+
+    @staticmethod
+    def fetchRemote(api, xmlrpc, items, loginName, password):
+        batch = UBBatch(api, xmlrpc)
+        for postId, itemType in items:
+            if itemType=='page':
+                batch.add('wp.getPage', '', postId, loginName, password)
+            else:
+                batch.add('metaWeblog.getPost', postId, loginName, password)
+        return batch.run()
+
+    def _onFetched(self, items, results):
+        faults = []
+        for (postId, itemType), (result, fault) in zip(items, results):
+            if fault is None:
+                self._openTab(itemType, postId, 'remote', result)
+            else:
+                faults.append((postId, fault))
+
+        if len(faults)>0:
+            raise UBException(_('Failed to open %d remote items, %s: %s') % (len(faults), faults[0][0], ub_get_error_message(faults[0][1])))
+
+    def _openTab(self, itemType, itemKey, scope, remoteItem=None):
+        cmd = UBCmdOpen(itemKey=itemKey, itemType=itemType, scope=scope, viewType='tab', remoteItem=remoteItem)
+        cmd.execute()
+
+class UBCmdSendRange(UBCmdRange):
+    ''' Send the local posts/pages in a range of lines to the blog
+    by system.multicall requests
+    '''
+    def __init__(self, line1, line2, status=None):
+        UBCmdRange.__init__(self, line1, line2)
+        self.viewScopes = ['local_post_list', 'local_page_list', 'result_list']
+        self.status = status
+
+    def _preExec(self):
+        UBCmdSendRange.doDefault()
+        if self.status is not None: ub_check_status(self.status)
+
+    def _exec(self):
+        ids = [id for id, postId in self.items if id>0]
+        posts = []
+        for i in range(0, len(ids), 500):
+            posts.extend(self.sess.query(Post).options(undefer('content')).filter(Post.id.in_(ids[i:i+500])).all())
+        # Items without local copies cannot be sent, nor is the blog asked anything for nothing
+        if len(posts)==0: raise UBException(_('No items in range !'))
+
+        self.posts = []
+        calls = []
+        for post in posts:
+            status = self.status is not None and self.status or post.status
+            html = ub_convert_str((post.content or u'').encode(self.enc), post.syntax, 'html', self.enc).decode(self.enc)
+            if post.type=='page':
+                item = dict(title=post.title, description=html, wp_slug=post.slug, post_type='page', page_status=status)
+            else:
+                item = dict(title=post.title, description=html, wp_slug=post.slug, post_type='post', post_status=status,
+                    categories=[cat.strip() for cat in (post.categories or '').split(',')], mt_keywords=post.tags)
+            self.posts.append((post.id, post.post_id, status))
+            calls.append((post.post_id, item, ub_check_status(status)))
+
+        ub_call_api(_('Sending %d items') % len(calls), UBCmdSendRange.sendRemote,
+            (db.cfg.xmlrpc, calls, db.cfg.loginName, db.cfg.password), self._onSent)
+
+    @staticmethod
+    def sendRemote(api, xmlrpc, calls, loginName, password):
+        batch = UBBatch(api, xmlrpc)
+        for postId, item, publish in calls:
+            if postId is None:
+                batch.add('metaWeblog.newPost', '', loginName, password, item, publish)
+            else:
+                batch.add('metaWeblog.editPost', postId, loginName, password, item, publish)
+        return batch.run()
+
+    def _onSent(self, results):
+        faults = []
+        for (id, postId, status), (result, fault) in zip(self.posts, results):
+            if fault is not None:
+                faults.append((id, fault))
+                continue
+            if postId is None: postId = int(result)
+            self.sess.query(Post).filter(Post.id==id).update({Post.post_id:postId, Post.status:status, Post.dirty:0})
+            UBEventQueue.fireEvent(UBPostSendEvent(postId))
+            UBEventQueue.fireEvent(UBPostSaveEvent(id))
+        self.sess.commit()
+        self.sess.close()
+        UBEventQueue.processEvents()
+
+        if len(faults)>0:
+            raise UBException(_('%d of %d items were sent, failed to send %s: %s') % (len(self.posts)-len(faults),
+                len(self.posts), faults[0][0], ub_get_error_message(faults[0][1])))
+        ub_echo(_('%d items were sent !') % len(self.posts))
+
 class UBCmdBlogThis(UBCommand):
     def __init__(self, itemType='post', toSyntax=None, fromSyntax=None):
         UBCommand.__init__(self, True)
@@ -1052,6 +1947,179 @@ class UBCmdConvert(UBCommand):
         ub_set_content(content.split("\n"))
         vim.command('setl filetype=%s' % self.toSyntax)
 
+class UBCmdSync(UBCommand):
+    ''' Synchronize posts/pages from the blog to the database.
+
+    Items are fetched by wp.getPosts in batches, from the latest modified to
+    the earliest, until the watermark left by the last finished run is
+    reached, so that only what has changed since then is transferred. Each
+    batch is stored along with the progress in one transaction, an
+    interrupted run is resumed by the next :UBSync.
+
+    Items which have been edited in another syntax than HTML keep their
+    source, only their statuses are updated. Items which have been changed
+    locally since they were last sent or synchronized are left alone and
+    reported as conflicts. A run which fetches everything removes the copies
+    of items which are no longer on the blog.
+    '''
+    isRunning = False
+
+    def __init__(self, full=False, itemType=None):
+        UBCommand.__init__(self)
+        self.full = full
+        self.itemType = itemType
+        self.types = itemType is not None and [itemType] or ['post', 'page']
+        self.batchSize = ub_get_option('ub_sync_batchsize')
+        self.state = None
+        self.count = 0
+        self.conflicts = []
+        self.pruned = 0
+        # post_ids of the items seen by a run which fetches everything, None otherwise
+        self.seen = None
+        # post_ids of the items stored by this run, of the current type
+        self.stored = set()
+
+    def _preExec(self):
+        UBCmdSync.doDefault()
+        if self.itemType not in ['post', 'page', None]:
+            raise UBException(_('Only posts and pages can be synchronized !'))
+        if UBCmdSync.isRunning: raise UBException(_('Synchronization is in progress !'))
+
+    def _exec(self):
+        UBCmdSync.isRunning = True
+        try:
+            if ub_is_async():
+                self._fetchNext()
+            else:
+                while self._fetchNext(): pass
+        except:
+            UBCmdSync.isRunning = False
+            raise
+
+    def _fetchNext(self):
+        '''Request the next batch, return False if all types are done
+        '''
+        if self.state is None:
+            if len(self.types)==0:
+                self._finish()
+                return False
+            self.state = self._loadState(self.types.pop(0))
+
+        flt = dict(post_type=self.state.type, number=self.batchSize, offset=self.state.run_offset,
+            orderby='modified', order='DESC')
+        fields = ['post_id', 'post_title', 'post_content', 'post_status', 'post_name', 'post_modified_gmt', 'terms']
+        ub_call_api(_('Synchronizing %ss (%d)') % (self.state.type, self.count), 'wp.getPosts',
+            ('', db.cfg.loginName, db.cfg.password, flt, fields), self._onBatch, self._onError)
+        return True
+
+    def _loadState(self, itemType):
+        state = self.sess.query(SyncState).filter(SyncState.blog==db.cfg.xmlrpc).filter(SyncState.type==itemType).first()
+        if state is None:
+            state = SyncState()
+            state.blog = db.cfg.xmlrpc
+            state.type = itemType
+            state.run_offset = 0
+        if self.full:
+            state.watermark = None
+            state.run_offset = 0
+            state.run_watermark = None
+        self.seen = None
+        if state.watermark is None and state.run_offset==0: self.seen = set()
+        self.stored = set()
+        return state
+
+    def _onBatch(self, items):
+        '''Store a batch of items and the progress in one transaction
+        '''
+        state = self.state
+        # Times are kept to the second, items modified in the same second as
+        # the watermark may have changed after the last run, so they are taken again
+        fresh = [item for item in items if state.watermark is None or str(item['post_modified_gmt'])>=state.watermark]
+        # Done if the last page or the watermark has been reached
+        isDone = len(items)<self.batchSize or len(fresh)<len(items)
+        # Items shift to the next page and come again when others are modified during the run
+        fresh = [item for item in fresh if int(item['post_id']) not in self.stored]
+        self.stored.update([int(item['post_id']) for item in fresh])
+        if len(fresh)>0:
+            self._upsert(state.type, fresh)
+            latest = max([str(item['post_modified_gmt']) for item in fresh])
+            if state.run_watermark is None or latest>state.run_watermark: state.run_watermark = latest
+        state.run_offset += len(items)
+        if self.seen is not None: self.seen.update([int(item['post_id']) for item in items])
+
+        if isDone:
+            if self.seen is not None: self._prune(state.type)
+            if state.run_watermark is not None: state.watermark = state.run_watermark
+            state.run_offset = 0
+            state.run_watermark = None
+            self.state = None
+        self.sess.add(state)
+        self.sess.commit()
+        self.count += len(fresh)
+
+        if ub_is_async(): self._fetchNext()
+
+    def _upsert(self, itemType, items):
+        ids = [int(item['post_id']) for item in items]
+        posts = self.sess.query(Post).filter(Post.type==itemType).filter(Post.post_id.in_(ids)).all()
+        existing = dict([(post.post_id, post) for post in posts])
+
+        for item in items:
+            post = existing.get(int(item['post_id']))
+            if post is not None and post.dirty:
+                self.conflicts.append(post.id)
+                continue
+            if post is None:
+                post = Post()
+                post.type = itemType
+                post.post_id = int(item['post_id'])
+                post.syntax = 'html'
+            post.status = item['post_status']
+            # Keep the source of items written in other syntaxes
+            if post.syntax=='html':
+                terms = item.get('terms', [])
+                post.title = item['post_title']
+                post.content = item['post_content']
+                post.slug = item['post_name']
+                if itemType=='post':
+                    post.categories = ', '.join([term['name'] for term in terms if term['taxonomy']=='category'])
+                    post.tags = ', '.join([term['name'] for term in terms if term['taxonomy']=='post_tag'])
+            self.sess.add(post)
+
+    def _prune(self, itemType):
+        '''Remove the copies of items which were not seen by a run fetching
+        everything, i.e. which have been deleted from the blog. Those changed
+        locally are kept as drafts.
+        '''
+        rows = self.sess.query(Post.id, Post.post_id, Post.dirty).filter(Post.type==itemType).filter(Post.post_id>0).all()
+        gone = [row for row in rows if row.post_id not in self.seen]
+        deleted = [row.id for row in gone if not row.dirty]
+        kept = [row.id for row in gone if row.dirty]
+        for i in range(0, len(deleted), 500):
+            self.sess.query(Post).filter(Post.id.in_(deleted[i:i+500])).delete(synchronize_session=False)
+        for i in range(0, len(kept), 500):
+            self.sess.query(Post).filter(Post.id.in_(kept[i:i+500])).update({Post.post_id:None}, synchronize_session=False)
+        self.pruned += len(deleted)
+
+    def _onError(self, error):
+        '''The progress of finished batches is kept for the next run
+        '''
+        UBCmdSync.isRunning = False
+        self.sess.rollback()
+        raise error
+
+    def _finish(self):
+        UBCmdSync.isRunning = False
+        self.sess.close()
+        UBEventQueue.fireEvent(UBSyncCompleteEvent(self.count))
+        UBEventQueue.processEvents()
+        if self.pruned>0:
+            ub_echo(_('%d items deleted from the blog have been removed !') % self.pruned)
+        if len(self.conflicts)>0:
+            ub_echo(_('%d items were changed locally and have not been overwritten, send them or '
+                'delete them to take the ones on the blog: %s') % (len(self.conflicts), ', '.join([str(id) for id in self.conflicts])))
+        ub_echo(_('%d items synchronized !') % (self.count-len(self.conflicts)))
+
 class UBCmdRefresh(UBCommand):
     def __init__(self):
         UBCommand.__init__(self)
@@ -1066,7 +2134,8 @@ class UBCmdRefresh(UBCommand):
         elif ub_is_view_of_type('list'):
             psize = ub_get_bufvar('page_size')
             pno = ub_get_bufvar('page_no')
-            ub_list_items(self.itemType, self.scope, psize, pno)
+            cursor = ub_get_bufvar('ub_cursor')
+            ub_list_items(self.itemType, self.scope, psize, pno, cursor)
         elif ub_is_view_of_type('edit'):
             itemKey = self.itemType=='tmpl' and ub_get_meta('name') or ub_get_meta('id')
             if itemKey is not None:
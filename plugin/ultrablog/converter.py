@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+import subprocess, threading, socket, time, os, json, urllib2
+
+class UBConverterPool:
+    ''' Run the external converter, e.g. pandoc, without paying the start of a
+    process for every conversion. If the converter is pandoc and server mode
+    is enabled, conversions are posted to a long-lived "pandoc server" on
+    localhost. Otherwise a spare process is started ahead of time for each
+    command, so that the next conversion finds one warmed up. Processes which
+    have died are restarted, at most size conversions run at the same time.
+    '''
+    size = 2
+    semaphore = threading.BoundedSemaphore(2)
+    lock = threading.Lock()
+    spares = {}
+    server = None
+    port = None
+    # Set if the server cannot be started, spare processes are used instead
+    serverFailed = False
+
+    @classmethod
+    def configure(cls, size):
+        if size != cls.size:
+            cls.size = size
+            cls.semaphore = threading.BoundedSemaphore(size)
+
+    @classmethod
+    def convert(cls, cmd_parts, content, from_syntax, to_syntax, encoding=None, use_server=False):
+        semaphore = cls.semaphore
+        semaphore.acquire()
+        try:
+            if use_server and not cls.serverFailed \
+                    and os.path.basename(cmd_parts[0]).startswith('pandoc'):
+                new_content = cls.__convertByServer(cmd_parts, content, from_syntax, to_syntax, encoding or 'utf-8')
+                if new_content is not None: return new_content
+            return cls.__convertByProcess(cmd_parts, content)
+        finally:
+            semaphore.release()
+
+    @classmethod
+    def shutdown(cls):
+        ''' Stop the server and the spare processes, called when Vim exits
+        '''
+        cls.lock.acquire()
+        try:
+            procs = [proc for procs in cls.spares.values() for proc in procs]
+            cls.spares.clear()
+            if cls.server is not None: procs.append(cls.server)
+            cls.server = None
+        finally:
+            cls.lock.release()
+        for proc in procs:
+            try:
+                proc.kill()
+                proc.wait()
+            except OSError:
+                pass
+
+    @classmethod
+    def __convertByProcess(cls, cmd_parts, content):
+        for i in (0, 1):
+            proc = cls.__takeProcess(cmd_parts)
+            try:
+                return proc.communicate(content)[0].replace("\r\n", "\n")
+            except (OSError, IOError):
+                # The spare died while waiting, retry with a fresh one
+                if i: raise
+
+    @classmethod
+    def __takeProcess(cls, cmd_parts):
+        key = tuple(cmd_parts)
+        proc = None
+        cls.lock.acquire()
+        try:
+            spares = cls.spares.setdefault(key, [])
+            while len(spares)>0 and proc is None:
+                proc = spares.pop()
+                if proc.poll() is not None: proc = None
+        finally:
+            cls.lock.release()
+        if proc is None: proc = cls.__spawn(cmd_parts)
+
+        # Warm up a process for the next conversion
+        spare = cls.__spawn(cmd_parts)
+        cls.lock.acquire()
+        try:
+            cls.spares.setdefault(key, []).append(spare)
+        finally:
+            cls.lock.release()
+        return proc
+
+    @classmethod
+    def __spawn(cls, cmd_parts):
+        return subprocess.Popen(cmd_parts, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    @classmethod
+    def __convertByServer(cls, cmd_parts, content, from_syntax, to_syntax, encoding):
+        ''' Post the content to pandoc server, return None if it is unavailable
+        '''
+        params = dict(text=content.decode(encoding), to=to_syntax)
+        params['from'] = from_syntax
+        # Options of the command line are mapped to fields of the request,
+        # e.g. --reference-links to "reference-links": true
+        for opt in cmd_parts[1:]:
+            if not opt.startswith('--') or opt.startswith('--from=') or opt.startswith('--to='): continue
+            name, sep, value = opt[2:].partition('=')
+            params[name] = sep and value or True
+        body = json.dumps(params)
+
+        for i in (0, 1):
+            port = cls.__startServer(cmd_parts[0], i==1)
+            if port is None: return None
+            req = urllib2.Request('http://127.0.0.1:%d/' % port, body,
+                {'Content-Type':'application/json', 'Accept':'text/plain'})
+            try:
+                new_content = urllib2.urlopen(req).read().decode('utf-8').encode(encoding)
+                return new_content.replace("\r\n", "\n")
+            except urllib2.HTTPError:
+                # The server is alive but refused the options, let the command line handle them
+                return None
+            except (urllib2.URLError, socket.error):
+                if i: return None
+
+    @classmethod
+    def __startServer(cls, command, restart=False):
+        cls.lock.acquire()
+        try:
+            if cls.server is not None and not restart and cls.server.poll() is None:
+                return cls.port
+            if cls.server is not None:
+                try:
+                    cls.server.kill()
+                except OSError:
+                    pass
+                cls.server = None
+
+            sock = socket.socket()
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+            sock.close()
+            try:
+                devnull = open(os.devnull, 'w')
+                server = subprocess.Popen([command, 'server', '--port', str(port)],
+                    stdin=subprocess.PIPE, stdout=devnull, stderr=devnull)
+            except OSError:
+                cls.serverFailed = True
+                return None
+
+            # Wait for the server to listen
+            for i in range(50):
+                if server.poll() is not None: break
+                try:
+                    socket.create_connection(('127.0.0.1', port), 0.1).close()
+                    cls.server, cls.port = server, port
+                    return port
+                except socket.error:
+                    time.sleep(0.1)
+            if server.poll() is None: server.kill()
+            cls.serverFailed = True
+            return None
+        finally:
+            cls.lock.release()
+
+if __name__ == '__main__':
+    pass
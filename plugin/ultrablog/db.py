@@ -1,14 +1,17 @@
 #!/usr/bin/env python
 
-import xmlrpclib,socket
+import xmlrpclib,socket,time
 import util as u
+from transport import UBTransport
+from cache import UBRenderCache
+from profiler import UBProfiler
 
 try:
     import sqlalchemy
-    from sqlalchemy import Table, Column, Integer, Text, String
+    from sqlalchemy import Table, Column, Integer, Float, Text, String, LargeBinary, Index, event
     from sqlalchemy.ext.declarative import declarative_base
-    from sqlalchemy.orm import sessionmaker
-    from sqlalchemy.sql import union_all,select,case,and_,or_,not_
+    from sqlalchemy.orm import sessionmaker, deferred, undefer
+    from sqlalchemy.sql import union_all,select,case,and_,or_,not_,text,literal,func
     from sqlalchemy.exc import OperationalError
 
     Base = declarative_base()
@@ -30,11 +33,14 @@ try:
         title = Column('title', String(256))
         categories = Column('categories', Text)
         tags = Column('tags', Text)
-        content = Column('content', Text)
+        # Loaded when it is first accessed, lists and meta data do not need it
+        content = deferred(Column('content', Text))
         slug = Column('slug', Text)
         syntax = Column('syntax', String(64), nullable=False, default='markdown')
         type = Column('type', String(32), nullable=False, default='post')
         status = Column('status', String(32), nullable=False, default='draft')
+        # 1 if it has been changed locally since it was last sent or synchronized
+        dirty = Column('dirty', Integer, nullable=False, default=0)
 
         def getKey(self, encoding=None):
             return self.id
@@ -56,6 +62,12 @@ try:
             if self.type=='page': del meta['categories'], meta['tags']
             return meta
 
+    # Indexes for paging post/page lists by keyset cursors
+    Index('idx_post_type_post_id', Post.__table__.c.type, Post.__table__.c.post_id)
+    Index('idx_post_type_id', Post.__table__.c.type, Post.__table__.c.id)
+    # Index for looking up local copies of remote posts of any type
+    Index('idx_post_post_id', Post.__table__.c.post_id)
+
     class Template(Base,Item):
         __tablename__ = 'template'
 
@@ -76,31 +88,210 @@ try:
                 name = self.name is not None and self._encode(self.name, encoding) or '',
                 description = self.description is not None and self._encode(self.description, encoding) or '')
 
+    class SyncState(Base):
+        '''Progress of synchronizing posts/pages of a blog to the database
+        '''
+        __tablename__ = 'sync_state'
+
+        blog = Column('blog', String(256), primary_key=True)
+        type = Column('type', String(32), primary_key=True)
+        # Last modified date of the last finished run
+        watermark = Column('watermark', String(32))
+        # Progress of the unfinished run, if any
+        run_offset = Column('run_offset', Integer, nullable=False, default=0)
+        run_watermark = Column('run_watermark', String(32))
+
+    class RenderCache(Base):
+        '''Persistent tier of UBRenderCache
+        '''
+        __tablename__ = 'render_cache'
+
+        key = Column('key', String(40), primary_key=True)
+        value = Column('value', LargeBinary, nullable=False)
+        size = Column('size', Integer, nullable=False)
+        accessed = Column('accessed', Float, nullable=False)
+
+    Index('idx_render_cache_accessed', RenderCache.__table__.c.accessed)
+
+    class Media(Base):
+        '''Files uploaded to blogs, by which uploading the same file again is skipped
+        '''
+        __tablename__ = 'media'
+
+        id = Column('id', Integer, primary_key=True)
+        blog = Column('blog', String(256), nullable=False)
+        # SHA-256 of the content of the file, in hex
+        hash = Column('hash', String(64), nullable=False)
+        size = Column('size', Integer, nullable=False)
+        type = Column('type', String(128), nullable=False, default='')
+        name = Column('name', String(256))
+        url = Column('url', Text, nullable=False)
+        # The struct returned by metaWeblog.newMediaObject, in JSON
+        result = Column('result', Text, nullable=False)
+        uploaded = Column('uploaded', Float, nullable=False)
+
+    class Term(Base):
+        '''Categories and tags of blogs, which are completed in meta data
+        '''
+        __tablename__ = 'term'
+
+        blog = Column('blog', String(256), primary_key=True)
+        # "category" or "tag"
+        taxonomy = Column('taxonomy', String(32), primary_key=True)
+        name = Column('name', String(256), primary_key=True)
+        fetched = Column('fetched', Float, nullable=False)
+
+    Index('idx_media_blog_hash', Media.__table__.c.blog, Media.__table__.c.hash,
+        Media.__table__.c.size, Media.__table__.c.type, unique=True)
+
 except ImportError, e:
     sqlalchemy = None
     Base = None
     Session = None
     Post = None
     Template = None
+    SyncState = None
+    RenderCache = None
+    Media = None
+    Term = None
 except:pass
 
+def ub_migrate_base(conn):
+    '''Create the tables of 3.6.1 and add columns which older versions lack
+    '''
+    Post.__table__.create(conn, checkfirst=True)
+    Template.__table__.create(conn, checkfirst=True)
+
+    columns = [row[1] for row in conn.execute("pragma table_info(post)")]
+    if 'type' not in columns:
+        conn.execute("alter table post add type varchar(32) not null default 'post'")
+    if 'status' not in columns:
+        conn.execute("alter table post add status varchar(32) not null default 'draft'")
+
+def ub_migrate_post_indexes(conn):
+    conn.execute("create index if not exists idx_post_type_post_id on post (type, post_id)")
+    conn.execute("create index if not exists idx_post_type_id on post (type, id)")
+
+def ub_migrate_sync_state(conn):
+    SyncState.__table__.create(conn, checkfirst=True)
+
+def ub_migrate_render_cache(conn):
+    RenderCache.__table__.create(conn, checkfirst=True)
+
+def ub_migrate_media(conn):
+    Media.__table__.create(conn, checkfirst=True)
+
+def ub_migrate_terms(conn):
+    Term.__table__.create(conn, checkfirst=True)
+
+def ub_migrate_post_id_index(conn):
+    conn.execute("create index if not exists idx_post_post_id on post (post_id)")
+
+def ub_migrate_post_dirty(conn):
+    columns = [row[1] for row in conn.execute("pragma table_info(post)")]
+    if 'dirty' not in columns:
+        conn.execute("alter table post add dirty integer not null default 0")
+
+# Schema migrations, the schema version of a database is the number of
+# migrations applied to it, which is kept in PRAGMA user_version.
+# Append new migrations to the end, never reorder or remove them.
+migrations = [
+    ub_migrate_base,
+    ub_migrate_post_indexes,
+    ub_migrate_sync_state,
+    ub_migrate_render_cache,
+    ub_migrate_media,
+    ub_migrate_terms,
+    ub_migrate_post_id_index,
+    ub_migrate_post_dirty,
+]
+
 def ub_upgrade(db):
+    '''Apply pending migrations in one transaction,
+    nothing but reading the schema version is done if the database is current
+    '''
+    conn = db.connect()
+    try:
+        if conn.execute("pragma user_version").scalar() >= len(migrations): return
+
+        # pysqlite commits implicitly before DDL statements, take over the
+        # transaction from it so that a failed migration leaves nothing behind
+        dbapi = conn.connection.connection
+        isolation = dbapi.isolation_level
+        dbapi.isolation_level = None
+        trans = conn.begin()
+        try:
+            conn.execute("begin immediate")
+            # Another Vim may have upgraded the database in the meantime
+            version = conn.execute("pragma user_version").scalar()
+            for migrate in migrations[version:]:
+                migrate(conn)
+            conn.execute("pragma user_version = %d" % len(migrations))
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        finally:
+            dbapi.isolation_level = isolation
+    finally:
+        conn.close()
+
+def ub_init_fts(db):
+    '''Create the FTS5 index of posts and the triggers which keep it in sync,
+    return the name of its tokenizer, or False if the SQLite library has no
+    FTS5 support
+
+    The index is tokenized into trigrams if SQLite supports it (3.34.0+), so
+    that keywords match substrings, as they do when all posts are scanned,
+    and text without spaces between words, e.g. CJK, is searchable as well.
+    '''
+    triggers = ['post_fts_ai', 'post_fts_ad', 'post_fts_au']
     conn = db.connect()
-    stmt = select([Post.type]).limit(1)
     try:
-        conn.execute(stmt)
+        conn.execute("create virtual table temp.ub_fts_probe using fts5(x)")
+        conn.execute("drop table temp.ub_fts_probe")
     except OperationalError:
-        sql = "alter table post add type varchar(32) not null default 'post'"
-        conn.execute(sql)
+        # Without FTS5 the triggers would break every write to the post table
+        for trigger in triggers:
+            conn.execute("drop trigger if exists %s" % trigger)
+        conn.close()
+        return False
 
-    stmt = select([Post.status]).limit(1)
+    tokenizer = 'unicode61'
     try:
-        conn.execute(stmt)
+        conn.execute("create virtual table temp.ub_fts_probe using fts5(x, tokenize='trigram')")
+        conn.execute("drop table temp.ub_fts_probe")
+        tokenizer = 'trigram'
     except OperationalError:
-        sql = "alter table post add status varchar(32) not null default 'draft'"
-        conn.execute(sql)
+        pass
+
+    # Rebuild an index made with another tokenizer, e.g. before SQLite was upgraded
+    sql = conn.execute("select sql from sqlite_master where type='table' and name='post_fts'").scalar()
+    if sql is not None and ('trigram' in sql) != (tokenizer=='trigram'):
+        for trigger in triggers:
+            conn.execute("drop trigger if exists %s" % trigger)
+        conn.execute("drop table post_fts")
+
+    rslt = conn.execute("select count(*) from sqlite_master where type='trigger' and name like 'post_fts_%'")
+    if rslt.fetchone()[0] < len(triggers):
+        conn.execute("create virtual table if not exists post_fts using fts5("
+            "title, content, categories, tags, content='post', content_rowid='id', tokenize='%s')" % tokenizer)
+        conn.execute("create trigger if not exists post_fts_ai after insert on post begin "
+            "insert into post_fts(rowid,title,content,categories,tags) "
+            "values (new.id,new.title,new.content,new.categories,new.tags); end")
+        conn.execute("create trigger if not exists post_fts_ad after delete on post begin "
+            "insert into post_fts(post_fts,rowid,title,content,categories,tags) "
+            "values ('delete',old.id,old.title,old.content,old.categories,old.tags); end")
+        conn.execute("create trigger if not exists post_fts_au after update of title,content,categories,tags on post begin "
+            "insert into post_fts(post_fts,rowid,title,content,categories,tags) "
+            "values ('delete',old.id,old.title,old.content,old.categories,old.tags); "
+            "insert into post_fts(rowid,title,content,categories,tags) "
+            "values (new.id,new.title,new.content,new.categories,new.tags); end")
+        # Index posts which were written while the triggers were missing
+        conn.execute("insert into post_fts(post_fts) values ('rebuild')")
 
     conn.close()
+    return tokenizer
 
 def ub_init_template():
     sess = Session()
@@ -170,29 +361,134 @@ def ub_set_mode(db):
     editor_mode = u.ub_get_option('ub_editor_mode')
     if '1' == editor_mode:
         Session.configure(bind=db)
-        Base.metadata.create_all(db)
+        ub_upgrade(db)
         ub_init_template()
 
-cfg = None
-try:
-    cfg = u.ub_get_blog_settings()
-except KeyError,e:
-    msg = _('Missing key %s in the settings list of UltraBlog.vim !') % str(e)
-    u.ub_echoerr(msg)
-except:
-    pass
+def ub_new_api():
+    '''Create a proxy of the blog API, proxies must not be shared between threads
+    '''
+    secure = cfg.xmlrpc.lower().startswith('https://')
+    return xmlrpclib.ServerProxy(cfg.xmlrpc, transport=UBTransport(secure))
 
-try:
-    socket.setdefaulttimeout(u.ub_get_option('ub_socket_timeout'))
-    api = xmlrpclib.ServerProxy(cfg.xmlrpc)
-    dbe = sqlalchemy.create_engine("sqlite:///%s" % cfg.dbf)
-    dbe.echo = u.ub_get_option('ub_debug')
-
-    Session.configure(bind=dbe)
-    Base.metadata.create_all(dbe)
-
-    ub_upgrade(dbe)
-    ub_init_template()
-except:
-    api = None
-    dbe  = None
+def ub_get_templates(name_only=False):
+    ''' Fetch and return a list of templates
+    '''
+    tmpls = []
+
+    try:
+        ub_bootstrap()
+        sess = Session()
+        tmpls = sess.query(Template).all()
+        sess.close()
+
+        if name_only is True: tmpls = [tmpl.name for tmpl in tmpls]
+    except:
+        pass
+
+    return tmpls
+
+def ub_tune_engine(engine):
+    '''Apply the pragmas set by the ub_db_* options to every connection of the
+    engine. In WAL mode readers do not block the writer, e.g. another Vim on
+    the same database, and with synchronous=NORMAL only checkpoints are
+    synced instead of every transaction.
+    '''
+    pragmas = [
+        ('journal_mode', u.ub_get_option('ub_db_journal_mode')),
+        ('synchronous', u.ub_get_option('ub_db_synchronous')),
+        ('busy_timeout', u.ub_get_option('ub_db_busy_timeout')),
+        # Negative sizes are in KiB instead of pages
+        ('cache_size', -u.ub_get_option('ub_db_cache_size')),
+        ('mmap_size', u.ub_get_option('ub_db_mmap_size')*1024*1024),
+        ('temp_store', u.ub_get_option('ub_db_temp_store')),
+    ]
+
+    def __on_connect(dbapi_conn, conn_record):
+        cursor = dbapi_conn.cursor()
+        try:
+            for name, value in pragmas:
+                cursor.execute("pragma %s = %s" % (name, value))
+        finally:
+            cursor.close()
+
+    event.listen(engine, 'connect', __on_connect)
+
+def ub_close_db():
+    '''Let SQLite update its statistics and move the write-ahead log into the
+    database, called when Vim exits
+    '''
+    if dbe is None: return
+    conn = dbe.connect()
+    try:
+        conn.execute("pragma optimize")
+        if u.ub_get_option('ub_db_journal_mode') == 'wal':
+            conn.execute("pragma wal_checkpoint(truncate)")
+    except OperationalError:
+        # Most likely busy with another Vim, which will do it in its turn
+        pass
+    finally:
+        conn.close()
+    dbe.dispose()
+
+def ub_profile_stage(stage, func, *args):
+    '''Call func and record how long it takes in bootstrap_profile
+    '''
+    start = time.time()
+    try:
+        return func(*args)
+    finally:
+        bootstrap_profile.append((stage, time.time()-start))
+
+def ub_record_startup_stage(stage, seconds):
+    startup_profile.append((stage, seconds))
+
+def ub_bootstrap():
+    '''Load the settings, create the API proxy and set up the database.
+    This is done on first use of UltraBlog.vim instead of at every start of Vim,
+    and is retried until it succeeds.
+    '''
+    global cfg, api, dbe, fts
+    if dbe is not None: return
+    # Only the stages of the latest attempt are shown
+    del bootstrap_profile[:]
+
+    try:
+        cfg = ub_profile_stage('settings', u.ub_get_blog_settings)
+    except KeyError,e:
+        msg = _('Missing key %s in the settings list of UltraBlog.vim !') % str(e)
+        u.ub_echoerr(msg)
+        return
+    except:
+        return
+    if cfg is None: return
+
+    try:
+        socket.setdefaulttimeout(u.ub_get_option('ub_socket_timeout'))
+        if u.ub_get_option('ub_gzip_requests') is True: UBTransport.encode_threshold = 1024
+        api = ub_new_api()
+        engine = ub_profile_stage('engine', sqlalchemy.create_engine, "sqlite:///%s" % cfg.dbf)
+        engine.echo = u.ub_get_option('ub_debug')
+        ub_tune_engine(engine)
+        UBProfiler.resize(u.ub_get_option('ub_profile_size'))
+        UBProfiler.watchEngine(engine)
+
+        Session.configure(bind=engine)
+        ub_profile_stage('upgrade', ub_upgrade, engine)
+        ub_profile_stage('template', ub_init_template)
+        fts = ub_profile_stage('fts', ub_init_fts, engine)
+        if u.ub_get_option('ub_render_cache_persistent') is True:
+            UBRenderCache.disk_size = u.ub_get_option('ub_render_cache_disk_size')*1024
+            UBRenderCache.engine = engine
+        dbe = engine
+    except:
+        api = None
+        dbe = None
+
+cfg = None
+api = None
+dbe = None
+fts = False
+# Pairs of stage name and seconds taken, refer to :UBStartupProfile
+startup_profile = []
+# The same for the stages of the latest run of ub_bootstrap()
+bootstrap_profile = []
@@ -1,8 +1,33 @@
 #!/usr/bin/env python
 
+import vim, sys, time, inspect
+from profiler import UBProfiler
+
 class UBEventQueue:
+    ''' Events are dispatched first in first out, to the listeners registered
+    for the type of the event or any of its base types. Listeners ask for
+    views to be refreshed or marked outdated instead of doing it themselves,
+    these effects are collected while the queue drains and applied once for
+    each buffer, so that a view is refreshed at most once however many events
+    concern it. Time taken by each listener is recorded by UBProfiler, and
+    reported in debug mode. A listener which raises does not stop the drain,
+    the first error is raised once the queue is empty.
+    '''
     queue = []
     listeners = []
+    index = {}
+    isProcessing = False
+    isDebugging = False
+    timings = []
+    refreshes = []
+    outdated = []
+    # Buffers which have been refreshed in the current drain
+    refreshed = []
+    # sys.exc_info() of the first error raised by a listener in the current drain
+    error = None
+    # Called to apply the effects, set by whoever registers the listeners
+    refresher = None
+    outdater = None
 
     @classmethod
     def fireEvent(cls, evt):
@@ -10,15 +35,90 @@ class UBEventQueue:
 
     @classmethod
     def processEvents(cls):
-        while len(cls.queue)>0:
-            evt = cls.queue.pop()
-            for listener in cls.listeners:
-                if listener.isTarget(evt):
-                    listener.processEvent(evt)
+        if cls.isProcessing:
+            # Called by a listener, e.g. through ub_wise_open_view(), dispatch
+            # right away, but leave the effects to the outer call
+            cls.__dispatch()
+            return
+
+        cls.isProcessing = True
+        cls.isDebugging = cls.checkDebugging()
+        try:
+            while len(cls.queue)>0 or len(cls.refreshes)>0 or len(cls.outdated)>0:
+                cls.__dispatch()
+                cls.__applyEffects()
+        finally:
+            cls.isProcessing = False
+            # Events left by an error of applying the effects are dispatched next time
+            del cls.refreshes[:], cls.outdated[:], cls.refreshed[:]
+            timings, cls.timings = cls.timings, []
+            error, cls.error = cls.error, None
+        cls.__report(timings)
+        if error is not None: raise error[0], error[1], error[2]
 
     @classmethod
     def registerListener(cls, lsnr):
         cls.listeners.append(lsnr)
+        cls.index.clear()
+
+    @classmethod
+    def getListeners(cls, eventType):
+        ''' Return listeners of the given type of events, in registration order
+        '''
+        if not cls.index.has_key(eventType):
+            bases = inspect.getmro(eventType)
+            cls.index[eventType] = [l for l in cls.listeners if l.eventType in bases]
+        return cls.index[eventType]
+
+    @classmethod
+    def refreshView(cls, nr):
+        ''' Refresh the view in the given buffer after the queue has drained,
+        if it is still the current one, or mark it outdated otherwise
+        '''
+        if nr not in cls.refreshes and nr not in cls.refreshed: cls.refreshes.append(nr)
+
+    @classmethod
+    def outdateView(cls, nr):
+        ''' Mark the view in the given buffer outdated after the queue has drained
+        '''
+        if nr not in cls.outdated: cls.outdated.append(nr)
+
+    @classmethod
+    def checkDebugging(cls):
+        return vim.eval("exists('g:ub_debug') && g:ub_debug") == '1'
+
+    @classmethod
+    def __dispatch(cls):
+        while len(cls.queue)>0:
+            evt = cls.queue.pop(0)
+            for listener in cls.getListeners(evt.__class__):
+                start = time.time()
+                try:
+                    listener.processEvent(evt)
+                except Exception:
+                    if cls.error is None: cls.error = sys.exc_info()
+                seconds = time.time()-start
+                UBProfiler.record(listener.__name__, seconds)
+                if cls.isDebugging: cls.timings.append((listener.__name__, seconds))
+
+    @classmethod
+    def __applyEffects(cls):
+        refreshes, cls.refreshes = cls.refreshes, []
+        outdated, cls.outdated = cls.outdated, []
+        for nr in refreshes:
+            if nr == vim.current.buffer.number:
+                cls.refreshed.append(nr)
+                cls.refresher()
+            elif nr not in outdated:
+                outdated.append(nr)
+        for nr in outdated:
+            if nr not in cls.refreshed:
+                cls.outdater(nr)
+
+    @classmethod
+    def __report(cls, timings):
+        for name, seconds in timings:
+            vim.command('echomsg "UltraBlog: %s took %.1f ms"' % (name, seconds*1000))
 
 if __name__ == '__main__':
     pass
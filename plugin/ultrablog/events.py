@@ -16,6 +16,8 @@ class UBPostSaveEvent(UBEvent): pass
 
 class UBViewEnterEvent(UBEvent): pass
 class UBReplaceCompleteEvent(UBEvent): pass
+class UBAsyncDoneEvent(UBEvent): pass
+class UBSyncCompleteEvent(UBEvent): pass
 
 if __name__ == '__main__':
     pass
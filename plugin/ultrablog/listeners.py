@@ -5,6 +5,7 @@ from util import *
 from commands import *
 from events import *
 from eventqueue import UBEventQueue
+from registry import UBViewRegistry
 
 class UBListener():
     ''' Parent class of all listeners
@@ -38,13 +39,10 @@ class UBTmplDelListener(UBListener):
     @staticmethod
     def processEvent(evt):
         for nr in ub_get_buffers(['local_tmpl_list']):
-            if nr == ub_get_bufnr('%'):
-                ub_refresh_current_view()
-            else:
-                ub_set_view_outdated(nr)
+            UBEventQueue.refreshView(nr)
 
         for nr in ub_get_buffers(['tmpl_edit']):
-            if evt.srcObj == ub_get_meta('name', nr):
+            if evt.srcObj == UBViewRegistry.getKey(nr):
                 vim.command('bd! %d' % nr)
 
 class UBTmplSaveListener(UBListener):
@@ -57,10 +55,7 @@ class UBTmplSaveListener(UBListener):
     @staticmethod
     def processEvent(evt):
         for nr in ub_get_buffers(['local_tmpl_list']):
-            if nr == ub_get_bufnr('%'):
-                ub_list_templates()
-            else:
-                ub_set_view_outdated(nr)
+            UBEventQueue.refreshView(nr)
 
 class UBRemotePostDelListener(UBListener):
     ''' Listener for remote posts/pages deletion events
@@ -77,10 +72,7 @@ class UBRemotePostDelListener(UBListener):
         sess.commit()
 
         for nr in ub_get_buffers(['post_list','post_edit','page_list','page_edit','search_result_list']):
-            if nr == ub_get_bufnr('%'):
-                ub_refresh_current_view()
-            else:
-                ub_set_view_outdated(nr)
+            UBEventQueue.refreshView(nr)
 
 class UBLocalPostDelListener(UBListener):
     ''' Listener for local posts/pages deletion events
@@ -93,14 +85,11 @@ class UBLocalPostDelListener(UBListener):
     @staticmethod
     def processEvent(evt):
         for nr in ub_get_buffers(['post_edit','page_edit']):
-            if evt.srcObj == ub_get_meta('id', nr):
+            if evt.srcObj == UBViewRegistry.getKey(nr):
                 vim.command('bd! %d' % nr)
 
-        for nr in ub_get_buffers(['post_list','page_list','search_result_list']):
-            if nr == ub_get_bufnr('%'):
-                ub_refresh_current_view()
-            else:
-                ub_set_view_outdated(nr)
+        for nr in ub_patch_list_views([int(evt.srcObj)], True):
+            UBEventQueue.refreshView(nr)
 
 class UBPostSaveListener(UBListener):
     ''' Listener for saving posts/pages
@@ -112,17 +101,11 @@ class UBPostSaveListener(UBListener):
     @staticmethod
     def processEvent(evt):
         for nr in ub_get_buffers(['post_edit','page_edit']):
-            if evt.srcObj==ub_get_meta('id', nr):
-                if nr==ub_get_bufnr('%'):
-                    ub_refresh_current_view()
-                else:
-                    ub_set_view_outdated(nr)
+            if evt.srcObj==UBViewRegistry.getKey(nr):
+                UBEventQueue.refreshView(nr)
 
-        for nr in ub_get_buffers(['post_list','page_list','search_result_list']):
-            if nr == ub_get_bufnr('%'):
-                ub_refresh_current_view()
-            else:
-                ub_set_view_outdated(nr)
+        for nr in ub_patch_list_views([int(evt.srcObj)]):
+            UBEventQueue.refreshView(nr)
 
 class UBPostSendListener(UBListener):
     ''' Listener for sending posts/pages
@@ -133,7 +116,7 @@ class UBPostSendListener(UBListener):
     @staticmethod
     def processEvent(evt):
         for nr in ub_get_buffers(['remote_post_list','remote_page_list']):
-            ub_set_view_outdated(nr)
+            UBEventQueue.outdateView(nr)
 
 class UBViewEnterListener(UBListener):
     ''' Listener for creating new views
@@ -148,7 +131,8 @@ class UBViewEnterListener(UBListener):
             vim.command("command! -buffer -nargs=0 UBSave exec('py ub_save_item()')")
             vim.command("command! -buffer -nargs=? -complete=custom,StatusCmpl UBSend exec('py ub_send_item(<f-args>)')")
             vim.command("command! -buffer -nargs=? -complete=custom,UBPreviewCmpl UBPreview exec('py ub_preview(<f-args>)')")
-            vim.command("command! -buffer -nargs=1 -complete=file UBUpload exec('py ub_upload_media(<f-args>)')")
+            vim.command("command! -buffer -bang -nargs=1 -complete=file UBUpload exec('py ub_upload_media(<f-args>, \"<bang>\"==\"!\")')")
+            vim.command("command! -buffer -bang -nargs=+ -complete=file UBUploadMany exec('py ub_upload_many(\"<bang>\"==\"!\", <f-args>)')")
             vim.command("command! -buffer -nargs=* -complete=custom,SyntaxCmpl UBConv exec('py ub_convert(<f-args>)')")
             vim.command("map <buffer> "+ub_get_option('ub_hotkey_save_current_item')+" :UBSave<cr>")
             vim.command('setl wrap')
@@ -157,24 +141,75 @@ class UBViewEnterListener(UBListener):
             vim.command("map <buffer> "+ub_get_option('ub_hotkey_open_item_in_splitted_view')+" :py ub_open_item_under_cursor('split')<cr>")
             vim.command("map <buffer> "+ub_get_option('ub_hotkey_open_item_in_tabbed_view')+" :py ub_open_item_under_cursor('tab')<cr>")
             vim.command("map <buffer> "+ub_get_option('ub_hotkey_delete_item')+" :py ub_del_item_under_cursor()<cr>")
+            vim.command("command! -buffer -range UBDelRange exec('py ub_del_range(<line1>, <line2>)')")
+            vim.command("command! -buffer -range UBOpenRange exec('py ub_open_range(<line1>, <line2>)')")
+            vim.command("command! -buffer -range -nargs=? -complete=custom,StatusCmpl UBSendRange exec('py ub_send_range(<line1>, <line2>, <f-args>)')")
+            vim.command("vmap <buffer> "+ub_get_option('ub_hotkey_delete_item')+" :UBDelRange<cr>")
+            vim.command("vmap <buffer> "+ub_get_option('ub_hotkey_open_item_in_tabbed_view')+" :UBOpenRange<cr>")
             vim.command('setl nowrap')
         vim.command("command! -buffer -nargs=0 UBRefresh exec('py ub_refresh_current_view()')")
 
 class UBReplaceCompleteListener(UBListener):
-    ''' Listener for context replacement event
-    1. Refresh the current view if it is an list view of this post
-    2. Mark all list views of posts/pages outdated
+    ''' Listener for context replacement event, of which the source is the ids
+    of the substituted items
+    1. Refresh edit views of these items and search result lists
+    2. Patch the lines of these items in list views
     '''
     eventType = UBReplaceCompleteEvent
 
+    @staticmethod
+    def processEvent(evt):
+        if len(evt.srcObj)==0: return
+        keys = [str(id) for id in evt.srcObj]
+        for nr in ub_get_buffers(['post_edit','page_edit']):
+            if str(UBViewRegistry.getKey(nr)) in keys:
+                UBEventQueue.refreshView(nr)
+
+        # Replacement may change what matches the keywords
+        for nr in ub_get_buffers(['search_result_list']):
+            UBEventQueue.refreshView(nr)
+
+        for nr in ub_patch_list_views(evt.srcObj, False, ['post_list','page_list']):
+            UBEventQueue.refreshView(nr)
+
+class UBSyncCompleteListener(UBListener):
+    ''' Listener for synchronization events
+    1. Refresh the current view if it is a list view of posts/pages
+    2. Mark all other list views of posts/pages outdated
+    '''
+    eventType = UBSyncCompleteEvent
+
     @staticmethod
     def processEvent(evt):
         if evt.srcObj <= 0: return
-        for nr in ub_get_buffers(['post_edit','page_edit','post_list','page_list','search_result_list']):
-            if nr == ub_get_bufnr('%'):
-                ub_refresh_current_view()
+        for nr in ub_get_buffers(['post_list','page_list','search_result_list']):
+            UBEventQueue.refreshView(nr)
+
+class UBAsyncDoneListener(UBListener):
+    ''' Listener for background calls which have finished
+    1. Pass the result to the callback of the call
+    2. Pass the error to the errback of the call, or report it
+    3. Report errors raised by the callback or the errback
+    '''
+    eventType = UBAsyncDoneEvent
+
+    @staticmethod
+    def processEvent(evt):
+        job = evt.srcObj
+        try:
+            if job.error is None:
+                if job.callback is not None: job.callback(job.result)
+            elif job.errback is not None:
+                job.errback(job.error)
             else:
-                ub_set_view_outdated(nr)
+                raise job.error
+        except Exception, e:
+            # Jobs finished in the same poll are delivered after this one,
+            # so their results must not be lost to this error
+            ub_echoerr_nonfatal(ub_get_error_message(e))
+
+UBEventQueue.refresher = staticmethod(ub_refresh_current_view)
+UBEventQueue.outdater = staticmethod(ub_set_view_outdated)
 
 UBEventQueue.registerListener(UBDebugListener)
 UBEventQueue.registerListener(UBTmplDelListener)
@@ -185,6 +220,8 @@ UBEventQueue.registerListener(UBPostSendListener)
 UBEventQueue.registerListener(UBPostSaveListener)
 UBEventQueue.registerListener(UBViewEnterListener)
 UBEventQueue.registerListener(UBReplaceCompleteListener)
+UBEventQueue.registerListener(UBAsyncDoneListener)
+UBEventQueue.registerListener(UBSyncCompleteListener)
 
 if __name__ == '__main__':
     pass
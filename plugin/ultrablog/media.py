@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+import xmlrpclib, base64, urllib, hashlib, os
+
+class UBMediaBody:
+    ''' The body of a metaWeblog.newMediaObject request, which is read in
+    pieces by httplib as it is sent, so that the file is base64-encoded a
+    chunk at a time instead of being held in memory, encoded, as a whole.
+    It can be rewound, in case the request has to be sent again.
+    '''
+    # Chunks are multiples of 3 bytes, so that they encode with no padding
+    chunkSize = 3*16384
+    # Stands for the file in the request built by xmlrpclib
+    marker = '\0UltraBlog.vim media\0'
+
+    def __init__(self, method, params, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+        params = params[:-1] + (dict(params[-1], bits=xmlrpclib.Binary(self.marker)),)
+        request = xmlrpclib.dumps(params, method)
+        self.prefix, self.suffix = request.split(base64.encodestring(self.marker), 1)
+        self.pieces = None
+
+    def __len__(self):
+        return len(self.prefix) + (self.size+2)/3*4 + len(self.suffix)
+
+    def seek(self, offset):
+        self.pieces = None
+
+    def read(self, blocksize=-1):
+        if self.pieces is None: self.pieces = self.__generate()
+        try:
+            return self.pieces.next()
+        except StopIteration:
+            return ''
+
+    def __generate(self):
+        yield self.prefix
+        fp = open(self.path, 'rb')
+        try:
+            while True:
+                chunk = fp.read(self.chunkSize)
+                if not chunk: break
+                yield base64.b64encode(chunk)
+        finally:
+            fp.close()
+        yield self.suffix
+
+class UBMediaUploader:
+    ''' Upload files by metaWeblog.newMediaObject with streamed request bodies
+    '''
+    @staticmethod
+    def digest(path):
+        ''' Return the SHA-256 of the content of the file in hex, and its size
+        '''
+        sha = hashlib.sha256()
+        size = 0
+        fp = open(path, 'rb')
+        try:
+            while True:
+                chunk = fp.read(UBMediaBody.chunkSize)
+                if not chunk: break
+                sha.update(chunk)
+                size += len(chunk)
+        finally:
+            fp.close()
+        return sha.hexdigest(), size
+
+    @staticmethod
+    def upload(api, url, loginName, password, path, fileType):
+        ''' Upload the file through the transport of the API proxy and return
+        the result of the call, which is meant to be run by UBJob
+        '''
+        params = ('', loginName, password, dict(name=os.path.basename(path), type=fileType))
+        body = UBMediaBody('metaWeblog.newMediaObject', params, path)
+        host, handler = urllib.splithost(urllib.splittype(url)[1])
+        response = api('transport').request(host, handler or '/RPC2', body)
+        return response[0]
+
+if __name__ == '__main__':
+    pass
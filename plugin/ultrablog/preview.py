@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+import threading, BaseHTTPServer, SocketServer, socket, subprocess, Queue, json, os, webbrowser
+
+# Injected into previewed pages, reloads the page when the draft changes
+# and keeps the scroll position across reloads
+LIVE_RELOAD_SCRIPT = '''<script>
+(function() {
+    var key = 'ub_scroll_' + location.pathname;
+    if (window.sessionStorage && sessionStorage[key]) window.scrollTo(0, parseInt(sessionStorage[key]));
+    if (!window.EventSource) return;
+    var source = new EventSource(location.pathname + '/events?version=%d');
+    source.onmessage = function() {
+        if (window.sessionStorage) sessionStorage[key] = window.pageYOffset;
+        source.close();
+        location.reload();
+    };
+})();
+</script>'''
+
+class UBPreviewHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ''' Serve /<bufnr> as the rendered draft of the buffer,
+    and /<bufnr>/events as a stream of server-sent events which fires
+    whenever the draft changes
+    '''
+    def do_GET(self):
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if not parts[0].isdigit():
+            self.send_error(404)
+            return
+
+        nr = int(parts[0])
+        if len(parts) == 1:
+            self.__sendPage(nr)
+        elif len(parts) == 2 and parts[1] == 'events':
+            version = 0
+            if '?version=' in self.path:
+                try:
+                    version = int(self.path.split('?version=')[1])
+                except ValueError: pass
+            self.__sendEvents(nr, version)
+        else:
+            self.send_error(404)
+
+    def __sendPage(self, nr):
+        page = UBPreviewServer.getPage(nr)
+        if page is None:
+            self.send_error(404)
+            return
+        version, html = page
+        script = LIVE_RELOAD_SCRIPT % version
+        idx = html.lower().rfind('</body>')
+        html = idx>=0 and html[:idx]+script+html[idx:] or html+script
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(html)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(html)
+
+    def __sendEvents(self, nr, version):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        UBPreviewServer.watch(nr, 1)
+        try:
+            while True:
+                new_version = UBPreviewServer.waitForChange(nr, version, 15)
+                if new_version is None: break
+                if new_version == version:
+                    # Keep the connection alive, and find out if the client has gone
+                    self.wfile.write(': ping\n\n')
+                else:
+                    self.wfile.write('data: %d\n\n' % new_version)
+                    version = new_version
+                self.wfile.flush()
+        except socket.error:
+            pass
+        finally:
+            UBPreviewServer.watch(nr, -1)
+
+    def log_message(self, format, *args):
+        pass
+
+class UBThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class UBPreviewServer:
+    ''' Serve rendered drafts from memory on localhost, keyed by buffer number.
+    Pages which are open in a browser are reloaded when the draft is published
+    again, so previewing repeatedly needs no new file, window or tab.
+    '''
+    server = None
+    thread = None
+    pages = {}
+    watchers = {}
+    cond = threading.Condition()
+
+    @classmethod
+    def start(cls):
+        if cls.server is None:
+            cls.server = UBThreadingHTTPServer(('127.0.0.1', 0), UBPreviewHandler)
+            cls.thread = threading.Thread(target=cls.server.serve_forever, name='UltraBlogPreview')
+            cls.thread.setDaemon(True)
+            cls.thread.start()
+        return cls.server.server_address[1]
+
+    @classmethod
+    def stop(cls):
+        if cls.server is not None:
+            cls.cond.acquire()
+            try:
+                cls.pages.clear()
+                cls.cond.notifyAll()
+            finally:
+                cls.cond.release()
+            cls.server.shutdown()
+            cls.server.server_close()
+            cls.server = None
+
+    @classmethod
+    def url(cls, nr):
+        return 'http://127.0.0.1:%d/%d' % (cls.start(), nr)
+
+    @classmethod
+    def publish(cls, nr, html):
+        ''' Set the page of the buffer, return False if nothing has changed
+        '''
+        cls.cond.acquire()
+        try:
+            version, old_html = cls.pages.get(nr, (0, None))
+            if html == old_html: return False
+            cls.pages[nr] = (version+1, html)
+            cls.cond.notifyAll()
+            return True
+        finally:
+            cls.cond.release()
+
+    @classmethod
+    def remove(cls, nr):
+        cls.cond.acquire()
+        try:
+            cls.pages.pop(nr, None)
+            cls.cond.notifyAll()
+        finally:
+            cls.cond.release()
+
+    @classmethod
+    def getPage(cls, nr):
+        cls.cond.acquire()
+        try:
+            return cls.pages.get(nr)
+        finally:
+            cls.cond.release()
+
+    @classmethod
+    def isWatched(cls, nr):
+        ''' Check if the page of the buffer is open in a browser
+        '''
+        return cls.watchers.get(nr, 0) > 0
+
+    @classmethod
+    def watch(cls, nr, delta):
+        cls.cond.acquire()
+        try:
+            cls.watchers[nr] = cls.watchers.get(nr, 0) + delta
+        finally:
+            cls.cond.release()
+
+    @classmethod
+    def waitForChange(cls, nr, version, timeout):
+        ''' Wait until the page has a version other than the given one and return
+        it, or return the given version on timeout, or None if the page is gone
+        '''
+        cls.cond.acquire()
+        try:
+            page = cls.pages.get(nr)
+            if page is not None and page[0] == version:
+                cls.cond.wait(timeout)
+                page = cls.pages.get(nr)
+            return page is not None and page[0] or None
+        finally:
+            cls.cond.release()
+
+class UBViewerClient:
+    ''' Talk to the built-in previewer, which runs viewer.py as a process of
+    its own. The process is started on first use and reused afterwards.
+    Messages are delivered by a background thread, failures are kept in
+    error, to be reported by the main thread.
+    '''
+    python = 'python'
+    proc = None
+    port = None
+    error = None
+    # Set if the previewer cannot be started, the web browser is used instead
+    failed = False
+    thread = None
+    messages = Queue.Queue()
+
+    @classmethod
+    def send(cls, cmd, **kwargs):
+        kwargs['cmd'] = cmd
+        cls.messages.put(kwargs)
+        if cls.thread is None or not cls.thread.isAlive():
+            cls.thread = threading.Thread(target=cls.__run, name='UltraBlogViewer')
+            cls.thread.setDaemon(True)
+            cls.thread.start()
+
+    @classmethod
+    def takeError(cls):
+        error, cls.error = cls.error, None
+        return error
+
+    @classmethod
+    def stop(cls):
+        proc, cls.proc = cls.proc, None
+        if proc is not None and proc.poll() is None:
+            try:
+                cls.__deliver(proc, cls.port, dict(cmd='quit'))
+                proc.wait()
+            except socket.error:
+                proc.kill()
+
+    @classmethod
+    def __run(cls):
+        while True:
+            msg = cls.messages.get()
+            try:
+                if cls.proc is None or cls.proc.poll() is not None:
+                    # Nothing to reload or close in a viewer which is not running
+                    if msg['cmd'] != 'open': continue
+                    cls.__start()
+                cls.__deliver(cls.proc, cls.port, msg)
+            except Exception, e:
+                cls.error = e
+                # Do not leave the user without a preview
+                if msg['cmd'] == 'open': webbrowser.open(msg['url'])
+
+    @classmethod
+    def __start(cls):
+        viewer = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'viewer.py')
+        devnull = open(os.devnull, 'w')
+        cls.proc = subprocess.Popen([cls.python, viewer], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=devnull)
+        port = cls.proc.stdout.readline().strip()
+        if not port.isdigit():
+            cls.proc = None
+            cls.failed = True
+            raise OSError(_('The previewer cannot be started, pywebkitgtk may be missing !'))
+        cls.port = int(port)
+
+    @classmethod
+    def __deliver(cls, proc, port, msg):
+        conn = socket.create_connection(('127.0.0.1', port), 5)
+        try:
+            conn.sendall(json.dumps(msg) + '\n')
+        finally:
+            conn.close()
+
+if __name__ == '__main__':
+    pass
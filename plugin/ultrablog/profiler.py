@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+import time, threading, bisect, cProfile, os
+from collections import deque
+
+class UBProfiler:
+    ''' Durations of the phases of commands: their steps, SQL statements,
+    calls to the blog, syntax conversions and event listeners. The latest
+    phases are kept in a ring buffer, so that memory stays bounded however
+    long Vim runs, and how long whole commands take is counted in histograms
+    of fixed buckets. Phases outside of any command, e.g. of calls made in
+    the background, are recorded under (other).
+    '''
+    size = 2000
+    records = deque(maxlen=size)
+    # Upper bounds of the buckets of histograms in milliseconds
+    buckets = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+    histograms = {}
+    lock = threading.Lock()
+    # Names of the commands running in each thread, innermost last
+    local = threading.local()
+
+    @classmethod
+    def resize(cls, size):
+        if size != cls.size:
+            cls.size = size
+            cls.records = deque(cls.records, maxlen=size)
+
+    @classmethod
+    def current(cls):
+        commands = getattr(cls.local, 'commands', None)
+        return commands and commands[-1] or '(other)'
+
+    @classmethod
+    def command(cls, name, func, dumpFile=None):
+        ''' Run func as the command of the given name, whose phases are
+        recorded under it, and dump its cProfile statistics to dumpFile if any
+        '''
+        if not hasattr(cls.local, 'commands'): cls.local.commands = []
+        cls.local.commands.append(name)
+        start = time.time()
+        try:
+            if dumpFile is None: return func()
+            prof = cProfile.Profile()
+            try:
+                return prof.runcall(func)
+            finally:
+                prof.dump_stats(os.path.expanduser(dumpFile))
+        finally:
+            seconds = time.time()-start
+            cls.local.commands.pop()
+            cls.__count(name, seconds)
+
+    @classmethod
+    def call(cls, phase, func, *args):
+        ''' Call func and record how long it takes as a phase of the current command
+        '''
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            cls.record(phase, time.time()-start)
+
+    @classmethod
+    def record(cls, phase, seconds):
+        cls.records.append((cls.current(), phase, seconds))
+
+    @classmethod
+    def watchEngine(cls, engine):
+        ''' Record the SQL statements executed by the engine, by their verbs
+        '''
+        from sqlalchemy import event
+
+        def before(conn, cursor, statement, parameters, context, executemany):
+            conn.info['ub_statement_start'] = time.time()
+
+        def after(conn, cursor, statement, parameters, context, executemany):
+            start = conn.info.pop('ub_statement_start', None)
+            if start is not None:
+                cls.record('sql %s' % statement.split(None, 1)[0].lower(), time.time()-start)
+
+        event.listen(engine, 'before_cursor_execute', before)
+        event.listen(engine, 'after_cursor_execute', after)
+
+    @classmethod
+    def clear(cls):
+        cls.records.clear()
+        cls.lock.acquire()
+        try:
+            cls.histograms.clear()
+        finally:
+            cls.lock.release()
+
+    @classmethod
+    def report(cls, count=10):
+        ''' Return a list of lines showing the phases which took the longest
+        in total, and the histograms of commands
+        '''
+        phases = {}
+        for command, phase, seconds in list(cls.records):
+            stat = phases.setdefault((command, phase), [0, 0.0, 0.0])
+            stat[0] += 1
+            stat[1] += seconds
+            stat[2] = max(stat[2], seconds)
+        slowest = sorted(phases.items(), key=lambda item: item[1][1], reverse=True)[:count]
+
+        lines = []
+        lines.append('Phases:       %d/%d' % (len(cls.records), cls.size))
+        lines.append('%-16s%-36s%8s%12s%10s' % ('Command', 'Phase', 'Count', 'Total ms', 'Max ms'))
+        for (command, phase), (calls, total, longest) in slowest:
+            lines.append('%-16s%-36s%8d%12.1f%10.1f' % (command, phase, calls, total*1000, longest*1000))
+
+        labels = ['<%d' % bound for bound in cls.buckets] + ['>=%d' % cls.buckets[-1]]
+        lines.append('')
+        lines.append('%-16s%s' % ('Command', 'Runs by milliseconds taken'))
+        cls.lock.acquire()
+        try:
+            for name in sorted(cls.histograms.keys()):
+                counts = cls.histograms[name]
+                lines.append('%-16s%s' % (name,
+                    '  '.join(['%s:%d' % (labels[i], n) for i, n in enumerate(counts) if n>0])))
+        finally:
+            cls.lock.release()
+        return lines
+
+    @classmethod
+    def __count(cls, name, seconds):
+        cls.lock.acquire()
+        try:
+            counts = cls.histograms.setdefault(name, [0]*(len(cls.buckets)+1))
+            counts[bisect.bisect_right(cls.buckets, seconds*1000)] += 1
+        finally:
+            cls.lock.release()
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+class UBViewRegistry:
+    ''' Views of UltraBlog.vim, keyed by buffer number, each of which has
+    a name, the key of the item it holds, if any, and an outdated flag.
+    It is kept up to date by ub_wise_open_view() and the autocommands for
+    BufDelete and BufWipeout, so that looking up views needs no vim.eval().
+    '''
+    views = {}
+
+    @classmethod
+    def register(cls, nr, name):
+        cls.views[nr] = dict(name=name, key=None, outdated=False, rows=None)
+
+    @classmethod
+    def unregister(cls, nr):
+        cls.views.pop(nr, None)
+
+    @classmethod
+    def getName(cls, nr):
+        view = cls.views.get(nr)
+        return view is not None and view['name'] or None
+
+    @classmethod
+    def getKey(cls, nr):
+        view = cls.views.get(nr)
+        return view is not None and view['key'] or None
+
+    @classmethod
+    def setKey(cls, nr, key):
+        if cls.views.has_key(nr): cls.views[nr]['key'] = key
+
+    @classmethod
+    def isOutdated(cls, nr):
+        view = cls.views.get(nr)
+        return view is not None and view['outdated']
+
+    @classmethod
+    def setOutdated(cls, nr, outdated=True):
+        if cls.views.has_key(nr): cls.views[nr]['outdated'] = outdated
+
+    @classmethod
+    def getRows(cls, nr):
+        ''' Return the rows of a list view, one for each line after the title,
+        or None if the view is not a list or cannot be patched line by line
+        '''
+        view = cls.views.get(nr)
+        return view is not None and view['rows'] or None
+
+    @classmethod
+    def setRows(cls, nr, rows):
+        if cls.views.has_key(nr): cls.views[nr]['rows'] = rows
+
+    @classmethod
+    def find(cls, viewTypes=None):
+        ''' Return numbers of buffers whose view names end with any of the
+        given view types, or of all views if none is given
+        '''
+        nrs = []
+        for nr in sorted(cls.views.keys()):
+            name = cls.views[nr]['name']
+            if viewTypes is None or [vt for vt in viewTypes if name.endswith(vt)]:
+                nrs.append(nr)
+        return nrs
+
+if __name__ == '__main__':
+    pass
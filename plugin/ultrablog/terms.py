@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+import bisect
+
+class UBTermIndex:
+    ''' Categories and tags for completion, kept per taxonomy in lists sorted
+    by their lower-cased names, so that the terms starting with a prefix are
+    found by a binary search instead of a scan. It is filled from the local
+    database, the blog is only asked by a background refresh when the stored
+    terms are older than ub_completion_ttl.
+    '''
+    terms = {}
+    # When the terms in the database were fetched from the blog, 0 for never
+    fetched = None
+
+    @classmethod
+    def load(cls, taxonomy, names):
+        keys = {}
+        for name in names:
+            name = name.strip()
+            if name != '': keys.setdefault(name.lower(), name)
+        cls.terms[taxonomy] = sorted(keys.items())
+
+    @classmethod
+    def add(cls, taxonomy, names):
+        terms = cls.terms.setdefault(taxonomy, [])
+        for name in names:
+            name = name.strip()
+            key = name.lower()
+            i = bisect.bisect_left(terms, (key,))
+            if name != '' and (i == len(terms) or terms[i][0] != key):
+                terms.insert(i, (key, name))
+
+    @classmethod
+    def isLoaded(cls):
+        return cls.fetched is not None
+
+    @classmethod
+    def isStale(cls, now, ttl):
+        return cls.fetched is None or cls.fetched+ttl < now
+
+    @classmethod
+    def complete(cls, taxonomy, prefix):
+        ''' Return the terms of the taxonomy starting with the prefix, ignoring case
+        '''
+        terms = cls.terms.get(taxonomy, [])
+        prefix = prefix.lower()
+        matches = []
+        i = bisect.bisect_left(terms, (prefix,))
+        while i < len(terms) and terms[i][0].startswith(prefix):
+            matches.append(terms[i][1])
+            i += 1
+        return matches
+
+    @classmethod
+    def clear(cls):
+        cls.terms.clear()
+        cls.fetched = None
+
+if __name__ == '__main__':
+    pass
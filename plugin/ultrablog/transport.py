@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+import xmlrpclib, httplib, socket, errno, threading, re
+from profiler import UBProfiler
+
+class UBConnectionPool:
+    ''' Idle HTTP connections to the blog, shared by all threads
+    '''
+    def __init__(self, size=4):
+        self.size = size
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            conns = self.idle.get(key, [])
+            return len(conns)>0 and conns.pop() or None
+        finally:
+            self.lock.release()
+
+    def put(self, key, conn):
+        self.lock.acquire()
+        try:
+            conns = self.idle.setdefault(key, [])
+            if len(conns)<self.size:
+                conns.append(conn)
+                conn = None
+        finally:
+            self.lock.release()
+        if conn is not None: conn.close()
+
+    def clear(self, key=None):
+        self.lock.acquire()
+        try:
+            keys = key is None and self.idle.keys() or [key]
+            conns = []
+            for k in keys: conns.extend(self.idle.pop(k, []))
+        finally:
+            self.lock.release()
+        for conn in conns: conn.close()
+
+class UBStaleConnection(Exception):
+    ''' A connection taken from the pool had been closed by the server before
+    any byte of the response came, so the request can be sent again
+    '''
+    pass
+
+class UBTransport(xmlrpclib.Transport):
+    ''' HTTP/1.1 transport for the blog API, which keeps connections alive in
+    a pool shared by all proxies, so that TCP and TLS handshakes are paid once
+    instead of once a call. Responses are gzipped if the server is willing to,
+    requests are gzipped only if encode_threshold is set, because not every
+    server accepts that. A connection closed by the server while idle is
+    replaced by a fresh one transparently, which is the only case a request
+    is sent twice, since calls such as metaWeblog.newPost are not idempotent.
+    Request bodies may be file-like objects with a length, e.g. UBMediaBody,
+    which are streamed as they are.
+    '''
+    pool = UBConnectionPool()
+    encode_threshold = None
+    regex_method = re.compile('<methodName>([^<]*)</methodName>')
+
+    def __init__(self, secure=False, use_datetime=0):
+        xmlrpclib.Transport.__init__(self, use_datetime)
+        self.secure = secure
+
+    def request(self, host, handler, request_body, verbose=0):
+        # Calls are recorded by the name of the method, which is near the start of the body
+        m = self.regex_method.search(getattr(request_body, 'prefix', request_body)[:512])
+        return UBProfiler.call('xmlrpc %s' % (m and m.group(1) or handler),
+            self.__request, host, handler, request_body, verbose)
+
+    def __request(self, host, handler, request_body, verbose=0):
+        try:
+            return self.single_request(host, handler, request_body, verbose)
+        except UBStaleConnection:
+            if hasattr(request_body, 'seek'): request_body.seek(0)
+            return self.single_request(host, handler, request_body, verbose, True)
+
+    def single_request(self, host, handler, request_body, verbose=0, fresh=False):
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        key = (self.secure, chost)
+        if fresh:
+            # Other idle connections to the host are likely to be stale as well
+            self.pool.clear(key)
+        conn = self.pool.get(key)
+        isReused = conn is not None
+        response = None
+        if conn is None:
+            if self.secure:
+                conn = httplib.HTTPSConnection(chost, None, **(x509 or {}))
+            else:
+                conn = httplib.HTTPConnection(chost)
+        if verbose: conn.set_debuglevel(1)
+
+        try:
+            self.send_request(conn, handler, request_body)
+            self.send_host(conn, host)
+            self.send_user_agent(conn)
+            self.send_content(conn, request_body)
+
+            response = conn.getresponse(buffering=True)
+            if response.status == 200:
+                self.verbose = verbose
+                try:
+                    result = self.parse_response(response)
+                except xmlrpclib.Fault:
+                    # Faults are raised after the response has been read up
+                    self.__release(key, conn, response)
+                    raise
+                self.__release(key, conn, response)
+                return result
+        except xmlrpclib.Fault:
+            raise
+        except Exception, e:
+            conn.close()
+            if isReused and response is None and self.__isClosedByServer(e): raise UBStaleConnection()
+            raise
+
+        if response.getheader("content-length", 0):
+            response.read()
+        conn.close()
+        raise xmlrpclib.ProtocolError(host + handler, response.status, response.reason, response.msg)
+
+    def send_content(self, connection, request_body):
+        if not hasattr(request_body, 'read'):
+            xmlrpclib.Transport.send_content(self, connection, request_body)
+            return
+        # Streamed bodies are never gzipped, which needs the whole body
+        connection.putheader("Content-Type", "text/xml")
+        connection.putheader("Content-Length", str(len(request_body)))
+        connection.endheaders(request_body)
+
+    def close(self):
+        self.pool.clear()
+
+    def __isClosedByServer(self, e):
+        '''Whether the error is how sending to or reading the status line from
+        a connection closed by the server fails
+        '''
+        if isinstance(e, socket.error):
+            return e.errno in (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE)
+        # The status line is empty, how that is told differs between versions of Python 2.7
+        return isinstance(e, httplib.BadStatusLine) \
+            and (e.line.strip("'")=='' or e.line.startswith('No status line'))
+
+    def __release(self, key, conn, response):
+        '''Put the connection back to the pool unless the server is closing it
+        '''
+        if response.will_close: conn.close()
+        else: self.pool.put(key, conn)
+
+if __name__ == '__main__':
+    pass
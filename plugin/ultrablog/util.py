@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 
-import vim,re,types,os
+import vim,re,types,os,xmlrpclib
 from exceptions import *
 from events import UBViewEnterEvent
 from eventqueue import UBEventQueue
+from cache import UBRenderCache
+from converter import UBConverterPool
+from registry import UBViewRegistry
+from profiler import UBProfiler
 
 def ub_wise_open_view(view_name=None, view_type=None):
     '''Wisely decide whether to wipe out the content of current buffer 
@@ -23,6 +27,9 @@ def ub_wise_open_view(view_name=None, view_type=None):
 
     if view_name is not None:
         vim.command("let b:ub_view_name = '%s'" % view_name)
+        UBViewRegistry.register(vim.current.buffer.number, view_name)
+    else:
+        UBViewRegistry.unregister(vim.current.buffer.number)
 
     UBEventQueue.fireEvent(UBViewEnterEvent(view_name))
     UBEventQueue.processEvents()
@@ -80,18 +87,12 @@ def ub_is_ubbuf(expr):
 def ub_is_view_outdated(expr):
     ''' Check if the given view is outdated
     '''
-    nr = ub_get_bufnr(expr)
-    if nr is None:
-        nr = -1
-    return '1' == vim.eval("getbufvar(%d, 'ub_view_is_outdated')" % nr)
+    return UBViewRegistry.isOutdated(ub_get_view_bufnr(expr))
 
 def ub_is_view(view_name, expr='%'):
     '''Check if the current view is named by the given parameter
     '''
-    nr = ub_get_bufnr(expr)
-    if nr is not None:
-        return view_name == vim.eval("getbufvar(%d, 'ub_view_name')" % nr)
-    return False
+    return view_name == ub_get_viewname(expr)
 
 def ub_is_view_of_type(view_type, expr='%'):
     '''Check if the type of current view is the same with the given parameter
@@ -205,6 +206,15 @@ def ub_get_option(opt, deal=False):
         else:
             val = default
         return val
+    def __get_natural(val, default):
+        """Like __get_positive(), but 0 is accepted as well."""
+        if (type(val) is types.IntType and val>=0) or (type(val) is types.StringType and val.isdigit()):
+            return int(val)
+        return default
+    def __get_choice(val, choices, default):
+        """Return val in lower case if it is one of choices, or return default."""
+        if type(val) is types.StringType and val.lower() in choices: return val.lower()
+        return default
     def __get_boolean(val, default):
         """Return True if val is 1 or '1', or return False if val is 0 or '0', or default will be returned."""
         if val in [1,'1']: return True
@@ -237,10 +247,16 @@ def ub_get_option(opt, deal=False):
         val = val is None and '<c-pageup>' or val
     elif opt == 'ub_hotkey_save_current_item':
         val = val is None and '<c-s>' or val
+    elif opt == 'ub_viewer_python':
+        val = val is None and 'python' or val
     elif opt == 'ub_tmpl_img_url':
         val = val is None and "markdown###![%(file)s][]\n[%(file)s]:%(url)s" or val
     elif opt == 'ub_default_template':
         val = val is None and 'default' or val
+    elif opt == 'ub_cprofile_command':
+        val = val is None and '' or val
+    elif opt == 'ub_cprofile_file':
+        val = val is None and '~/ultrablog.prof' or val
     elif opt == 'ub_local_pagesize':
         val = __get_positive(val, 30)
     elif opt == 'ub_remote_pagesize':
@@ -249,6 +265,36 @@ def ub_get_option(opt, deal=False):
         val = __get_positive(val, 30)
     elif opt == 'ub_socket_timeout':
         val = __get_positive(val, 10)
+    elif opt == 'ub_sync_batchsize':
+        val = __get_positive(val, 50)
+    elif opt == 'ub_replace_batchsize':
+        val = __get_positive(val, 200)
+    elif opt == 'ub_upload_workers':
+        val = __get_positive(val, 3)
+    elif opt == 'ub_completion_ttl':
+        val = __get_positive(val, 86400)
+    elif opt == 'ub_profile_size':
+        val = __get_positive(val, 2000)
+    elif opt == 'ub_db_busy_timeout':
+        val = __get_natural(val, 5000)
+    elif opt == 'ub_db_cache_size':
+        val = __get_positive(val, 8192)
+    elif opt == 'ub_db_mmap_size':
+        val = __get_natural(val, 64)
+    elif opt == 'ub_db_journal_mode':
+        val = __get_choice(val, ['wal', 'delete', 'truncate', 'persist', 'memory', 'off'], 'wal')
+    elif opt == 'ub_db_synchronous':
+        val = __get_choice(val, ['off', 'normal', 'full', 'extra'], 'normal')
+    elif opt == 'ub_db_temp_store':
+        val = __get_choice(val, ['default', 'file', 'memory'], 'memory')
+    elif opt == 'ub_render_cache_size':
+        val = __get_positive(val, 32)
+    elif opt == 'ub_render_cache_disk_size':
+        val = __get_positive(val, 10240)
+    elif opt == 'ub_converter_processes':
+        val = __get_positive(val, 2)
+    elif opt == 'ub_preview_delay':
+        val = __get_positive(val, 300)
     elif opt == 'ub_viewer_width':
         val = __get_positive(val, 900)
     elif opt == 'ub_viewer_height':
@@ -259,6 +305,18 @@ def ub_get_option(opt, deal=False):
         val = __get_boolean(val, True)
     elif opt == 'ub_save_after_opened':
         val = __get_boolean(val, False)
+    elif opt == 'ub_use_fts':
+        val = __get_boolean(val, True)
+    elif opt == 'ub_async':
+        val = __get_boolean(val, True)
+    elif opt == 'ub_gzip_requests':
+        val = __get_boolean(val, False)
+    elif opt == 'ub_list_remote_from_mirror':
+        val = __get_boolean(val, True)
+    elif opt == 'ub_render_cache_persistent':
+        val = __get_boolean(val, False)
+    elif opt == 'ub_converter_server':
+        val = __get_boolean(val, False)
 
     if deal:
         if opt == 'ub_tmpl_img_url':
@@ -273,58 +331,107 @@ def ub_get_option(opt, deal=False):
 
     return val
 
+# Parsed headers of buffers, keyed by buffer number, refer to ub_parse_meta()
+__ub_meta_cache = {}
+__ub_regex_meta_item = re.compile('^\$(\w+):(.*)$')
+__ub_regex_meta_end = re.compile('^\s*-->')
+
+def ub_parse_meta(buf=None):
+    '''Parse the meta data in the header of the current buffer, or of the given one.
+    Return a dict of the raw values and the line numbers of items, and the index
+    of the line closing the header, which is None if there is no such line.
+    Only the header is read, and only once until the buffer changes.
+    '''
+    nr = ub_get_bufnr(buf)
+    if nr is None: nr = int(vim.eval("bufnr('%')"))
+    tick = vim.eval("getbufvar(%d, 'changedtick')" % nr)
+
+    cached = __ub_meta_cache.get(nr)
+    if cached is not None and cached[0] == tick: return cached[1]
+
+    buffer = ub_get_buffer(nr)
+    header = dict(items={}, lines={}, end=None)
+    if buffer is not None:
+        for i in xrange(len(buffer)):
+            line = buffer[i]
+            if __ub_regex_meta_end.match(line):
+                header['end'] = i
+                break
+            m = __ub_regex_meta_item.match(line)
+            if m is not None and not header['items'].has_key(m.group(1)):
+                header['items'][m.group(1)] = m.group(2).strip()
+                header['lines'][m.group(1)] = i
+
+    __ub_meta_cache[nr] = (tick, header)
+    return header
+
+def __ub_meta_value(header, item):
+    '''Return the value of the given item from a parsed header,
+    items whose names end with "id" must be positive integers
+    '''
+    val = header['items'].get(item)
+    if val is not None and item.endswith('id'):
+        if val.isdigit() and int(val)>0:
+            val = int(val)
+        else:
+            return None
+    return val
+
 def ub_get_meta(item, buf=None):
     '''Get value of the given item from meta data in the current buffer
     '''
-    def __get_value(item, line):
-        tmp = line.split(':')
-        val = ':'.join(tmp[1:]).strip()
-        if item.endswith('id'):
-            if val.isdigit():
-                val = int(val)
-                if val<=0:
-                    return None
-            else:
-                return None
-        return val
+    return __ub_meta_value(ub_parse_meta(buf), item)
 
-    nr = ub_get_bufnr(buf)
-    if nr is None: nr = int(vim.eval("bufnr('%')"))
-    regex_meta_end = re.compile('^\s*-->')
-    regex_item = re.compile('^\$'+item+':\s*')
-    for line in vim.eval("getbufline(%d,0,'$')" % nr):
-        if regex_meta_end.match(line):
-            break
-        if regex_item.match(line):
-            return __get_value(item, line)
-    return None
+def ub_set_meta(item, value, buf=None):
+    '''Set value of the given item from meta data in the current buffer,
+    or in the given buffer
+    '''
+    buffer = vim.current.buffer
+    if buf is not None:
+        buffer = ub_get_buffer(ub_get_bufnr(buf))
+        if buffer is None: return False
+    lnum = ub_parse_meta(buffer.number)['lines'].get(item)
+    if lnum is None: return False
+    buffer[lnum] = "$%-17s%s" % (item+':',value)
+    if item in ['id', 'name']: UBViewRegistry.setKey(buffer.number, value)
+    return True
 
-def ub_set_meta(item, value):
-    '''Set value of the given item from meta data in the current buffer
-    '''
-    regex_meta_end = re.compile('^\s*-->')
-    regex_item = re.compile('^\$'+item+':\s*')
-    for i in range(0,len(vim.current.buffer)):
-        if regex_meta_end.match(vim.current.buffer[i]):
-            break
-        if regex_item.match(vim.current.buffer[i]):
-            vim.current.buffer[i] = "$%-17s%s" % (item+':',value)
-            return True
-    return False
+def ub_forget_buffer(nr):
+    '''Drop everything kept for the given buffer, called when it is deleted
+    '''
+    UBViewRegistry.unregister(nr)
+    __ub_meta_cache.pop(nr, None)
+    __ub_deferred_views.pop(nr, None)
+
+# Functions which open views when their buffers are entered next, refer to ub_defer_view()
+__ub_deferred_views = {}
+
+def ub_defer_view(nr, func):
+    '''Call func to open a view when the given buffer is entered next, for
+    results of background calls which arrive after the user has moved away
+    from where they were asked for
+    '''
+    if ub_get_buffer(nr) is None: return False
+    __ub_deferred_views[nr] = func
+    return True
+
+def ub_pop_deferred_view(nr):
+    '''Return the function deferred for the given buffer, if any, and forget it
+    '''
+    return __ub_deferred_views.pop(nr, None)
 
 def ub_get_buffers(viewnames=None):
     ''' Return a list of buffer numbers which belongs to UltraBlog.vim
     If parameter viewnames is given, buffers which has the given name will be returned
     '''
-    bufs = []
-    for nr in range(int(vim.eval("bufnr('$')"))+1):
-        if viewnames is None and ub_is_ubbuf(nr):
-            bufs.append(nr)
-        if type(viewnames) is types.ListType:
-            for viewname in viewnames:
-                if ub_is_view_of_type(viewname, nr):
-                    bufs.append(nr)
-    return bufs
+    return UBViewRegistry.find(viewnames)
+
+def ub_get_buffer(nr):
+    ''' Return the buffer object of the given buffer number
+    '''
+    for buf in vim.buffers:
+        if buf.number == nr: return buf
+    return None
 
 def ub_get_bufvar(key, expr='%'):
     ''' Return the value of the given buffer variable
@@ -334,9 +441,17 @@ def ub_get_bufvar(key, expr='%'):
     return vim.eval("getbufvar(%d, '%s')" % (nr,key))
 
 def ub_get_viewname(expr):
-    ''' Return the value of variable b:ub_view_name in buffer nr
+    ''' Return the name of the view in buffer nr
+    '''
+    return UBViewRegistry.getName(ub_get_view_bufnr(expr))
+
+def ub_get_view_bufnr(expr):
+    ''' Return the buffer number which matches the given expression,
+    without asking Vim in the most common cases
     '''
-    return ub_get_bufvar('ub_view_name', expr)
+    if expr == '%': return vim.current.buffer.number
+    if type(expr) is types.IntType: return expr
+    return ub_get_bufnr(expr)
 
 def ub_get_bufnr(expr):
     ''' Return the buffer number which matches the given expression
@@ -391,18 +506,18 @@ def ub_get_blog_settings():
 def ub_set_view_outdated(expr, outdated=True):
     ''' Set the specified view to be outdated
     '''
-    nr = ub_get_bufnr(expr)
-    val = (outdated is True and 1) or 0
-    if nr is not None:
-        vim.command("call setbufvar(%d,'ub_view_is_outdated',%d)" % (nr,val))
+    UBViewRegistry.setOutdated(ub_get_view_bufnr(expr), outdated is True)
 
 def ub_fill_meta_data(meta_data):
     if ub_is_view('post_edit'):
         __ub_fill_post_meta_data(meta_data)
+        UBViewRegistry.setKey(vim.current.buffer.number, meta_data['id'] or None)
     elif ub_is_view('page_edit'):
         __ub_fill_page_meta_data(meta_data)
+        UBViewRegistry.setKey(vim.current.buffer.number, meta_data['id'] or None)
     elif ub_is_view('tmpl_edit'):
         __ub_fill_tmpl_meta_data(meta_data)
+        UBViewRegistry.setKey(vim.current.buffer.number, meta_data['name'] or None)
     else:
         raise UBException(_('Invalid view !'))
 
@@ -490,91 +605,114 @@ def ub_get_html(body_only=True):
 def ub_get_post_meta_data():
     '''Get all meta data of the post and return a dict
     '''
-    id = ub_get_meta('id')
-    if id is None:
-        id = 0
-    post_id = ub_get_meta('post_id')
-    if post_id is None:
-        post_id = 0
-
+    header = ub_parse_meta()
     return dict(\
-        id = id,
-        post_id = post_id,
-        title = ub_get_meta('title'),
-        categories = ub_get_meta('categories'),
-        tags = ub_get_meta('tags'),
-        slug = ub_get_meta('slug'),
-        status = ub_get_meta('status')
+        id = __ub_meta_value(header, 'id') or 0,
+        post_id = __ub_meta_value(header, 'post_id') or 0,
+        title = __ub_meta_value(header, 'title'),
+        categories = __ub_meta_value(header, 'categories'),
+        tags = __ub_meta_value(header, 'tags'),
+        slug = __ub_meta_value(header, 'slug'),
+        status = __ub_meta_value(header, 'status')
     )
 
 def ub_get_page_meta_data():
     '''Get all meta data of the page and return a dict
     '''
-    id = ub_get_meta('id')
-    if id is None:
-        id = 0
-    post_id = ub_get_meta('post_id')
-    if post_id is None:
-        post_id = 0
-
+    header = ub_parse_meta()
     return dict(\
-        id = id,
-        post_id = post_id,
-        title = ub_get_meta('title'),
-        slug = ub_get_meta('slug'),
-        status = ub_get_meta('status')
+        id = __ub_meta_value(header, 'id') or 0,
+        post_id = __ub_meta_value(header, 'post_id') or 0,
+        title = __ub_meta_value(header, 'title'),
+        slug = __ub_meta_value(header, 'slug'),
+        status = __ub_meta_value(header, 'status')
     )
 
 def ub_get_tmpl_meta_data():
+    header = ub_parse_meta()
     return dict(\
-        name = ub_get_meta('name'),
-        description = ub_get_meta('description')
+        name = __ub_meta_value(header, 'name'),
+        description = __ub_meta_value(header, 'description')
     )
 
+def ub_get_content_start():
+    '''Return the index of the first line of content in the current buffer
+    '''
+    # Numbers of meta data items in edit views
+    sizes = dict(post_edit=7, page_edit=5, tmpl_edit=2)
+    size = sizes.get(ub_get_viewname('%'))
+    if size is None: return 0
+
+    end = ub_parse_meta()['end']
+    return end is not None and end+1 or size+2
+
 def ub_get_content():
     '''Generate content from the current buffer
     '''
-    if ub_is_view('post_edit'):
-        meta_dict = ub_get_post_meta_data()
-    elif ub_is_view('page_edit'):
-        meta_dict = ub_get_page_meta_data()
-    elif ub_is_view('tmpl_edit'):
-        meta_dict = ub_get_tmpl_meta_data()
-    else:
-        return "\n".join(vim.current.buffer[:])
-
-    return "\n".join(vim.current.buffer[len(meta_dict)+2:])
+    return "\n".join(vim.current.buffer[ub_get_content_start():])
 
 def ub_set_content(lines):
     '''Set the given lines to the content area of the current buffer
     '''
-    meta_dict = None
-    if ub_is_view('post_edit'):
-        meta_dict = ub_get_post_meta_data()
-    elif ub_is_view('page_edit'):
-        meta_dict = ub_get_page_meta_data()
-    elif ub_is_view('tmpl_edit'):
-        meta_dict = ub_get_tmpl_meta_data()
-
-    idx = meta_dict is not None and len(meta_dict)+2 or 0
+    idx = ub_get_content_start()
     del vim.current.buffer[idx:]
     vim.current.buffer.append(lines, idx)
     return True
 
+def ub_import_markdown():
+    try:
+        import markdown
+    except ImportError:
+        try:
+            import markdown2 as markdown
+        except ImportError:
+            raise UBException(_('Missing module: python-markdown or python-markdown2 !'))
+    return markdown
+
+def ub_get_converter_command(from_syntax, to_syntax):
+    cmd_parts = []
+    cmd_parts.append(ub_get_option('ub_converter_command'))
+    cmd_parts.extend(ub_get_option('ub_converter_options'))
+    try:
+        cmd_parts.append(ub_get_option('ub_converter_option_from') % from_syntax)
+        cmd_parts.append(ub_get_option('ub_converter_option_to') % to_syntax)
+    except TypeError:
+        pass
+    return cmd_parts
+
+def ub_get_converter_identity(from_syntax, to_syntax):
+    '''Describe the converter and its version or options, which is a part of the
+    keys of UBRenderCache, so that cached results are not reused after the
+    converter has been changed
+    '''
+    if from_syntax == 'markdown' and to_syntax == 'html':
+        markdown = ub_import_markdown()
+        return '%s %s' % (markdown.__name__, getattr(markdown, '__version__', getattr(markdown, 'version', '')))
+    elif from_syntax == 'html' and to_syntax == 'markdown':
+        return 'html2text'
+    return ' '.join(ub_get_converter_command(from_syntax, to_syntax))
+
 def ub_convert_str(content, from_syntax, to_syntax, encoding=None):
     if from_syntax == to_syntax \
         or not ub_is_valid_syntax(from_syntax) \
         or not ub_is_valid_syntax(to_syntax):
         return content
 
+    UBRenderCache.size = ub_get_option('ub_render_cache_size')
+    key = UBRenderCache.key(content, from_syntax, to_syntax, encoding,
+        ub_get_converter_identity(from_syntax, to_syntax))
+    new_content = UBRenderCache.get(key)
+    if new_content is None:
+        new_content = UBProfiler.call('convert %s to %s' % (from_syntax, to_syntax),
+            ub_run_converter, content, from_syntax, to_syntax, encoding)
+        # An empty result of a non-empty content is most likely a failure
+        if len(new_content)>0 or len(content)==0:
+            UBRenderCache.put(key, new_content)
+    return new_content
+
+def ub_run_converter(content, from_syntax, to_syntax, encoding=None):
     if from_syntax == 'markdown' and to_syntax == 'html':
-        try:
-            import markdown
-        except ImportError:
-            try:
-                import markdown2 as markdown
-            except ImportError:
-                raise UBException(_('Missing module: python-markdown or python-markdown2 !'))
+        markdown = ub_import_markdown()
         if encoding is not None:
             new_content = markdown.markdown(content.decode(encoding)).encode(encoding)
         else:
@@ -589,39 +727,31 @@ def ub_convert_str(content, from_syntax, to_syntax, encoding=None):
         else:
             new_content = html2text.html2text(content)
     else:
-        cmd_parts = []
-        cmd_parts.append(ub_get_option('ub_converter_command'))
-        cmd_parts.extend(ub_get_option('ub_converter_options'))
-        try:
-            cmd_parts.append(ub_get_option('ub_converter_option_from') % from_syntax)
-            cmd_parts.append(ub_get_option('ub_converter_option_to') % to_syntax)
-        except TypeError:
-            pass
-        import subprocess
-        p = subprocess.Popen(cmd_parts, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        new_content = p.communicate(content)[0].replace("\r\n", "\n")
+        UBConverterPool.configure(ub_get_option('ub_converter_processes'))
+        new_content = UBConverterPool.convert(ub_get_converter_command(from_syntax, to_syntax),
+            content, from_syntax, to_syntax, encoding, ub_get_option('ub_converter_server'))
     return new_content
 
-def ub_get_templates(name_only=False):
-    ''' Fetch and return a list of templates
-    '''
-    tmpls = []
-
-    try:
-        sess = Session()
-        tmpls = sess.query(Template).all()
-        sess.close()
-
-        if name_only is True: tmpls = [tmpl.name for tmpl in tmpls]
-    except:
-        pass
-
-    return tmpls
-
 def ub_echoerr(msg):
     cmd = '''echoerr "%s"''' % msg.replace('"', "'")
     vim.command(cmd)
 
+def ub_echoerr_nonfatal(msg):
+    '''Show msg as an error without raising, :echoerr run by Python raises
+    vim.error, which must not escape e.g. a listener
+    '''
+    cmd = '''echohl ErrorMsg | echomsg "%s" | echohl None''' % msg.replace('"', "'")
+    vim.command(cmd)
+
+def ub_get_error_message(e):
+    '''Return the message of an error as it is shown to the user
+    '''
+    if isinstance(e, UBException): return e.message
+    if isinstance(e, xmlrpclib.Fault): return "xmlrpc error: %s" % e.faultString
+    if isinstance(e, xmlrpclib.ProtocolError): return "xmlrpc error: %s %s" % (e.url, e.errmsg)
+    if isinstance(e, IOError): return "network error: %s" % str(e)
+    return str(e)
+
 def ub_echo(msg):
     cmd = '''echo "%s"''' % msg.replace('"', "'")
     vim.command(cmd)
@@ -634,15 +764,30 @@ def raw(text):
                '\5':r'\5', '\6':r'\6', '\7':r'\7', '\8':r'\8', '\9':r'\9'}
     return "".join([escape_dict.get(char,char) for char in text])
 
+# Patterns compiled for the SQLite functions below, which are called per row
+__ub_patterns = {}
+
+def ub_compile_pattern(expr):
+    """Return the compiled pattern of the expr, compiling it only once"""
+    pattern = __ub_patterns.get(expr)
+    if pattern is None:
+        if len(__ub_patterns) >= 64: __ub_patterns.clear()
+        pattern = __ub_patterns[expr] = re.compile(expr)
+    return pattern
+
 def regex_replace(string, expr, repl):
     """Do substitutions on the string for repls matching the expr"""
-    r = re.compile(raw(expr))
-    return r.sub(repl, string)
+    if string is None: return None
+    return ub_compile_pattern(raw(expr)).sub(repl, string)
+
+def regex_count(string, expr):
+    """Count sub-strings of the string which match the expr"""
+    if string is None: return 0
+    return len(ub_compile_pattern(raw(expr)).findall(string))
 
 def regexp_search(expr, item):
     """Check if the item has a sub-string which matches the expr"""
-    reg = re.compile(expr)
-    return reg.search(item) is not None
+    return item is not None and ub_compile_pattern(expr).search(item) is not None
 
 def is_in_console():
     """Return True if invoked under console"""
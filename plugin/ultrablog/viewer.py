@@ -1,12 +1,29 @@
 #!/usr/bin/python
 
+'''The built-in previewer of UltraBlog.vim, which runs as a process of its own,
+so that GTK never blocks Vim. It prints the port it listens on, then waits
+for messages from Vim, one JSON object a line:
+
+    {"cmd": "open", "url": "...", "width": 900, "height": 600}
+    {"cmd": "reload"}
+    {"cmd": "close"}
+    {"cmd": "quit"}
+
+One window is reused for all previews, closing it only hides it. The process
+quits when Vim closes its standard input.
+'''
+
+import sys, os, socket, json, gettext
+gettext.install('ultrablog', os.path.join(os.path.dirname(__file__), os.path.pardir, 'locale'))
+
+import gobject
 import gtk
 import webkit
 
 class UBPreviewer(gtk.Window):
     def __init__(self, width=900, height=600):
         super(UBPreviewer, self).__init__()
-        self.connect("destroy", self.onDestroy)
+        self.connect("delete-event", self.onDelete)
         self.set_size_request(width, height)
         self.set_position(gtk.WIN_POS_CENTER)
         self.set_title(_('Previewer for UltraBlog.vim'))
@@ -30,8 +47,15 @@ class UBPreviewer(gtk.Window):
         self.show_all()
 
     def open(self, url):
-        self.viewer.open(url)
-    
+        if self.viewer.get_uri() == url:
+            self.viewer.reload()
+        else:
+            self.viewer.open(url)
+        self.present()
+
+    def reload(self):
+        self.viewer.reload()
+
     def onTitleChanged(self, webview, frame, title):
         self.set_title(title)
 
@@ -44,15 +68,63 @@ class UBPreviewer(gtk.Window):
     def onLoadFinished(self, webview, frame):
         self.progress.set_visible(False)
 
-    def onDestroy(self, w=None, data=None):
-        ''' Destroy app
+    def onDelete(self, w=None, data=None):
+        ''' Hide the window instead of destroying it, it will be reused
         '''
-        gtk.main_quit()
+        self.hide()
+        return True
+
+class UBViewerServer:
+    ''' Accept messages from Vim and apply them to the previewer window
+    '''
+    def __init__(self):
+        self.app = None
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        gobject.io_add_watch(self.sock, gobject.IO_IN, self.onAccept)
+
+    def getPort(self):
+        return self.sock.getsockname()[1]
+
+    def onAccept(self, sock, condition):
+        conn = sock.accept()[0]
+        try:
+            for line in conn.makefile():
+                if line.strip(): self.handle(json.loads(line))
+        except ValueError:
+            pass
+        conn.close()
+        return True
+
+    def handle(self, msg):
+        cmd = msg.get('cmd')
+        if cmd == 'open':
+            width, height = msg.get('width', 900), msg.get('height', 600)
+            if self.app is None:
+                self.app = UBPreviewer(width, height)
+            else:
+                self.app.set_size_request(width, height)
+                self.app.show_all()
+            self.app.open(msg['url'])
+        elif cmd == 'reload' and self.app is not None:
+            self.app.reload()
+        elif cmd == 'close' and self.app is not None:
+            self.app.hide()
+        elif cmd == 'quit':
+            gtk.main_quit()
+
+def onVimGone(source, condition):
+    gtk.main_quit()
+    return False
 
-def open(url, width=900, height=600):
-    app = UBPreviewer(width, height)
-    app.open(url)
+def main():
+    server = UBViewerServer()
+    sys.stdout.write('%d\n' % server.getPort())
+    sys.stdout.flush()
+    # Vim holds the other end of stdin, quit if Vim has gone without saying so
+    gobject.io_add_watch(sys.stdin, gobject.IO_HUP|gobject.IO_IN, onVimGone)
     gtk.main()
 
 if __name__ == '__main__':
-    pass
+    main()
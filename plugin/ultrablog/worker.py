@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+import threading, Queue
+
+class UBJob:
+    ''' A blocking call to be run by UBWorker
+    method is the dotted name of an XML-RPC method, e.g. metaWeblog.getPost,
+    or a function which is called with the API proxy and args
+    '''
+    def __init__(self, label, method, args, callback=None, errback=None):
+        self.label = label
+        self.method = method
+        self.args = args
+        self.callback = callback
+        self.errback = errback
+        self.result = None
+        self.error = None
+
+    def run(self, api):
+        if callable(self.method): return self.method(api, *self.args)
+        func = api
+        for name in self.method.split('.'):
+            func = getattr(func, name)
+        return func(*self.args)
+
+class UBWorker:
+    ''' Run XML-RPC calls in a background thread, so that the blog never
+    freezes Vim. The thread must not touch the vim module, finished jobs are
+    handed back to the main thread by poll().
+
+    Jobs which do not depend on each other, e.g. uploads, may be submitted
+    in parallel instead, they are run by a pool of at most poolSize threads,
+    which quit once there is nothing left to do.
+    '''
+    jobs = Queue.Queue()
+    results = Queue.Queue()
+    pending = []
+    thread = None
+    parallelJobs = Queue.Queue()
+    poolSize = 3
+    poolThreads = 0
+    lock = threading.Lock()
+
+    @classmethod
+    def submit(cls, job, apiFactory):
+        cls.pending.append(job)
+        cls.jobs.put(job)
+        if cls.thread is None or not cls.thread.isAlive():
+            cls.thread = threading.Thread(target=cls.__run, args=(apiFactory,), name='UltraBlogWorker')
+            cls.thread.setDaemon(True)
+            cls.thread.start()
+
+    @classmethod
+    def submitParallel(cls, job, apiFactory):
+        cls.pending.append(job)
+        cls.lock.acquire()
+        try:
+            cls.parallelJobs.put(job)
+            if cls.poolThreads < cls.poolSize:
+                cls.poolThreads += 1
+                thread = threading.Thread(target=cls.__runParallel, args=(apiFactory,), name='UltraBlogPool')
+                thread.setDaemon(True)
+                thread.start()
+        finally:
+            cls.lock.release()
+
+    @classmethod
+    def wait(cls, jobs):
+        ''' Block until the given jobs are finished and return them, for callers
+        which cannot wait for poll(), other finished jobs are left to poll()
+        '''
+        done = []
+        others = []
+        while len(done) < len(jobs):
+            job = cls.results.get()
+            if job in jobs:
+                cls.pending.remove(job)
+                done.append(job)
+            else:
+                others.append(job)
+        for job in others: cls.results.put(job)
+        return done
+
+    @classmethod
+    def __runParallel(cls, apiFactory):
+        api = None
+        while True:
+            cls.lock.acquire()
+            try:
+                try:
+                    job = cls.parallelJobs.get_nowait()
+                except Queue.Empty:
+                    cls.poolThreads -= 1
+                    return
+            finally:
+                cls.lock.release()
+            try:
+                if api is None: api = apiFactory()
+                job.result = job.run(api)
+            except Exception, e:
+                job.error = e
+            cls.results.put(job)
+
+    @classmethod
+    def __run(cls, apiFactory):
+        api = None
+        while True:
+            job = cls.jobs.get()
+            try:
+                if api is None: api = apiFactory()
+                job.result = job.run(api)
+            except Exception, e:
+                job.error = e
+            cls.results.put(job)
+
+    @classmethod
+    def poll(cls):
+        ''' Return the jobs finished since the last poll, called on the main thread
+        '''
+        done = []
+        while True:
+            try:
+                job = cls.results.get_nowait()
+            except Queue.Empty:
+                break
+            cls.pending.remove(job)
+            done.append(job)
+        return done
+
+    @classmethod
+    def isPending(cls, method=None):
+        for job in cls.pending:
+            if method is None or job.method == method: return True
+        return False
+
+if __name__ == '__main__':
+    pass